@@ -0,0 +1,205 @@
+import time
+import asyncio
+import collections
+import metrics
+import outbound
+
+# Tags our WHOX queries, so their replies can be told from pydle's (which
+# asks about every channel we join, with its own fields)
+WHOX_TOKEN = '731'
+PYDLE_TOKEN = '542'
+NO_ACCOUNT = '0'
+
+LOOKUPS = metrics.counter(
+    'kontroler_account_lookups_total',
+    'Nicks whose account was needed, by what answered: the JOIN itself '
+    '(join), what we already knew (known, cache), a lookup in flight '
+    '(pending) or a new one (query)', ['source'])
+RESOLUTION_SECONDS = metrics.histogram(
+    'kontroler_account_resolution_seconds',
+    'From an account being needed to the server saying what it is')
+
+
+class AccountResolver(object):
+    """ Finds out which account nicks are logged in to.
+
+    With extended-join, JOINs say it, and with account-notify pydle keeps
+    it current. Otherwise nicks are looked up, but never one at a time as
+    they join: the accounts of nicks that quit or left are remembered for
+    `ttl` seconds by nick!user@host, so rejoining after a netsplit costs
+    nothing, and lookups needed within `delay` seconds of each other go out
+    together, as a WHOX query for the channel when `channel_batch` or more
+    of its joins wait, or one per nick. Servers without WHOX get a WHOIS per
+    nick. A nick is looked up at most once at a time; nicks that aren't
+    logged in are asked about again after `ttl` seconds at the earliest. """
+
+    def __init__(self, irc, ttl=600, delay=0.5, channel_batch=5, timeout=30):
+        self.irc = irc
+        self.ttl = ttl
+        self.delay = delay
+        self.channel_batch = channel_batch
+        self.timeout = timeout
+        # {nick!user@host: (account, expires)}, oldest first
+        self._cache = collections.OrderedDict()
+        self._answered = {}  # {nick: when the server last told us}
+        self._pending = {}  # {nick: (future, since)}
+        self._queued = {}  # {nick: (nick, channel)} for the next batch
+        self._asked = {}  # {WHO mask: [nicks]} until the end of the reply
+        self._timer = None
+
+    def __len__(self):
+        return len(self._cache)
+
+    def _key(self, name):
+        return self.irc.normalize(name)
+
+    def _mask(self, nick):
+        user = self.irc.users.get(nick) or {}
+        if not user.get('username') or not user.get('hostname'):
+            return None
+        return self._key('{0}!{1}@{2}'.format(nick, user['username'],
+                                              user['hostname']))
+
+    def _capable(self, capability):
+        return bool(self.irc._capabilities.get(capability))
+
+    def _fresh(self, key):
+        when = self._answered.get(key)
+        if when is None:
+            return False
+        return self._capable('account-notify') or when + self.ttl > time.monotonic()
+
+    @staticmethod
+    def _done(account):
+        future = asyncio.get_event_loop().create_future()
+        future.set_result(account)
+        return future
+
+    def joined(self, channel, nick):
+        """ Starts finding out the account of `nick`, who joined `channel`,
+        unless the JOIN said it """
+        if self._capable('extended-join'):
+            LOOKUPS.inc('join')
+            self._answered[self._key(nick)] = time.monotonic()
+            return
+        self.lookup(nick, channel)
+
+    def lookup(self, nick, channel=None):
+        """ Returns a future for the account of `nick`: None if it's not
+        logged in or not around """
+        key = self._key(nick)
+        account = (self.irc.users.get(nick) or {}).get('account')
+        if account or self._fresh(key):
+            LOOKUPS.inc('known')
+            return self._done(account)
+        cached = self._cache.get(self._mask(nick))
+        if cached is not None and cached[1] > time.monotonic():
+            LOOKUPS.inc('cache')
+            self._answer(nick, cached[0])
+            return self._done(cached[0])
+        if key in self._pending:
+            LOOKUPS.inc('pending')
+            return self._pending[key][0]
+        LOOKUPS.inc('query')
+        future = asyncio.get_event_loop().create_future()
+        self._pending[key] = (future, time.monotonic())
+        self._queued[key] = (nick, channel)
+        if self._timer is None:
+            self._timer = asyncio.get_event_loop().call_later(self.delay,
+                                                              self._send)
+        return future
+
+    async def resolve(self, nick):
+        """ The account of `nick`, waiting for a lookup if needed (but no
+        more than `timeout` seconds) """
+        try:
+            return await asyncio.wait_for(asyncio.shield(self.lookup(nick)),
+                                          self.timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    def _send(self):
+        self._timer = None
+        queued, self._queued = self._queued, {}
+        if not self.irc._isupport.get('WHOX'):
+            for nick, channel in queued.values():
+                asyncio.ensure_future(self._whois(nick))
+            return
+        by_channel = collections.defaultdict(list)
+        for nick, channel in queued.values():
+            by_channel[channel].append(nick)
+        for channel, nicks in by_channel.items():
+            if channel is not None and len(nicks) >= self.channel_batch:
+                self._who(channel, nicks)
+            else:
+                for nick in nicks:
+                    self._who(nick, [nick])
+
+    def _who(self, mask, nicks):
+        self._asked.setdefault(self._key(mask), []).extend(nicks)
+        self.irc.outbound.put('WHO', mask, '%tna,' + WHOX_TOKEN,
+                              outbound.CONTROL)
+
+    async def _whois(self, nick):
+        info = await self.irc.whois(nick)
+        self._answer(nick, info and info.get('account'))
+
+    def _answer(self, nick, account):
+        key = self._key(nick)
+        now = time.monotonic()
+        self._answered[key] = now
+        user = self.irc.users.get(nick)
+        if user is not None:
+            user['account'] = account
+            user['identified'] = account is not None
+            self.irc.roster.set_account(nick, account)
+        pending = self._pending.pop(key, None)
+        if pending is not None:
+            RESOLUTION_SECONDS.observe(now - pending[1])
+            if not pending[0].done():
+                pending[0].set_result(account)
+
+    def on_whox(self, params):
+        """ A WHOX reply (354), ours or pydle's """
+        if params[1] == WHOX_TOKEN and len(params) >= 4:
+            nick, account = params[2:4]
+        elif params[1] == PYDLE_TOKEN and len(params) >= 6:
+            nick, account = params[4:6]
+        else:
+            return
+        self._answer(nick, None if account == NO_ACCOUNT else account)
+
+    def on_who_end(self, mask):
+        """ The end of a WHO reply (315): the nicks asked about that weren't
+        in it aren't around anymore """
+        for nick in self._asked.pop(self._key(mask), ()):
+            if self._key(nick) in self._pending:
+                self._answer(nick, None)
+
+    def left(self, nick):
+        """ `nick` quit or left a channel; remembers its account """
+        self._answered.pop(self._key(nick), None)
+        account = (self.irc.users.get(nick) or {}).get('account')
+        mask = self._mask(nick)
+        now = time.monotonic()
+        if account and mask:
+            self._cache.pop(mask, None)
+            self._cache[mask] = (account, now + self.ttl)
+        while self._cache and next(iter(self._cache.values()))[1] <= now:
+            self._cache.popitem(last=False)
+
+    def renamed(self, old, new):
+        self._answered.pop(self._key(old), None)
+
+    def clear(self):
+        """ Disconnected: lookups in flight won't be answered """
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        for future, since in self._pending.values():
+            if not future.done():
+                future.set_result(None)
+        self._pending.clear()
+        self._queued.clear()
+        self._asked.clear()
+        self._answered.clear()
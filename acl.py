@@ -0,0 +1,116 @@
+import time
+import config
+import aiodb
+import metrics
+from models import Effective
+
+# Which votes in effect entitle their target to a flag
+ENTITLES = {'V': ('civis', 'staff'),
+            'O': ('staff',)}
+# A flag isn't taken away if that'd leave this many or fewer holding it
+FLOOR = {'V': 3, 'O': 2}
+
+RECONCILE_SECONDS = metrics.histogram(
+    'kontroler_acl_reconcile_seconds',
+    'Time to check flags against the votes in effect and send the changes',
+    ['kind'])
+
+
+class ACLReconciler(object):
+    """ Keeps a channel's ChanServ access list in line with the votes in
+    effect, by taking away the flags nobody voted for.
+
+    The full FLAGS listing is an audit: it replaces the flags we know of and
+    every flagged account is checked against the active Effective rows,
+    loaded in a single query. Between audits, the accounts ChanServ tells us
+    got a flag are checked one at a time. Only the needed FLAGS changes are
+    sent. """
+
+    def __init__(self, irc):
+        self.irc = irc
+        self._listings = {}  # {channel key: {account: flags}} being received
+        self.runs = 0
+        self.last_duration = None  # seconds
+
+    def listed(self, chan, account, flags):
+        """ A line of the FLAGS listing """
+        self._listings.setdefault(chan.key, {})[account] = flags
+
+    async def audit(self, chan):
+        """ The FLAGS listing ended """
+        listing = self._listings.pop(chan.key, {})
+        for account, user in chan.usermap.items():
+            user.flags = listing.pop(account, '')
+        for account, flags in listing.items():
+            chan.usermap.add(account).flags = flags
+        await self.reconcile(chan)
+
+    async def changed(self, chan, account):
+        """ ChanServ says `account` got new flags """
+        await self.reconcile(chan, [account])
+
+    @staticmethod
+    def _entitlements(channel, accounts=None):
+        """ {account: {vote types in effect}} """
+        types = set(t for allowed in ENTITLES.values() for t in allowed)
+        query = Effective.select(Effective.vote_target, Effective.vote_type) \
+                         .where((Effective.channel == channel) &
+                                (Effective.vote_type << list(types)))
+        if accounts is not None:
+            query = query.where(Effective.vote_target << accounts)
+        entitled = {}
+        for target, vote_type in query.tuples():
+            entitled.setdefault(target, set()).add(vote_type)
+        return entitled
+
+    def diff(self, chan, entitled, accounts):
+        """ Returns [(account, flags to take away)] """
+        holders = dict.fromkeys(FLOOR, 0)
+        for user in chan.usermap.values():
+            for fl in FLOOR:
+                if fl in user.flags:
+                    holders[fl] += 1
+        me = config.SASL_USER.lower()
+        changes = []
+        for account in accounts:
+            if account == me:
+                continue
+            flags = chan.usermap.flags(account)
+            types = entitled.get(account, ())
+            remove = ''
+            for fl, allowed in ENTITLES.items():
+                if fl not in flags or any(t in types for t in allowed):
+                    continue
+                if holders[fl] > FLOOR[fl]:
+                    remove += fl
+                    holders[fl] -= 1
+            if remove:
+                changes.append((account, remove))
+        chan.civis_count = holders['V']
+        chan.staff_count = holders['O']
+        return changes
+
+    async def reconcile(self, chan, accounts=None):
+        """ Checks `accounts` (every flagged account if None) and sends the
+        changes. Returns them. """
+        start = time.perf_counter()
+        candidates = accounts if accounts is not None else list(chan.usermap)
+        candidates = sorted(a for a in candidates
+                            if any(fl in chan.usermap.flags(a) for fl in ENTITLES))
+        changes = []
+        if candidates:
+            entitled = await aiodb.run(self._entitlements, chan.key,
+                                       None if accounts is None else candidates)
+            changes = self.diff(chan, entitled, candidates)
+        for account, flags in changes:
+            await self.irc.message('ChanServ', 'FLAGS {0} {1} -{2}'
+                                   .format(chan.name, account, flags))
+        self.runs += 1
+        self.last_duration = time.perf_counter() - start
+        RECONCILE_SECONDS.observe(self.last_duration,
+                                  'audit' if accounts is None else 'check')
+        if accounts is None:  # Checks are too frequent to log
+            print("ACL audit of {0}: {1} accounts checked, {2} changes in "
+                  "{3:.1f}ms".format(chan.name, len(candidates), len(changes),
+                                     self.last_duration * 1000))
+        return changes
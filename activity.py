@@ -0,0 +1,81 @@
+from datetime import datetime
+from peewee import chunked
+from models import db, User
+import aiodb
+
+
+class ActivityCounter(object):
+    """ Keeps line counts (also per day, see usermap.DailyLines) in memory
+    and writes them back in batches.
+
+    Accounts touched by `count` are marked dirty and written in a single
+    transaction by `flush`, which the bot runs on a timer and at shutdown.
+    At most one flush interval worth of activity is lost on a crash. """
+
+    def __init__(self, channel, usermap):
+        self.channel = channel
+        self.usermap = usermap
+        self.dirty = usermap.dirty  # Shared, so dirty records aren't evicted
+
+    def count(self, account):
+        now = datetime.utcnow()
+        user = self.usermap.add(account)
+        if not user.complete:
+            # Counted from zero until we know the stored values
+            self.usermap.fault(account)
+        user.count(self.usermap.window, now)
+        self.dirty.add(account)
+
+    def _take(self):
+        # Incomplete records wait until their stored values have been read
+        rows = []
+        for account in list(self.dirty):
+            user = self.usermap[account]
+            if not user.complete:
+                continue
+            self.dirty.discard(account)
+            rows.append({"channel": self.channel,
+                         "name": account,
+                         "lines": user.lines,
+                         "first_seen": user.first_seen,
+                         "last_seen": user.last_seen,
+                         "recent": user.recent and user.recent.dump()})
+        return rows
+
+    @staticmethod
+    def _write(rows):
+        with db.atomic():
+            for batch in chunked(rows, 100):
+                User.insert_many(batch) \
+                    .on_conflict(conflict_target=[User.channel, User.name],
+                                 preserve=[User.lines, User.last_seen,
+                                           User.recent]) \
+                    .execute()
+
+    async def flush(self):
+        """ Writes every dirty account back to the database. Returns the
+        number of accounts written. """
+        rows = self._take()
+        if not rows:
+            return 0
+        names = [row['name'] for row in rows]
+        # Not dirty anymore (lines counted meanwhile make them dirty again),
+        # but they can't be evicted before they're written
+        self.usermap.writing.update(names)
+        try:
+            await aiodb.run(self._write, rows)
+        except Exception:
+            # Keep them around for the next attempt
+            self.dirty.update(names)
+            raise
+        finally:
+            self.usermap.writing.difference_update(names)
+        return len(rows)
+
+    def save(self):
+        """ Blocking version of `flush`, for when the event loop is gone """
+        self.usermap.complete()
+        rows = self._take()
+        if rows:
+            self._write(rows)
+        return len(rows)
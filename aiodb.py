@@ -0,0 +1,52 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from models import db
+import metrics
+
+# SQLite only has one writer anyway; a single thread keeps every query in
+# the order it was issued and gives it a connection of its own.
+executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='db')
+
+DB_SECONDS = metrics.histogram('kontroler_db_seconds',
+                               'Time spent running database work',
+                               ['handler'])
+DB_QUERIES = metrics.counter('kontroler_db_queries_total',
+                             'SQL statements run', ['handler'])
+DB_TRANSACTION_SECONDS = metrics.histogram(
+    'kontroler_db_transaction_seconds', 'Duration of transactions',
+    ['handler'])
+
+
+def _call(handler, func, args, kwargs):
+    db.handler = handler
+    queries = db.queries
+    start = time.perf_counter()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        DB_SECONDS.observe(time.perf_counter() - start, handler)
+        DB_QUERIES.inc(handler, amount=db.queries - queries)
+
+
+async def run(func, *args, **kwargs):
+    """ Runs `func` on the database thread, without blocking the event loop
+    while it works """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        executor, _call, metrics.handler.get(), func, args, kwargs)
+
+
+def _atomic(func, *args, **kwargs):
+    with metrics.timed(DB_TRANSACTION_SECONDS, db.handler):
+        with db.atomic():
+            return func(*args, **kwargs)
+
+
+async def atomic(func, *args, **kwargs):
+    """ Like `run`, but inside a transaction """
+    return await run(_atomic, func, *args, **kwargs)
+
+
+def shutdown():
+    executor.shutdown(wait=True)
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+""" Closed elections are moved out of the database some time after they
+closed, with their ballots, so the tables the bot queries all the time
+stay small. They go into one gzipped file of JSON lines per month they
+closed in (archive/2024-05.jsonl.gz); the Archived table says which file
+an election is in, and `find` reads it back for `!vote <id>`.
+
+Elections that passed stay until their action expires. The journal keeps
+their events either way.
+
+    python3 archive.py <days>   # archives what closed more than <days> ago """
+
+import os
+import sys
+import gzip
+import json
+from datetime import datetime, timedelta
+import config
+from models import db, User, Election, Suffrage, Effective, Archived
+from tally import Tally
+
+DIR = getattr(config, 'ARCHIVE_DIR', 'archive')
+
+
+def _path(partition):
+    return os.path.join(DIR, '{0}.jsonl.gz'.format(partition))
+
+
+def _prefix(election):
+    # Records start with their id, so lines can be skipped without parsing
+    return '{{"id": {0:d},'.format(election)
+
+
+def archive(days, limit=5000):
+    """ Archives up to `limit` elections that closed more than `days` ago.
+    Runs on the database thread, in a transaction: the records are written
+    out before the rows are deleted, so a failure leaves them in the
+    database (and maybe in the file too, which `find` doesn't mind).
+    Returns how many were archived. """
+    cutoff = datetime.utcnow() - timedelta(days=days)
+    elections = list(Election.select(Election, User.name)
+                             .join(User, on=(Election.opened_by == User.id))
+                             .where((Election.status != 0) &
+                                    (Election.close < cutoff) &
+                                    Election.id.not_in(
+                                        Effective.select(Effective.election)))
+                             .order_by(Election.id)
+                             .limit(limit)
+                             .objects())
+    if not elections:
+        return 0
+    ids = [elec.id for elec in elections]
+    ballots = dict((elec, {}) for elec in ids)
+    query = Suffrage.select(Suffrage.election, User.name, Suffrage.yea) \
+                    .join(User, on=(Suffrage.emitted_by == User.id)) \
+                    .where(Suffrage.election.in_(ids)) \
+                    .tuples()
+    for elec, name, yea in query:
+        ballots[elec][name] = bool(yea)
+
+    partitions = {}
+    for elec in elections:
+        record = {'id': elec.id, 'channel': elec.channel,
+                  'vote_type': elec.vote_type, 'vote_target': elec.vote_target,
+                  'opened': str(elec.opened), 'close': str(elec.close),
+                  'status': elec.status, 'opened_by': elec.name,
+                  'ballots': ballots[elec.id]}
+        partitions.setdefault(elec.close.strftime('%Y-%m'), []) \
+                  .append(json.dumps(record))
+    os.makedirs(DIR, exist_ok=True)
+    for partition, lines in partitions.items():
+        # Appending adds a gzip member; readers see a single stream
+        with gzip.open(_path(partition), 'at', encoding='utf-8') as f:
+            f.write('\n'.join(lines) + '\n')
+
+    with db.atomic():
+        Archived.insert_many(
+            [{'election': elec.id, 'partition': elec.close.strftime('%Y-%m')}
+             for elec in elections]).on_conflict_replace().execute()
+        for i in range(0, len(ids), 500):
+            Suffrage.delete().where(Suffrage.election.in_(ids[i:i + 500])) \
+                    .execute()
+            Election.delete().where(Election.id.in_(ids[i:i + 500])).execute()
+    return len(elections)
+
+
+def records():
+    """ Every archived election record, oldest partition first, read as
+    they're needed. Records written by an archive run that failed (the
+    rows are still in the database) are skipped. """
+    if not os.path.isdir(DIR):
+        return
+    archived = set(elec for (elec,) in
+                   Archived.select(Archived.election).tuples().iterator())
+    for name in sorted(os.listdir(DIR)):
+        if name.endswith('.jsonl.gz'):
+            with gzip.open(os.path.join(DIR, name), 'rt',
+                           encoding='utf-8') as f:
+                for line in f:
+                    record = json.loads(line)
+                    if record['id'] in archived:
+                        archived.discard(record['id'])  # Only once
+                        yield record
+
+
+def find(election):
+    """ Returns an archived election (an unsaved Election), its Tally and
+    the names of its yea and nay voters, or None if it wasn't archived.
+    Reads a file; run it on the database thread like a query. """
+    entry = Archived.get_or_none(Archived.election == election)
+    if entry is None:
+        return None
+    prefix = _prefix(election)
+    try:
+        with gzip.open(_path(entry.partition), 'rt', encoding='utf-8') as f:
+            for line in f:
+                if line.startswith(prefix):
+                    record = json.loads(line)
+                    break
+            else:
+                return None
+    except FileNotFoundError:
+        return None
+    elec = Election(id=record['id'], channel=record['channel'],
+                    vote_type=record['vote_type'],
+                    vote_target=record['vote_target'],
+                    opened=datetime.fromisoformat(record['opened']),
+                    close=datetime.fromisoformat(record['close']),
+                    status=record['status'])
+    yeas = [name for name, yea in record['ballots'].items() if yea]
+    nays = [name for name, yea in record['ballots'].items() if not yea]
+    return elec, Tally(len(yeas), len(nays), None), yeas, nays
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 2 or not sys.argv[1].isdigit():
+        sys.exit(__doc__.strip().splitlines()[-1].strip())
+    total = 0
+    while True:
+        count = archive(int(sys.argv[1]))
+        if not count:
+            break
+        total += count
+    print("Archived {0} elections".format(total))
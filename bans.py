@@ -0,0 +1,86 @@
+import heapq
+import time
+
+
+class BanTracker(object):
+    """ A channel's ban list, kept up to date from MODE changes, and when
+    each ban is due to be lifted (`lifetime` seconds after it was set).
+
+    Expiries are kept in a heap; entries of bans that were removed or set
+    again are skipped when they come up. The full list (RPL_BANLIST) is
+    only needed to resync: between `begin` and `end` listed bans are
+    collected, and replace the known ones at the end. """
+
+    def __init__(self, lifetime=86400):
+        self.lifetime = lifetime
+        self.bans = {}  # {mask: expiry}
+        self._heap = []  # [(expiry, mask)]
+        self._listing = None
+
+    def __len__(self):
+        return len(self.bans)
+
+    def __contains__(self, mask):
+        return mask in self.bans
+
+    def add(self, mask, set_at=None):
+        expiry = (time.time() if set_at is None else set_at) + self.lifetime
+        self.bans[mask] = expiry
+        heapq.heappush(self._heap, (expiry, mask))
+
+    def remove(self, mask):
+        self.bans.pop(mask, None)
+
+    def begin(self):
+        """ A ban list was requested """
+        self._listing = {}
+
+    def listed(self, mask, set_at):
+        if self._listing is None:
+            return self.add(mask, set_at)
+        self._listing[mask] = set_at + self.lifetime
+
+    def end(self):
+        """ The ban list is over; it's what the channel has """
+        if self._listing is None:
+            return
+        self.bans, self._listing = self._listing, None
+        self._heap = [(expiry, mask) for mask, expiry in self.bans.items()]
+        heapq.heapify(self._heap)
+
+    def _prune(self):
+        while self._heap and self.bans.get(self._heap[0][1]) != self._heap[0][0]:
+            heapq.heappop(self._heap)
+
+    @property
+    def next_expiry(self):
+        """ When the next ban is due to be lifted (unix time), or None """
+        self._prune()
+        return self._heap[0][0] if self._heap else None
+
+    def due(self, now=None):
+        """ Returns the masks of the bans that are due to be lifted, once:
+        only ask when the MODE lifting them can be sent. They stay known
+        until the MODE removing them is seen. """
+        now = time.time() if now is None else now
+        masks = []
+        self._prune()
+        while self._heap and self._heap[0][0] <= now:
+            masks.append(heapq.heappop(self._heap)[1])
+            self._prune()
+        return list(dict.fromkeys(masks))  # set twice, it's in the heap twice
+
+
+def mode_lines(masks, per_line, length):
+    """ Splits `masks` into groups that fit a single MODE line: at most
+    `per_line` (ISUPPORT MODES) of them, and `length` bytes of arguments """
+    group, size = [], 0
+    for mask in masks:
+        cost = len(mask.encode('utf-8')) + 2  # the mode letter and a space
+        if group and (len(group) == per_line or size + cost > length):
+            yield group
+            group, size = [], 0
+        group.append(mask)
+        size += cost
+    if group:
+        yield group
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+""" Lines per second through the command dispatcher.
+
+Compares the old way of routing a line (strip and lowercase everything,
+argparse for `!vote list`) against the command table, and measures the
+whole of on_message for channel chatter. Runs against a throwaway database;
+needs a config.py like the bot does.
+
+    python3 benchmarks/dispatch.py [lines] """
+
+import sys
+import time
+import asyncio
+import argparse
+
+from fake import bot, FakeKontroler
+
+CHATTER = ["hello there", "  anyone around?", "lol", "!!!", "that vote was silly",
+           "I think we should ban him", "brb", "what's the topic?"]
+COMMANDS = ["!vote y 12", "!vote 12", "!vote list", "!vote list --type civis",
+            "!vote n #12", "!vote civis someone", "!vote 12 no", "!help"]
+
+votelistParser = argparse.ArgumentParser()
+votelistParser.add_argument('--type')
+
+
+def legacy_route(message):
+    """ What on_message did before the command table """
+    message = message.strip().lower()
+    if not message.startswith('!'):
+        return None
+    command = message[1:].split()[0]
+    args = message.split()[1:]
+    if command != 'vote' or not args:
+        return None
+    args[0] = args[0].strip('#')
+    if args[0] in list(bot.VOTE_NAMES):
+        return 'start', args
+    elif args[0] == "list":
+        return 'list', votelistParser.parse_known_args(args[1:])[0]
+    elif args[0].isdigit() or args[0] in ['y', 'yes', 'n', 'no']:
+        return 'ballot', args
+    return None
+
+
+def table_route(message):
+    if not message.lstrip().startswith('!'):
+        return None
+    return bot.COMMANDS.parse(message)
+
+
+def rate(func, lines):
+    start = time.perf_counter()
+    for line in lines:
+        func(line)
+    return len(lines) / (time.perf_counter() - start)
+
+
+async def on_message_rate(lines):
+    client = FakeKontroler()
+    client.add_user('someone')
+    start = time.perf_counter()
+    for line in lines:
+        await client.on_message(client.chan.name, 'someone', line)
+    return len(lines) / (time.perf_counter() - start)
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    chatter = (CHATTER * (count // len(CHATTER) + 1))[:count]
+    commands = (COMMANDS * (count // len(COMMANDS) + 1))[:count]
+
+    print("{0:<28}{1:>14}{2:>14}".format('', 'before', 'after'))
+    for name, lines in (('chatter', chatter), ('commands', commands)):
+        print("{0:<28}{1:>14,.0f}{2:>14,.0f}".format(
+            name + ' (lines/s)', rate(legacy_route, lines),
+            rate(table_route, lines)))
+    print("{0:<28}{1:>28,.0f}".format(
+        'on_message chatter (lines/s)', asyncio.run(on_message_rate(chatter))))
+    bot.aiodb.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+""" A Kontroler that talks to nothing, over a scratch database, for the
+benchmarks. Import this before anything from the bot: it moves to a
+temporary directory so users.db is created there. Needs a config.py like
+the bot does. """
+
+import os
+import sys
+import tempfile
+from datetime import datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+WORKDIR = tempfile.mkdtemp(prefix='kontroler-bench-')
+os.chdir(WORKDIR)
+
+import bot  # noqa: E402
+from models import db, User, Election, Suffrage, Effective  # noqa: E402
+from state import CHANNELS  # noqa: E402
+
+CHANNEL_KEY = CHANNELS[0].lower()  # what the benchmarks run in
+
+
+def path(name):
+    """ `name` relative to the checkout, as we're not in it anymore """
+    return os.path.join(ROOT, name)
+
+
+class QueryCounter(object):
+    """ The number of statements run on `database` so far """
+
+    def __init__(self, database):
+        self.database = database
+
+    @property
+    def count(self):
+        return self.database.queries
+
+
+queries = QueryCounter(db)
+
+
+class FakeKontroler(bot.Kontroler):
+    """ Keeps what it sends in `sent` instead of sending it. Sends aren't
+    rate limited. """
+
+    def __init__(self):
+        super().__init__('Kontroler')
+        self.nickname = 'Kontroler'
+        # pydle echoes what we send back to on_message/on_notice
+        self.users[self.nickname] = {'nickname': self.nickname,
+                                     'account': bot.config.SASL_USER,
+                                     'username': 'kontroler', 'hostname': 'bench'}
+        self.sent = []
+        self.outbound.rate = self.outbound.burst = float('inf')
+        self.outbound.backlog = float('inf')
+
+    async def rawmsg(self, command, *args, **kwargs):
+        self.sent.append((command,) + args)
+
+    @property
+    def chan(self):
+        """ The first governed channel """
+        return next(iter(self.governed.values()))
+
+    def add_user(self, nick, enfranchised=False):
+        self.users[nick] = {'nickname': nick, 'account': nick,
+                            'username': nick, 'hostname': 'bench'}
+        channel = self.channels.setdefault(
+            self.chan.name, {'users': set(), 'modes': {'v': [], 'o': []}})
+        channel['users'].add(nick)
+        self.roster.joined(self.chan.name, nick)
+        self.roster.set_account(nick, nick)
+        if enfranchised:
+            channel['modes']['v'].append(nick)
+            self.roster.set_mode(self.chan.name, nick, 'v', True)
+
+
+def reset():
+    """ Empties the database """
+    for model in (Suffrage, Effective, Election, User):
+        model.delete().execute()
+
+
+def seed_users(channel, count, lines=5000, days=60):
+    """ Accounts u0..u<count>, eligible for any vote """
+    now = datetime.utcnow()
+    rows = [{'channel': channel, 'name': 'u{0}'.format(i), 'lines': lines,
+             'first_seen': now - timedelta(days=days), 'last_seen': now}
+            for i in range(count)]
+    with db.atomic():
+        for i in range(0, len(rows), 500):
+            User.insert_many(rows[i:i + 500]).execute()
+    return dict((u.name, u) for u in User.select().where(User.channel == channel))
+
+
+def seed_election(channel, opener, voters, vote_type='opine', status=0):
+    """ An election with a yea from every user in `voters` (two thirds) or
+    a nay (the rest) """
+    now = datetime.utcnow()
+    elec = Election.create(channel=channel, vote_type=vote_type, opened=now,
+                           close=now + timedelta(hours=1), status=status,
+                           opened_by=opener,
+                           vote_target='issue {0}'.format(now.timestamp()))
+    rows = [{'election': elec, 'emitted_by': user, 'yea': i % 3 != 0}
+            for i, user in enumerate(voters)]
+    with db.atomic():
+        for i in range(0, len(rows), 500):
+            Suffrage.insert_many(rows[i:i + 500]).execute()
+    return elec
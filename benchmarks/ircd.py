@@ -0,0 +1,620 @@
+""" A stand-in IRC server, for running the bot end to end without a network.
+
+It speaks enough RFC 1459 and IRCv3 (CAP, SASL PLAIN, extended-join,
+account-notify, WHOX) for Kontroler to connect to it with tls=False,
+keeps channel modes and ban lists, and plays ChanServ: FLAGS listings
+and changes (announced to the channel, with the +v/+o or kickban they
+entail), TOPIC, and voicing, opping or kickbanning flagged accounts as they
+join.
+
+Simulated users don't connect: `add_user` creates them and `join`, `say`
+and friends make them act, so thousands of them are cheap. Lines that
+connected clients send can be waited for with `expect`. """
+
+import re
+import time
+import base64
+import fnmatch
+import asyncio
+import collections
+
+NAME = 'irc.test'
+CAPABILITIES = ('account-notify', 'extended-join', 'sasl')
+ISUPPORT = ('PREFIX=(ov)@+', 'CHANMODES=b,k,l,imnpst', 'CHANTYPES=#',
+            'MODES=3', 'WHOX', 'CASEMAPPING=ascii', 'NETWORK=Test')
+STATUS = {'o': '@', 'v': '+'}  # status modes and their NAMES prefixes
+CHANSERV = 'ChanServ!ChanServ@services.' + NAME
+# ChanServ flags and the status mode they give on join
+AUTOMODES = (('O', 'o'), ('V', 'v'))
+# Fields of a WHOX reply, in the order they're sent
+WHOX_FIELDS = 'tcuihsnfdlaor'
+
+
+class User(object):
+    def __init__(self, nick, username, host, account=None, writer=None):
+        self.nick = nick
+        self.username = username
+        self.host = host
+        self.account = account
+        self.realname = nick
+        self.writer = writer  # None for simulated users
+        self.caps = set()
+        self.channels = set()  # keys
+
+    @property
+    def mask(self):
+        return '{0}!{1}@{2}'.format(self.nick, self.username, self.host)
+
+
+class Channel(object):
+    def __init__(self, name):
+        self.name = name
+        self.members = {}  # {nick key: {status modes}}
+        self.modes = set('nt')
+        self.bans = collections.OrderedDict()  # {mask: (set by, when)}
+        self.topic = None
+        self.access = {}  # {account: ChanServ flags}
+
+
+def _split(line):
+    """ (source, command, params) of a line """
+    source = None
+    if line.startswith(':'):
+        source, _, line = line[1:].partition(' ')
+    line, _, trailing = line.partition(' :')
+    params = line.split()
+    command = params.pop(0).upper() if params else ''
+    if _:
+        params.append(trailing)
+    return source, command, params
+
+
+class FakeIRCd(object):
+    """ Call `start`, then connect to `port` on 127.0.0.1. `logins` logs
+    nicks in to accounts when they register, for clients that can't do
+    SASL; `passwords` ({account: password}) is checked by SASL if set. """
+
+    def __init__(self, logins=None, passwords=None):
+        self.logins = dict((k.lower(), v) for k, v in (logins or {}).items())
+        self.passwords = passwords
+        self.users = {}  # {nick key: User}
+        self.channels = {}  # {channel key: Channel}
+        self.port = None
+        self.received = 0  # lines from connected clients
+        self._server = None
+        self._connections = set()  # tasks serving connected clients
+        self._expected = []  # [(compiled pattern, future)]
+
+    async def start(self, port=0):
+        self._server = await asyncio.start_server(self._serve, '127.0.0.1', port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self
+
+    async def stop(self):
+        self._server.close()
+        for user in list(self.users.values()):
+            if user.writer is not None:
+                user.writer.close()
+        await asyncio.gather(*self._connections, return_exceptions=True)
+        await self._server.wait_closed()
+
+    def expect(self, pattern):
+        """ A future for the next line a connected client sends that
+        matches `pattern` (a regular expression searched for in the raw
+        line). Its result is (time.monotonic() when it arrived, line). """
+        future = asyncio.get_event_loop().create_future()
+        self._expected.append((re.compile(pattern), future))
+        return future
+
+    # Simulated users
+
+    def add_user(self, nick, account=None, host=None):
+        user = User(nick, nick.lower()[:10],
+                    host or '{0}.users.{1}'.format(nick.lower(), NAME), account)
+        self.users[nick.lower()] = user
+        return user
+
+    async def login(self, nick, account):
+        """ `nick` logs in to `account` (or out, if None) """
+        user = self.users[nick.lower()]
+        user.account = account
+        line = ':{0} ACCOUNT {1}'.format(user.mask, account or '*')
+        for peer in self._peers(user):
+            if 'account-notify' in peer.caps:
+                self._send(peer, line)
+        await self.drain()
+
+    def channel(self, name):
+        """ The Channel `name`, created if needed (ChanServ access lists
+        can be set up on it before anyone joins) """
+        key = name.lower()
+        if key not in self.channels:
+            self.channels[key] = Channel(name)
+        return self.channels[key]
+
+    async def join(self, nick, channel):
+        self._join(self.users[nick.lower()], channel)
+        await self.drain()
+
+    async def part(self, nick, channel, reason='Leaving'):
+        user = self.users[nick.lower()]
+        chan = self.channels[channel.lower()]
+        self._broadcast(chan, ':{0} PART {1} :{2}'.format(user.mask, chan.name,
+                                                         reason))
+        self._leave(user, chan)
+        await self.drain()
+
+    async def quit(self, nick, reason='Quit'):
+        self._quit(self.users[nick.lower()], reason)
+        await self.drain()
+
+    async def say(self, nick, target, text, command='PRIVMSG'):
+        user = self.users[nick.lower()]
+        self._message(user, command, target, text)
+        await self.drain()
+
+    async def drain(self):
+        """ Waits for what connected clients were sent to be written out """
+        for user in list(self.users.values()):
+            if user.writer is not None and not user.writer.is_closing():
+                await user.writer.drain()
+
+    # Connections
+
+    async def _serve(self, reader, writer):
+        state = {'nick': None, 'username': None, 'account': None,
+                 'caps': set(), 'negotiating': False, 'user': None}
+        task = asyncio.current_task()
+        self._connections.add(task)
+        try:
+            while not reader.at_eof():
+                line = await reader.readline()
+                if not line:
+                    break
+                line = line.decode('utf-8', 'replace').rstrip('\r\n')
+                if not line:
+                    continue
+                self.received += 1
+                self._check_expected(line)
+                user = state['user']
+                if user is None:
+                    self._register(state, writer, line)
+                else:
+                    self._handle(user, line)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            if state['user'] is not None and state['user'].nick.lower() in self.users:
+                self._quit(state['user'], 'Connection closed')
+            writer.close()
+            self._connections.discard(task)
+
+    def _check_expected(self, line):
+        for entry in list(self._expected):
+            pattern, future = entry
+            if future.done():
+                self._expected.remove(entry)
+            elif pattern.search(line):
+                future.set_result((time.monotonic(), line))
+                self._expected.remove(entry)
+
+    def _write(self, writer, line):
+        if writer is not None and not writer.is_closing():
+            writer.write(line.encode('utf-8') + b'\r\n')
+
+    def _send(self, user, line):
+        self._write(user.writer, line)
+
+    def _numeric(self, user, numeric, *params):
+        params = list(params)
+        if params and (' ' in params[-1] or params[-1].startswith(':')
+                       or not params[-1]):
+            params[-1] = ':' + params[-1]
+        self._send(user, ':{0} {1} {2} {3}'.format(NAME, numeric, user.nick,
+                                                    ' '.join(params)))
+
+    def _register(self, state, writer, line):
+        source, command, params = _split(line)
+        nick = state['nick'] or '*'
+
+        def reply(text):
+            self._write(writer, ':{0} {1}'.format(NAME, text.format(nick)))
+
+        if command == 'CAP' and params:
+            sub = params[0].upper()
+            if sub == 'LS':
+                state['negotiating'] = True
+                reply('CAP {0} LS :' + ' '.join(CAPABILITIES))
+            elif sub == 'REQ':
+                wanted = params[-1].split()
+                if all(cap.lstrip('-') in CAPABILITIES for cap in wanted):
+                    state['caps'].update(c for c in wanted if c[0] != '-')
+                    reply('CAP {0} ACK :' + params[-1])
+                else:
+                    reply('CAP {0} NAK :' + params[-1])
+            elif sub == 'END':
+                state['negotiating'] = False
+        elif command == 'AUTHENTICATE' and params:
+            if params[0].upper() == 'PLAIN':
+                self._write(writer, 'AUTHENTICATE +')
+            elif params[0] == '*':
+                reply('906 {0} :SASL authentication aborted')
+            else:
+                try:
+                    _, account, password = base64.b64decode(params[0]) \
+                        .decode('utf-8').split('\0')
+                except ValueError:
+                    return reply('904 {0} :SASL authentication failed')
+                if self.passwords is not None and \
+                   self.passwords.get(account) != password:
+                    return reply('904 {0} :SASL authentication failed')
+                state['account'] = account
+                reply('900 {0} {0}!' + (state['username'] or '*') + '@localhost '
+                      + account + ' :You are now logged in as ' + account)
+                reply('903 {0} :SASL authentication successful')
+        elif command == 'NICK' and params:
+            if params[0].lower() in self.users:
+                return reply('433 {0} ' + params[0] + ' :Nickname is already in use')
+            state['nick'] = params[0]
+        elif command == 'USER' and params:
+            state['username'] = params[0]
+        elif command == 'PING':
+            reply('PONG {0} :' + (params[0] if params else NAME))
+
+        if state['nick'] and state['username'] and not state['negotiating']:
+            account = state['account'] or self.logins.get(state['nick'].lower())
+            user = User(state['nick'], state['username'], 'localhost', account,
+                        writer)
+            user.caps = state['caps']
+            state['user'] = self.users[user.nick.lower()] = user
+            self._welcome(user)
+
+    def _welcome(self, user):
+        self._numeric(user, '001', 'Welcome to the test network ' + user.mask)
+        self._numeric(user, '002', 'Your host is ' + NAME)
+        self._numeric(user, '003', 'This server was created just now')
+        self._numeric(user, '004', NAME, 'fake-1.0', 'iosw', 'biklmnopstv')
+        self._numeric(user, '005', *(ISUPPORT + ('are supported by this server',)))
+        self._numeric(user, '422', 'MOTD File is missing')
+        if user.account and 'sasl' not in user.caps:
+            self._numeric(user, '900', user.mask, user.account,
+                          'You are now logged in as ' + user.account)
+
+    def _handle(self, user, line):
+        source, command, params = _split(line)
+        handler = getattr(self, '_cmd_' + command.lower(), None)
+        if handler is None:
+            return self._numeric(user, '421', command, 'Unknown command')
+        if len(params) < getattr(handler, 'arity', 1):
+            return self._numeric(user, '461', command, 'Not enough parameters')
+        handler(user, *params)
+
+    # Commands from connected clients
+
+    def _cmd_ping(self, user, token=NAME, *rest):
+        self._send(user, ':{0} PONG {0} :{1}'.format(NAME, token))
+
+    def _cmd_pong(self, user, *params):
+        pass
+
+    def _cmd_cap(self, user, *params):
+        pass  # Negotiation is over by now
+
+    def _cmd_quit(self, user, reason='Quit', *rest):
+        self._quit(user, reason)
+        user.writer.close()
+
+    def _cmd_nick(self, user, new, *rest):
+        if new.lower() in self.users and new.lower() != user.nick.lower():
+            return self._numeric(user, '433', new, 'Nickname is already in use')
+        line = ':{0} NICK {1}'.format(user.mask, new)
+        self._to_peers(user, line)
+        old = user.nick.lower()
+        del self.users[old]
+        user.nick = new
+        self.users[new.lower()] = user
+        for key in user.channels:
+            members = self.channels[key].members
+            members[new.lower()] = members.pop(old)
+
+    def _cmd_join(self, user, channels, *rest):
+        for name in channels.split(','):
+            if name.startswith('#'):
+                self._join(user, name)
+
+    def _cmd_part(self, user, channels, reason='Leaving', *rest):
+        for name in channels.split(','):
+            chan = self.channels.get(name.lower())
+            if chan is None or user.nick.lower() not in chan.members:
+                self._numeric(user, '442', name, "You're not on that channel")
+                continue
+            self._broadcast(chan, ':{0} PART {1} :{2}'.format(user.mask,
+                                                             chan.name, reason))
+            self._leave(user, chan)
+
+    def _cmd_privmsg(self, user, target, text=None, *rest):
+        if text is None:
+            return self._numeric(user, '412', 'No text to send')
+        self._message(user, 'PRIVMSG', target, text)
+
+    def _cmd_notice(self, user, target, text='', *rest):
+        self._message(user, 'NOTICE', target, text)
+
+    def _cmd_mode(self, user, target, *modes):
+        chan = self.channels.get(target.lower())
+        if chan is None:
+            if not target.startswith('#'):
+                return self._numeric(user, '221', '+i')
+            return self._numeric(user, '403', target, 'No such channel')
+        if not modes:
+            return self._numeric(user, '324', chan.name, '+' + ''.join(sorted(chan.modes)))
+        if modes[0] in ('b', '+b') and len(modes) == 1:
+            for mask, (by, when) in chan.bans.items():
+                self._numeric(user, '367', chan.name, mask, by, str(when))
+            return self._numeric(user, '368', chan.name, 'End of channel ban list')
+        if 'o' not in chan.members.get(user.nick.lower(), ()):
+            return self._numeric(user, '482', chan.name, "You're not channel operator")
+        self._set_modes(chan, user.mask, modes[0], list(modes[1:]))
+
+    def _cmd_kick(self, user, channel, nick, reason=None, *rest):
+        chan = self.channels.get(channel.lower())
+        target = self.users.get(nick.lower())
+        if chan is None or target is None or target.nick.lower() not in chan.members:
+            return self._numeric(user, '441', nick, channel,
+                                 "They aren't on that channel")
+        if 'o' not in chan.members.get(user.nick.lower(), ()):
+            return self._numeric(user, '482', chan.name, "You're not channel operator")
+        self._broadcast(chan, ':{0} KICK {1} {2} :{3}'.format(
+            user.mask, chan.name, target.nick, reason or user.nick))
+        self._leave(target, chan)
+
+    def _cmd_topic(self, user, channel, text=None, *rest):
+        chan = self.channels.get(channel.lower())
+        if chan is None:
+            return self._numeric(user, '403', channel, 'No such channel')
+        if text is None:
+            return self._topic(user, chan)
+        chan.topic = text
+        self._broadcast(chan, ':{0} TOPIC {1} :{2}'.format(user.mask, chan.name, text))
+
+    def _cmd_who(self, user, mask, query='', *rest):
+        fields, _, token = query.lstrip('%').partition(',')
+        if mask.lower() in self.channels:
+            chan = self.channels[mask.lower()]
+            found = [(chan, self.users[nick]) for nick in chan.members]
+        elif mask.lower() in self.users:
+            found = [(None, self.users[mask.lower()])]
+        else:
+            found = []
+        for chan, who in found:
+            if query.startswith('%'):
+                self._whox(user, chan, who, fields, token)
+            else:
+                modes = chan.members[who.nick.lower()] if chan else ()
+                self._numeric(user, '352', chan.name if chan else '*',
+                              who.username, who.host, NAME, who.nick,
+                              'H' + ''.join(STATUS[m] for m in 'ov' if m in modes),
+                              '0 ' + who.realname)
+        self._numeric(user, '315', mask, 'End of /WHO list.')
+
+    def _whox(self, user, chan, who, fields, token):
+        values = {'t': token, 'c': chan.name if chan else '*',
+                  'u': who.username, 'i': '255.255.255.255', 'h': who.host,
+                  's': NAME, 'n': who.nick, 'f': 'H', 'd': '0', 'l': '0',
+                  'a': who.account or '0', 'o': 'n/a', 'r': who.realname}
+        self._numeric(user, '354', *[values[f] for f in WHOX_FIELDS if f in fields])
+
+    def _cmd_whois(self, user, *nicks):
+        nick = nicks[-1]
+        who = self.users.get(nick.lower())
+        if who is None:
+            self._numeric(user, '401', nick, 'No such nick/channel')
+        else:
+            self._numeric(user, '311', who.nick, who.username, who.host, '*',
+                          who.realname)
+            if who.account:
+                self._numeric(user, '330', who.nick, who.account, 'is logged in as')
+        self._numeric(user, '318', nick, 'End of /WHOIS list.')
+
+    # What happens
+
+    def _peers(self, user):
+        """ Everyone sharing a channel with `user`, and `user` """
+        peers = {user.nick.lower(): user}
+        for key in user.channels:
+            for nick in self.channels[key].members:
+                peers[nick] = self.users[nick]
+        return peers.values()
+
+    def _to_peers(self, user, line):
+        for peer in self._peers(user):
+            self._send(peer, line)
+
+    def _broadcast(self, chan, line, skip=None):
+        for nick in chan.members:
+            if nick != skip:
+                self._send(self.users[nick], line)
+
+    def _join(self, user, name):
+        chan = self.channel(name)
+        key = user.nick.lower()
+        if key in chan.members:
+            return
+        if any(fnmatch.fnmatchcase(user.mask.lower(), ban.lower())
+               for ban in chan.bans):
+            return self._numeric(user, '474', chan.name,
+                                 'Cannot join channel (+b)')
+        chan.members[key] = set()
+        user.channels.add(name.lower())
+        plain = ':{0} JOIN {1}'.format(user.mask, chan.name)
+        extended = ':{0} JOIN {1} {2} :{3}'.format(user.mask, chan.name,
+                                                   user.account or '*',
+                                                   user.realname)
+        for nick in chan.members:
+            member = self.users[nick]
+            self._send(member, extended if 'extended-join' in member.caps else plain)
+        if user.writer is not None:
+            if chan.topic is not None:
+                self._topic(user, chan)
+            self._names(user, chan)
+        if len(chan.members) == 1 and not chan.access:
+            chan.members[key].add('o')  # Founded it
+        flags = chan.access.get(user.account, '') if user.account else ''
+        if 'b' in flags:
+            return self._akick(chan, user)
+        modes = ''.join(mode for flag, mode in AUTOMODES if flag in flags)
+        if modes:
+            self._set_modes(chan, CHANSERV, '+' + modes, [user.nick] * len(modes))
+
+    def _topic(self, user, chan):
+        if chan.topic is None:
+            self._numeric(user, '331', chan.name, 'No topic is set')
+        else:
+            self._numeric(user, '332', chan.name, chan.topic)
+
+    def _names(self, user, chan):
+        names = [''.join(STATUS[m] for m in 'ov' if m in modes)[:1] +
+                 self.users[nick].nick for nick, modes in chan.members.items()]
+        for i in range(0, len(names), 40):
+            self._numeric(user, '353', '=', chan.name, ' '.join(names[i:i + 40]))
+        self._numeric(user, '366', chan.name, 'End of /NAMES list.')
+
+    def _leave(self, user, chan):
+        chan.members.pop(user.nick.lower(), None)
+        user.channels.discard(chan.name.lower())
+
+    def _quit(self, user, reason):
+        self._to_peers(user, ':{0} QUIT :{1}'.format(user.mask, reason))
+        for key in list(user.channels):
+            self._leave(user, self.channels[key])
+        self.users.pop(user.nick.lower(), None)
+
+    def _message(self, user, command, target, text):
+        if target.lower() == 'chanserv':
+            if command == 'PRIVMSG':
+                self._chanserv(user, text)
+            return
+        line = ':{0} {1} {2} :{3}'.format(user.mask, command, target, text)
+        if target.lower() in self.channels:
+            self._broadcast(self.channels[target.lower()], line,
+                            skip=user.nick.lower())
+        elif target.lower() in self.users:
+            self._send(self.users[target.lower()], line)
+        elif command == 'PRIVMSG':
+            self._numeric(user, '401', target, 'No such nick/channel')
+
+    def _set_modes(self, chan, source, modes, params):
+        adding = True
+        applied = ''
+        sign = None
+        args = []
+        for mode in modes:
+            if mode in '+-':
+                adding = mode == '+'
+                continue
+            if mode in STATUS or mode == 'b':
+                if not params:
+                    continue
+                param = params.pop(0)
+                if mode in STATUS:
+                    member = chan.members.get(param.lower())
+                    if member is None:
+                        continue
+                    (member.add if adding else member.discard)(mode)
+                elif adding:
+                    chan.bans[param] = (source.split('!')[0], int(time.time()))
+                elif chan.bans.pop(param, None) is None:
+                    continue
+                args.append(param)
+            elif adding:
+                chan.modes.add(mode)
+            else:
+                chan.modes.discard(mode)
+            if sign != adding:
+                applied += '+' if adding else '-'
+                sign = adding
+            applied += mode
+        if applied:
+            self._broadcast(chan, ':{0} MODE {1} {2}'.format(
+                source, chan.name, ' '.join([applied] + args)))
+
+    # ChanServ
+
+    def _chanserv(self, user, text):
+        words = text.split()
+        command = words[0].upper() if words else ''
+        if command == 'FLAGS' and len(words) >= 2:
+            return self._flags(user, words[1], words[2:])
+        if command == 'TOPIC' and len(words) >= 3:
+            chan = self.channels.get(words[1].lower())
+            if chan is not None and self._allowed(user, chan, 't'):
+                chan.topic = text.split(None, 2)[2]
+                self._broadcast(chan, ':{0} TOPIC {1} :{2}'.format(
+                    CHANSERV, chan.name, chan.topic))
+            return
+        self._notice(user, 'Invalid command. Use \002/msg ChanServ help\002 '
+                     'for a command listing.')
+
+    def _akick(self, chan, user):
+        """ Bans and kicks `user`, whose account has the b flag """
+        mask = '*!*@' + user.host
+        if mask not in chan.bans:
+            self._set_modes(chan, CHANSERV, '+b', [mask])
+        self._broadcast(chan, ':{0} KICK {1} {2} :Banned'.format(
+            CHANSERV, chan.name, user.nick))
+        self._leave(user, chan)
+
+    def _notice(self, user, text):
+        self._send(user, ':{0} NOTICE {1} :{2}'.format(CHANSERV, user.nick, text))
+
+    def _allowed(self, user, chan, flag):
+        flags = chan.access.get(user.account, '') if user.account else ''
+        return flag in flags or 'F' in flags
+
+    def _flags(self, user, channel, args):
+        chan = self.channels.get(channel.lower())
+        if chan is None:
+            return self._notice(user, '\002{0}\002 is not registered.'.format(channel))
+        if not args:
+            if not self._allowed(user, chan, 'A'):
+                return self._notice(user, 'You are not authorized to perform '
+                                    'this operation.')
+            for i, (account, flags) in enumerate(sorted(chan.access.items()), 1):
+                self._notice(user, '{0:<5} {1:<20} +{2:<12}  ({3}) [modified 1 '
+                             'day ago]'.format(i, account, flags, chan.name))
+            return self._notice(user, 'End of \002{0}\002 FLAGS listing.'
+                                .format(chan.name))
+        if len(args) < 2 or not self._allowed(user, chan, 'f'):
+            return self._notice(user, 'You are not authorized to perform this '
+                                'operation.')
+        account, change = args[0], args[1]
+        flags = chan.access.get(account, '')
+        adding = True
+        for flag in change:
+            if flag in '+-':
+                adding = flag == '+'
+            elif adding and flag not in flags:
+                flags += flag
+            elif not adding:
+                flags = flags.replace(flag, '')
+        if flags:
+            chan.access[account] = flags
+        else:
+            chan.access.pop(account, None)
+        self._notice(user, 'Flags \002{0}\002 were set on \002{1}\002 in '
+                     '\002{2}\002.'.format(change, account, chan.name))
+        self._broadcast(chan, ':{0} NOTICE {1} :\002{2}\002 set flags \002{3}\002 '
+                        'on \002{4}\002 in \002{1}\002.'.format(
+                            CHANSERV, chan.name, user.nick, change, account))
+        # What the new flags give the nicks logged in to the account
+        for nick in list(chan.members):
+            if self.users[nick].account != account:
+                continue
+            if 'b' in flags:
+                self._akick(chan, self.users[nick])
+                continue
+            for flag, mode in AUTOMODES:
+                has = mode in chan.members[nick]
+                if (flag in flags) != has:
+                    self._set_modes(chan, CHANSERV, ('-' if has else '+') + mode,
+                                    [self.users[nick].nick])
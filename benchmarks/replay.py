@@ -0,0 +1,274 @@
+#!/usr/bin/env python3
+""" Kontroler end to end, against a stand-in IRC server (ircd.py).
+
+`load` runs whole vote lifecycles at once: simulated users join, the
+voters (voiced by ChanServ) open and vote on elections, and the time from
+the `!vote` to ChanServ being asked for the flag (civis) or the KICK
+(kick) reaching the server is measured. `replay` plays a channel log back
+at `--speed` times its pace, reporting how many lines the bot kept up with
+and how long it took to answer commands. Log lines look like
+
+    [12:00:01] <nick> what they said
+    [12:00:05] *** nick joined
+    [12:00:09] *** nick left
+
+Runs against a throwaway database; needs a config.py like the bot does.
+
+    python3 benchmarks/replay.py load [--users N] [--elections N] [--early-close] ...
+    python3 benchmarks/replay.py replay LOG [--speed X] """
+
+import re
+import time
+import asyncio
+import argparse
+import collections
+from datetime import datetime, timedelta
+
+import fake
+from fake import bot, seed_users
+from ircd import FakeIRCd
+from models import db, Election, Effective
+from suite import percentile
+
+LOG_RE = re.compile(r'^\[(\d+):(\d+):(\d+)\] (?:<[@+]?(\S+)> (.*)|\*\*\* (\S+) '
+                    r'(joined|left|quit))')
+BOT_FLAGS = 'AFORefiorstv'  # what the bot's account has in the channel
+
+
+async def until(condition, timeout=60, interval=0.05):
+    """ Waits for `condition()` to be true """
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise TimeoutError('gave up waiting')
+        await asyncio.sleep(interval)
+
+
+async def start(server, rate):
+    """ A Kontroler connected to `server`, in its channel, with the accounts
+    of everyone there known """
+    client = bot.Kontroler('Kontroler', sasl_username=bot.config.SASL_USER,
+                           sasl_password=bot.config.SASL_PASS)
+    if rate is None:
+        client.outbound.rate = client.outbound.burst = float('inf')
+        client.outbound.backlog = float('inf')
+    else:
+        client.outbound.rate = rate
+    chan = next(iter(client.governed.values()))
+    server.logins['kontroler'] = bot.config.SASL_USER
+    server.channel(chan.name).access[bot.config.SASL_USER] = BOT_FLAGS
+    audited = server.expect(r'^PRIVMSG ChanServ :FLAGS {0}$'.format(re.escape(chan.name)))
+    await client.connect('127.0.0.1', server.port, tls=False)
+    await asyncio.wait_for(audited, 60)
+    members = server.channel(chan.name).members
+    await until(lambda: all(client.roster.account(nick) for nick in members
+                            if server.users[nick].account))
+    return client, chan
+
+
+def seed_civis(channel, opener, accounts):
+    """ Civis in effect for `accounts`, so the ACL audit leaves their +V """
+    now = datetime.utcnow()
+    with db.atomic():
+        elec = Election.create(channel=channel, vote_type='civis', opened=now,
+                               close=now, status=1, opened_by=opener,
+                               vote_target=opener.name)
+        rows = [{'election': elec, 'channel': channel, 'vote_type': 'civis',
+                 'close': now + timedelta(days=28), 'vote_target': account}
+                for account in accounts]
+        for i in range(0, len(rows), 500):
+            Effective.insert_many(rows[i:i + 500]).execute()
+
+
+def action_pattern(vote_type, channel, target):
+    channel, target = re.escape(channel), re.escape(target)
+    if vote_type == 'kick':
+        return r'^KICK {0} {1}\b'.format(channel, target)
+    return r'^PRIVMSG ChanServ :FLAGS {0} {1} \+V$'.format(channel, target)
+
+
+async def election(server, chan, vote_type, opener, voters, target, timings):
+    """ `opener` calls the vote on `target`, then every one of `voters`
+    votes for it once the bot announces it """
+    done = server.expect(action_pattern(vote_type, chan.name, target))
+    announcement = r'Vote \002#(\d+)\002: \002{0}\002: \037{1}\037'.format(
+        vote_type, re.escape(target))
+    # Replies to the same target may be packed into one line
+    announced = server.expect(r'^NOTICE {0} :.*{1}'.format(re.escape(chan.name),
+                                                          announcement))
+    opened = time.monotonic()
+    await server.say(opener, chan.name, '!vote {0} {1}'.format(vote_type, target))
+    line = (await asyncio.wait_for(announced, 60))[1]
+    voteid = re.search(announcement, line).group(1)
+    last = opened
+    for voter in voters:
+        if done.done():
+            break
+        last = time.monotonic()
+        await server.say(voter, chan.name, '!vote y {0}'.format(voteid))
+    acted = (await done)[0]
+    timings['open to action'].append(acted - opened)
+    timings['last vote to action'].append(acted - last)
+
+
+def report(timings, elapsed, note=''):
+    print("{0:<22}{1:>8}{2:>10}{3:>10}{4:>10}".format(
+        'measure', 'count', 'p50 ms', 'p99 ms', 'max ms'))
+    for name, values in timings.items():
+        if not values:
+            continue
+        ordered = sorted(values)
+        print("{0:<22}{1:>8}{2:>10.1f}{3:>10.1f}{4:>10.1f}".format(
+            name, len(ordered), percentile(ordered, 0.5) * 1000,
+            percentile(ordered, 0.99) * 1000, ordered[-1] * 1000))
+    print("{0:.2f}s in all{1}".format(elapsed, note))
+
+
+async def load(args):
+    server = await FakeIRCd().start()
+    vtype = bot.VOTE_NAMES[args.type]
+    if args.openfor is not None:
+        vtype.openfor = args.openfor
+    if args.early_close:
+        vtype.early_close = True
+    rows = seed_users(fake.CHANNEL_KEY, args.users)
+    users = sorted(rows, key=lambda name: int(name[1:]))
+    voters, others = users[:args.voters], users[args.voters:]
+    if len(others) < args.elections:
+        raise SystemExit('Need more users than voters, one target per election')
+    seed_civis(fake.CHANNEL_KEY, rows[voters[0]], voters)
+    channel = server.channel(bot.CHANNELS[0])
+    for name in users:
+        server.add_user(name, name)
+        if name in voters:
+            channel.access[name] = 'V'
+        await server.join(name, channel.name)
+
+    start_time = time.monotonic()
+    client, chan = await start(server, args.rate)
+    print("Connected and synced {0} users in {1:.2f}s".format(
+        len(users), time.monotonic() - start_time))
+
+    timings = collections.OrderedDict([('open to action', []),
+                                       ('last vote to action', [])])
+    start_time = time.monotonic()
+    await asyncio.gather(*[
+        election(server, chan, args.type, voters[i % len(voters)],
+                 voters[:i % len(voters)] + voters[i % len(voters) + 1:],
+                 others[i], timings)
+        for i in range(args.elections)])
+    elapsed = time.monotonic() - start_time
+    if not vtype.early_close:
+        # Every election waits out openfor; what's left is ours
+        timings['overhead'] = [t - vtype.openfor for t in timings['open to action']]
+    report(timings, elapsed, ', {0} lines from the bot'.format(server.received))
+    await client.disconnect(expected=True)
+    await server.stop()
+
+
+def parse_log(path):
+    """ [(seconds into the log, nick, what: 'say', 'join' or 'part', text)] """
+    events = []
+    first = None
+    with open(path, encoding='utf-8', errors='replace') as f:
+        for line in f:
+            m = LOG_RE.match(line.rstrip('\n'))
+            if m is None:
+                continue
+            at = int(m.group(1)) * 3600 + int(m.group(2)) * 60 + int(m.group(3))
+            if first is None:
+                first = at
+            at = (at - first) % 86400  # Past midnight
+            if m.group(4):
+                events.append((at, m.group(4), 'say', m.group(5)))
+            else:
+                events.append((at, m.group(6),
+                               'join' if m.group(7) == 'joined' else 'part', None))
+    return events
+
+
+async def answered(server, chan, nick, said, timings):
+    """ Times the bot's first line to the channel or `nick` after `said` """
+    reply = server.expect(r'^(?:PRIVMSG|NOTICE) (?:{0}|{1}) :'.format(
+        re.escape(chan.name), re.escape(nick)))
+    try:
+        at = (await asyncio.wait_for(reply, 10))[0]
+    except asyncio.TimeoutError:
+        return reply.cancel()
+    timings['command to reply'].append(at - said)
+
+
+async def replay(args):
+    server = await FakeIRCd().start()
+    events = parse_log(args.log)
+    if not events:
+        raise SystemExit('No lines in {0}'.format(args.log))
+    nicks = set(nick for _, nick, _, _ in events)
+    channel = server.channel(bot.CHANNELS[0])
+    for nick in nicks:
+        server.add_user(nick, nick)
+    client, chan = await start(server, args.rate)
+
+    timings = collections.OrderedDict([('line lag', []), ('command to reply', [])])
+    waiting = []
+    start_time = time.monotonic()
+    for at, nick, what, text in events:
+        due = start_time + at / args.speed
+        delay = due - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        timings['line lag'].append(max(0, -delay))
+        key = nick.lower()
+        if what == 'join':
+            if key not in channel.members:
+                await server.join(nick, channel.name)
+            continue
+        if what == 'part':
+            if key in channel.members:
+                await server.part(nick, channel.name)
+            continue
+        if key not in channel.members:
+            await server.join(nick, channel.name)
+        said = time.monotonic()
+        await server.say(nick, channel.name, text)
+        if text.startswith('!'):
+            waiting.append(asyncio.ensure_future(
+                answered(server, chan, nick, said, timings)))
+    await asyncio.gather(*waiting)
+    elapsed = time.monotonic() - start_time
+    report(timings, elapsed, ', {0} log lines ({1:,.0f}/s), {2} lines from the bot'
+           .format(len(events), len(events) / elapsed, server.received))
+    await client.disconnect(expected=True)
+    await server.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rate', type=float, default=None,
+                        help="the bot's outgoing lines per second (unlimited "
+                        "by default)")
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+    sub = commands.add_parser('load', help='many elections at once')
+    sub.add_argument('--users', type=int, default=2000)
+    sub.add_argument('--elections', type=int, default=50)
+    sub.add_argument('--voters', type=int, default=5,
+                     help='voiced users; each votes in every election')
+    sub.add_argument('--type', choices=('civis', 'kick'), default='kick')
+    sub.add_argument('--openfor', type=float, default=None,
+                     help='seconds elections stay open (the vote type\'s own '
+                     'by default)')
+    sub.add_argument('--early-close', action='store_true',
+                     help='close elections as soon as they are decided')
+    sub = commands.add_parser('replay', help='play back a channel log')
+    sub.add_argument('log')
+    sub.add_argument('--speed', type=float, default=60.0,
+                     help='how many times faster than it happened')
+    args = parser.parse_args()
+
+    asyncio.run(load(args) if args.command == 'load' else replay(args))
+    fake.bot.aiodb.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+""" Write throughput of vote casting and line counting per storage setup.
+
+Runs the `casts` and `chatter` workloads of the suite once per database
+configuration, each in a process of its own (the database is set up when
+models is imported), and compares them. Needs a config.py like the bot
+does; its DATABASE settings are overridden.
+
+    python3 benchmarks/storage.py [--scale N] [--only NAME...] """
+
+import os
+import sys
+import json
+import argparse
+import subprocess
+import collections
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+WAL = {'journal_mode': 'wal', 'synchronous': 'normal'}
+SETUPS = collections.OrderedDict([
+    ('rollback', {'DATABASE_PRAGMAS': {}}),
+    ('wal', {'DATABASE_PRAGMAS': WAL}),
+    ('wal+cache+mmap', {'DATABASE_PRAGMAS': dict(WAL, cache_size=-16000,
+                                                 mmap_size=64 * 2 ** 20)}),
+    ('wal pooled', {'DATABASE_PRAGMAS': WAL, 'DATABASE_POOL': 4}),
+    ('memory', {'DATABASE': ':memory:'}),
+])
+# {result row: what it's shown as}
+ROWS = collections.OrderedDict([('vote cast', 'vote casts'),
+                                ('activity flush', 'line count flushes')])
+
+
+def run_setup(name, scale):
+    """ Runs in the child: configures the database, then the workloads """
+    sys.path.insert(0, ROOT)
+    import config
+    config.DATABASE = 'users.db'  # relative to the benchmark's directory
+    for option, value in SETUPS[name].items():
+        setattr(config, option, value)
+    import asyncio
+    import suite
+    results = asyncio.run(suite.run(['casts', 'chatter'], scale))
+    suite.fake.bot.aiodb.shutdown()
+    json.dump(dict((row, results[row]) for row in ROWS), sys.stdout)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--scale', type=float, default=1.0,
+                        help='multiplies the size of every workload')
+    parser.add_argument('--only', nargs='+', choices=list(SETUPS),
+                        default=list(SETUPS))
+    parser.add_argument('--setup', choices=list(SETUPS), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.setup:
+        return run_setup(args.setup, args.scale)
+
+    results = collections.OrderedDict()
+    for name in args.only:
+        out = subprocess.run([sys.executable, __file__, '--setup', name,
+                              '--scale', str(args.scale)],
+                             stdout=subprocess.PIPE, check=True).stdout
+        # The bot prints as it goes; the results are the last line
+        results[name] = json.loads(out.decode().strip().splitlines()[-1])
+
+    for row, title in ROWS.items():
+        print("{0:<16}{1:>12}{2:>10}{3:>10}".format(title, 'calls/s',
+                                                    'p50 ms', 'p99 ms'))
+        for name, rows in results.items():
+            r = rows[row]
+            print("  {0:<14}{1:>12,.0f}{2:>10.3f}{3:>10.3f}".format(
+                name, r['per_second'], r['p50_ms'], r['p99_ms']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+""" What Kontroler's handlers cost, per call.
+
+Each workload drives a FakeKontroler (no network, scratch database) and
+reports throughput, p50/p99 latency and SQL statements per call. Results
+can be saved as a baseline and later runs checked against it; a check
+fails (exit status 1) when a workload gets slower than the tolerance
+allows or runs more queries than it used to.
+
+    python3 benchmarks/suite.py [--scale N] [--only NAME...]
+                                [--save FILE | --check FILE] """
+
+import argparse
+import asyncio
+import collections
+import json
+import sys
+import time
+from datetime import datetime, timedelta
+
+import fake
+from fake import FakeKontroler, queries, reset, seed_users, seed_election
+from models import Election
+
+DEFAULT_BASELINE = 'benchmarks/baseline.json'
+WORKLOADS = collections.OrderedDict()
+
+
+def workload(func):
+    WORKLOADS[func.__name__] = func
+    return func
+
+
+class Recorder(object):
+    def __init__(self):
+        self.rows = collections.OrderedDict()  # {name: [latencies, queries]}
+
+    async def time(self, name, awaitable):
+        row = self.rows.setdefault(name, [[], 0])
+        before = queries.count
+        start = time.perf_counter()
+        result = await awaitable
+        row[0].append(time.perf_counter() - start)
+        row[1] += queries.count - before
+        return result
+
+
+def client_with_users(count, enfranchised=True):
+    users = seed_users(fake.CHANNEL_KEY, count)
+    client = FakeKontroler()
+    for name in users:
+        client.add_user(name, enfranchised)
+    return client, users
+
+
+@workload
+async def chatter(rec, scale):
+    """ Channel lines through on_message and count_line """
+    client, users = client_with_users(200)
+    names = list(users)
+    chan = client.chan.name
+    for i in range(int(20000 * scale)):
+        await rec.time('chatter', client.on_message(
+            chan, names[i % len(names)], 'just talking, line {0}'.format(i)))
+        if i % 1000 == 999:
+            await rec.time('activity flush', client._flush_activity())
+
+
+@workload
+async def start_votes(rec, scale):
+    """ A burst of !vote opine """
+    client, users = client_with_users(100)
+    names = list(users)
+    for i in range(int(500 * scale)):
+        await rec.time('start_vote', client.on_message(
+            client.chan.name, names[i % len(names)], '!vote opine issue {0}'.format(i)))
+
+
+@workload
+async def casts(rec, scale):
+    """ Thousands of !vote y <id>, spread over a few elections """
+    client, users = client_with_users(int(2000 * scale))
+    opener = next(iter(users.values()))
+    elections = [seed_election(client.chan.key, opener, []) for _ in range(10)]
+    client.tallies.load()
+    for i, name in enumerate(users):
+        elec = elections[i % len(elections)]
+        await rec.time('vote cast', client.on_message(
+            client.chan.name, name, '!vote y {0}'.format(elec.id)))
+
+
+@workload
+async def closes(rec, scale):
+    """ _closevote on elections with large electorates """
+    client, users = client_with_users(int(2000 * scale))
+    voters = list(users.values())
+    elections = [seed_election(client.chan.key, voters[0], voters)
+                 for _ in range(20)]
+    client.tallies.load()
+    for elec in elections:
+        await rec.time('closevote', client._closevote(elec.id))
+
+
+@workload
+async def listing(rec, scale):
+    """ !vote list with a few open elections """
+    client, users = client_with_users(500)
+    voters = list(users.values())
+    for _ in range(5):
+        seed_election(client.chan.key, voters[0], voters)
+    client.tallies.load()
+    names = list(users)
+    for i in range(int(500 * scale)):
+        await rec.time('vote list', client.on_message(
+            client.chan.name, names[i % len(names)], '!vote list'))
+
+
+@workload
+async def archiving(rec, scale):
+    """ Moving closed elections to the archive, then opening new ones; new
+    elections must not get the ids of archived ones """
+    client, users = client_with_users(100)
+    voters = list(users.values())
+    long_ago = datetime.utcnow() - timedelta(days=400)
+    for _ in range(5):
+        elections = [seed_election(client.chan.key, voters[0], voters[:10],
+                                   status=3) for _ in range(int(200 * scale))]
+        Election.update(close=long_ago) \
+                .where(Election.id.in_([e.id for e in elections])).execute()
+        await rec.time('archive', fake.bot.aiodb.run(fake.bot.archive.archive, 180))
+        await client.on_message(client.chan.name, voters[0].name,
+                                '!vote opine issue {0}'.format(elections[-1].id))
+        opened = Election.select().order_by(Election.id.desc()).first()
+        if opened.id <= elections[-1].id:
+            raise AssertionError('election id {0} reused after archiving'
+                                 .format(opened.id))
+
+
+@workload
+async def flags(rec, scale):
+    """ ChanServ FLAGS listings with thousands of entries """
+    client = FakeKontroler()
+    chan = client.chan.name
+    lines = ['{0}  u{0}  +V  ({1}) [modified 1 day ago]'.format(i, chan)
+             for i in range(int(5000 * scale))]
+    for _ in range(3):
+        for line in lines:
+            await rec.time('flags line', client.on_notice(
+                client.nickname, 'ChanServ', line))
+        await rec.time('flags audit', client.on_notice(
+            client.nickname, 'ChanServ',
+            'End of \002{0}\002 FLAGS listing.'.format(chan)))
+
+
+def percentile(ordered, p):
+    return ordered[int(round(p * (len(ordered) - 1)))]
+
+
+def summarize(rec):
+    results = collections.OrderedDict()
+    for name, (latencies, count) in rec.rows.items():
+        ordered = sorted(latencies)
+        results[name] = {'calls': len(ordered),
+                         'per_second': len(ordered) / sum(ordered),
+                         'p50_ms': percentile(ordered, 0.5) * 1000,
+                         'p99_ms': percentile(ordered, 0.99) * 1000,
+                         'queries': count / len(ordered)}
+    return results
+
+
+def report(results):
+    print("{0:<16}{1:>8}{2:>12}{3:>10}{4:>10}{5:>10}".format(
+        'workload', 'calls', 'calls/s', 'p50 ms', 'p99 ms', 'queries'))
+    for name, r in results.items():
+        print("{0:<16}{1:>8}{2:>12,.0f}{3:>10.3f}{4:>10.3f}{5:>10.2f}".format(
+            name, r['calls'], r['per_second'], r['p50_ms'], r['p99_ms'],
+            r['queries']))
+
+
+def check(results, baseline, tolerance):
+    """ Returns the regressions against `baseline` """
+    failures = []
+    for name, r in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        if r['per_second'] < base['per_second'] * (1 - tolerance):
+            failures.append("{0}: {1:,.0f} calls/s, baseline {2:,.0f}".format(
+                name, r['per_second'], base['per_second']))
+        if r['p50_ms'] > base['p50_ms'] * (1 + tolerance):
+            failures.append("{0}: p50 {1:.3f}ms, baseline {2:.3f}ms".format(
+                name, r['p50_ms'], base['p50_ms']))
+        if r['queries'] > base['queries'] + 0.01:
+            failures.append("{0}: {1:.2f} queries per call, baseline {2:.2f}".format(
+                name, r['queries'], base['queries']))
+    return failures
+
+
+async def run(names, scale):
+    rec = Recorder()
+    for name in names:
+        reset()
+        await WORKLOADS[name](rec, scale)
+        # Let background work (flushes, sends) finish before the next one
+        await asyncio.sleep(0.1)
+    return summarize(rec)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--scale', type=float, default=1.0,
+                        help='multiplies the size of every workload')
+    parser.add_argument('--only', nargs='+', choices=list(WORKLOADS),
+                        default=list(WORKLOADS))
+    parser.add_argument('--save', nargs='?', const=DEFAULT_BASELINE,
+                        metavar='FILE', help='save the results as a baseline')
+    parser.add_argument('--check', nargs='?', const=DEFAULT_BASELINE,
+                        metavar='FILE', help='compare against a baseline')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='how much slower than the baseline is fine')
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args.only, args.scale))
+    fake.bot.aiodb.shutdown()
+    report(results)
+
+    if args.save:
+        with open(fake.path(args.save), 'w') as f:
+            json.dump(results, f, indent=2)
+        print("Saved baseline to {0}".format(args.save))
+    if args.check:
+        with open(fake.path(args.check)) as f:
+            failures = check(results, json.load(f), args.tolerance)
+        for failure in failures:
+            print("REGRESSION " + failure)
+        if failures:
+            sys.exit(1)
+        print("No regressions against {0}".format(args.check))
+
+
+if __name__ == '__main__':
+    main()
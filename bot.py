@@ -1,27 +1,48 @@
 #!/usr/bin/env python3
 import time
+import asyncio
+import collections
+import traceback
 import pydle
-import argparse
+from pydle.features.rfc1459.protocol import (BEHAVIOUR_LIST, BEHAVIOUR_PARAMETER,
+                                             BEHAVIOUR_PARAMETER_ON_SET)
 import re
-import copy
 from datetime import datetime, timedelta
 import votes
 import config
-from models import db, User, Election, Suffrage, Effective
-from i18n import _
-
-VOTE_NAMES = {"civis": votes.Civis,
-              "censure": votes.Censure,
-              "staff": votes.Staff,
-              "destaff": votes.Destaff,
-              "kick": votes.Kick,
-              "topic": votes.Topic,
-              "opine": votes.Opine,
-              "ban": votes.Ban}
-
-
-votelistParser = argparse.ArgumentParser()
-votelistParser.add_argument('--type')
+import aiodb
+from models import User, Election, Suffrage, Effective
+from tally import TallyCache, tally, ballots
+from scheduler import DeadlineScheduler
+from state import CHANNELS, ChannelState
+import outbound
+import acl
+import accounts
+import roster
+import bans
+import metrics
+import profiler
+from commands import CommandTable, Context, UsageError, ballot, rest, vote_id
+import i18n
+import journal
+import archive
+
+VOTE_NAMES = votes.BY_NAME
+
+
+COMMANDS = CommandTable()
+_vote = COMMANDS.command('vote')
+_vote.add(VOTE_NAMES, 'cmd_vote_start', word=str, args=[str], optional=[rest],
+          usage='Usage: !vote <type> <target>')
+_vote.add(['list'], 'cmd_vote_list', options={'--type': str},
+          channel_only=True, usage='Usage: !vote list [--type <type>]')
+_vote.add(['y', 'yes', 'n', 'no'], 'cmd_vote_ballot', word=ballot,
+          optional=[vote_id], usage='Usage: !vote y/n <vote id>')
+_vote.add_numeric('cmd_vote_id', args=[vote_id], optional=[ballot])
+COMMANDS.command('profile').add_numeric('cmd_profile', args=[int])
+
+# Accounts allowed to run maintenance commands (!profile)
+OPERATORS = set(a.lower() for a in getattr(config, 'OPERATORS', []))
 
 
 def display_time(seconds, granularity=2):
@@ -54,499 +75,929 @@ BaseClient = pydle.featurize(pydle.features.RFC1459Support,
                              pydle.features.WHOXSupport)
 
 CS_FLAGS_RE = re.compile(r'\d+\s+(.+?)\s+\+(.+?)\s+(?:\(.+\))?\s+\((\#.+)\).*')
+CS_FLAGS_END_RE = re.compile(r'End of \002(.+?)\002 FLAGS listing')
 CS_FCHANGE_RE = re.compile(r'set flags \002(.+?)\002 on \002(.+?)\002')
+SERVICES = ('chanserv', 'nickserv')
+
+STATUS_NAMES = {0: '\00301,07ACTIVE\003',
+                1: '\00300,03PASSED\003',
+                2: '\00300,04QUORUM\003',
+                3: '\00300,04FAILED\003',
+                4: '\00300,04VETOED\003'}
+MESSAGES = metrics.counter('kontroler_messages_total',
+                           'Channel and private messages handled', ['kind'])
+COMMAND_SECONDS = metrics.histogram('kontroler_command_seconds',
+                                    'Time to handle a command', ['command'])
+CHANSERV_ROUNDTRIP = metrics.histogram(
+    'kontroler_chanserv_roundtrip_seconds',
+    'From asking ChanServ for a FLAGS listing to the end of it')
+ELECTIONS_CLOSED = metrics.counter('kontroler_elections_closed_total',
+                                   'Elections closed', ['status'])
+CLOSED_STATUS = {1: 'passed', 2: 'quorum', 3: 'failed'}
+EXPIRIES = metrics.counter('kontroler_expiries_total',
+                           'Votes in effect that expired')
+
+TIME_UNITS = ((604800, '{0} \002weeks {1}\002'),
+              (86400, '{0} \002days {1}\002'),
+              (3600, '{0} \002hours {1}\002'),
+              (60, '{0} \002minutes {1}\002'))
 
 
 class Kontroler(BaseClient):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        # {"Account": {"flags": ..., "lines": ..., ...}}
-        self.usermap = {}
-
-        for user in User.select():
-            self.usermap[user.name] = {"lines": user.lines,
-                                       "first_seen": user.first_seen,
-                                       "last_seen": user.last_seen,
-                                       "flags": ""}
-
-    def on_connect(self):
-        super().on_connect()
-        self.join(config.CHANNEL)
-
-    def on_join(self, channel, user):
+        # {"#channel": ChannelState}
+        self.governed = {}
+        for name in CHANNELS:
+            self.governed[name.lower()] = ChannelState(name)
+            self.governed[name.lower()].usermap.load()
+        self.tallies = TallyCache()
+        self.tallies.load(journal.recover())
+        self.deadlines = DeadlineScheduler()
+        self._periodic = []
+        # Channels we asked ChanServ for FLAGS of, in order
+        self._flags_pending = collections.deque()
+        # Votes being opened, {(channel, type, target): done}
+        self._opening = {}
+        self.acl = acl.ACLReconciler(self)
+        self.roster = roster.Roster(self.normalize)
+        self.accounts = accounts.AccountResolver(
+            self,
+            ttl=getattr(config, 'ACCOUNT_CACHE_TTL', 600),
+            delay=getattr(config, 'ACCOUNT_BATCH_DELAY', 0.5),
+            channel_batch=getattr(config, 'ACCOUNT_WHO_CHANNEL', 5))
+        self.outbound = outbound.OutboundQueue(
+            self._deliver,
+            rate=getattr(config, 'OUTBOUND_RATE', 1.0),
+            burst=getattr(config, 'OUTBOUND_BURST', 5),
+            line_length=getattr(config, 'OUTBOUND_LINE_LENGTH', 400),
+            backlog=getattr(config, 'OUTBOUND_BACKLOG', 50))
+        self._metrics_server = None
+        self._register_metrics()
+
+    def _register_metrics(self):
+        out = self.outbound
+        metrics.gauge('kontroler_deadlines_pending',
+                      'Scheduled vote closes and expiries',
+                      lambda: dict(((kind,), count) for kind, count
+                                   in self.deadlines.pending().items()),
+                      ['kind'])
+        metrics.gauge('kontroler_outbound_queued', 'Lines waiting to be sent',
+                      lambda: len(out))
+        metrics.gauge('kontroler_outbound_lines_total',
+                      'Outgoing lines sent, packed into others, or dropped',
+                      lambda: {('sent',): out.sent, ('packed',): out.packed,
+                               ('dropped',): out.dropped},
+                      ['result'], kind='counter')
+        metrics.gauge('kontroler_usermap_records', 'Accounts kept in memory',
+                      lambda: dict(((c.name,), len(c.usermap))
+                                   for c in self.governed.values()),
+                      ['channel'])
+        metrics.gauge('kontroler_usermap_evictions_total',
+                      'Accounts dropped from memory',
+                      lambda: dict(((c.name,), c.usermap.evictions)
+                                   for c in self.governed.values()),
+                      ['channel'], kind='counter')
+        metrics.gauge('kontroler_account_cache_entries',
+                      'Accounts of nicks that left, kept for when they rejoin',
+                      lambda: len(self.accounts))
+
+    def governs(self, channel):
+        """ Returns the ChannelState of `channel`, or None """
+        return self.governed.get(channel.lower()) if channel else None
+
+    async def on_connect(self):
+        await super().on_connect()
+        for chan in self.governed.values():
+            await self.join(chan.name)
+        listen = getattr(config, 'METRICS_LISTEN', None)
+        if listen and self._metrics_server is None:
+            self._metrics_server = await metrics.serve(*listen)
+
+    async def on_disconnect(self, expected):
+        self.outbound.clear()  # Nobody to send it to anymore
+        self.accounts.clear()
+        self.roster.clear()
+        await super().on_disconnect(expected)
+
+    def _every(self, interval, func, *args):
+        """ Runs coroutine function `func` every `interval` seconds """
+        async def loop():
+            metrics.handler.set(func.__name__)
+            while True:
+                await asyncio.sleep(interval)
+                try:
+                    await func(*args)
+                except Exception:
+                    traceback.print_exc()
+        return asyncio.ensure_future(loop())
+
+    @staticmethod
+    def _pending_deadlines(channel):
+        return (list(Election.select(Election.id, Election.close)
+                             .where((Election.channel == channel) &
+                                    (Election.status == 0))),
+                list(Effective.select(Effective.id, Effective.close)
+                              .where(Effective.channel == channel)))
+
+    async def on_join(self, channel, user):
+        self.roster.joined(channel, user)
+        chan = self.governs(channel)
+        if chan is None:
+            return
         if user == self.nickname:
-            self._check_flags()
-
-            for elec in Election.select().where(Election.status == 0):
-                if elec.close < datetime.utcnow():
-                    # Already closed!!
-                    self._closevote(elec.id)
-                else:
-                    closes_in = elec.close - datetime.utcnow()
-                    self.eventloop.schedule_in(closes_in, self._closevote, elec.id)
-
-            for elec in Effective.select():
-                if elec.close < datetime.utcnow():
-                    # Already closed!!
-                    self._expire(elec.id)
-                else:
-                    closes_in = elec.close - datetime.utcnow()
-                    self.eventloop.schedule_in(closes_in, self._expire, elec.id)
-
-            self.eventloop.schedule_periodically(600, self.set_mode, config.CHANNEL, 'b')
-            self.eventloop.schedule_periodically(3600, self._check_flags)
+            await self._check_flags(chan)
+            await self._sync_bans(chan)
+
+            # Overdue ones get closed in a single batch by the scheduler
+            elections, effectives = await aiodb.run(self._pending_deadlines,
+                                                    chan.key)
+            for elec in elections:
+                self._schedule_close(elec)
+            for elec in effectives:
+                self._schedule_expire(elec)
+
+            if not self._periodic:
+                self._periodic = [
+                    self._every(getattr(config, 'ACTIVITY_FLUSH_INTERVAL', 60),
+                                self._flush_activity),
+                    self._every(getattr(config, 'BAN_RESYNC_INTERVAL', 21600),
+                                self._check_bans),
+                    self._every(getattr(config, 'ACL_AUDIT_INTERVAL', 3600),
+                                self._check_all_flags),
+                    self._every(getattr(config, 'JOURNAL_SNAPSHOT_INTERVAL', 3600),
+                                self._snapshot)]
+                if getattr(config, 'ARCHIVE_AFTER_DAYS', 180):
+                    self._periodic.append(self._every(86400, self._archive))
+                if getattr(config, 'METRICS_TEXTFILE', None):
+                    self._periodic.append(self._every(
+                        getattr(config, 'METRICS_TEXTFILE_INTERVAL', 15),
+                        self._write_metrics))
         else:
-            self.whois(user)
-
-    def _check_flags(self):
-        self.civis_count = 0
-        self.staff_count = 0
-        self.message('ChanServ', 'FLAGS {}'.format(config.CHANNEL))
-
-    def on_raw_367(self, message):
-        ban, creator, timestamp = message.params[2:]
-        if time.time() - int(timestamp) > 86400:
-            self.set_mode(config.CHANNEL, '-b', ban)
+            self.accounts.joined(channel, user)
+
+    async def _create_user(self, nickname):
+        # pydle WHOISes every new user on servers without WHOX; joins are
+        # looked up in batches by self.accounts instead
+        super(pydle.features.WHOXSupport, self)._create_user(nickname)
+
+    async def _sync_user(self, nick, metadata):
+        await super()._sync_user(nick, metadata)
+        if 'account' in metadata and nick in self.users:
+            self.roster.set_account(nick, self.users[nick]['account'])
+
+    async def _rename_user(self, user, new):
+        # Instead of pydle's, which looks for the nick in every list of every
+        # channel and WHOISes the new one: the roster knows where it is, and
+        # without account-notify the account is looked up again in a batch
+        info = self.users.pop(user, None)
+        if info is None:
+            await self._create_user(new)
+        else:
+            info['nickname'] = new
+            self.users[new] = info
+        for channel, modes in self.roster.renamed(user, new).items():
+            ch = self.channels.get(channel)
+            if ch is None:
+                continue
+            ch['users'].discard(user)
+            ch['users'].add(new)
+            for mode in modes:
+                nicks = ch['modes'].get(mode, [])
+                if user in nicks:
+                    nicks[nicks.index(user)] = new
+        if info is not None and not self._capabilities.get('account-notify'):
+            info.update(account=None, identified=False)
+            self.roster.set_account(new, None)
+            self.accounts.lookup(new)
+
+    def _destroy_user(self, nickname, channel=None):
+        # Before pydle forgets them; kicks get here before on_kick
+        self.accounts.left(nickname)
+        super()._destroy_user(nickname, channel)
+        self.roster.parted(nickname, channel)
+
+    async def on_raw_join(self, message):
+        await super().on_raw_join(message)
+        # With extended-join, pydle sets the account without _sync_user
+        nick = self._parse_user(message.source)[0]
+        if nick in self.users:
+            self.roster.set_account(nick, self.users[nick]['account'])
+
+    async def on_raw_353(self, message):
+        await super().on_raw_353(message)
+        channel, names = message.params[2:4]
+        prefixes = ''.join(self._nickname_prefixes)
+        for entry in names.split():
+            nick = self._parse_user(entry.lstrip(prefixes))[0]
+            if not nick:
+                continue
+            self.roster.joined(channel, nick)
+            for prefix in entry[:len(entry) - len(entry.lstrip(prefixes))]:
+                self.roster.set_mode(channel, nick,
+                                     self._nickname_prefixes[prefix], True)
+
+    async def on_raw_354(self, message):
+        await super().on_raw_354(message)
+        self.accounts.on_whox(message.params)
+
+    async def on_raw_315(self, message):
+        await super().on_raw_315(message)
+        self.accounts.on_who_end(message.params[1])
+
+    async def on_nick_change(self, old, new):
+        await super().on_nick_change(old, new)
+        self.accounts.renamed(old, new)
+
+    async def _flush_activity(self):
+        for chan in self.governed.values():
+            await chan.activity.flush()
+
+    async def _check_bans(self):
+        for chan in self.governed.values():
+            if chan.name in self.channels:
+                await self._sync_bans(chan)
+
+    async def _sync_bans(self, chan):
+        chan.bans.begin()
+        await self.set_mode(chan.name, 'b')
+
+    def _schedule_unban(self, chan):
+        expiry = chan.bans.next_expiry
+        if expiry is None:
+            return self.deadlines.cancel(('unban', chan.key))
+        self.deadlines.schedule(('unban', chan.key),
+                                datetime.utcfromtimestamp(expiry),
+                                self._lift_bans, chan)
+
+    async def _lift_bans(self, chan):
+        if chan.name not in self.channels:
+            # Rescheduled when we're back and have read the ban list again
+            return
+        for group in bans.mode_lines(chan.bans.due(), self._mode_limit,
+                                     self.outbound.line_length):
+            self.outbound.put('MODE', chan.name,
+                              ' '.join(['-' + 'b' * len(group)] + group),
+                              outbound.CONTROL)
+        self._schedule_unban(chan)
+
+    def _reset_attributes(self):
+        super()._reset_attributes()
+        self._mode_limit = 3  # RFC 1459's, until the server says (ISUPPORT MODES)
+
+    async def on_isupport_modes(self, value):
+        if value is True:
+            # No value means there's no limit; the line length still is one
+            self._mode_limit = None
+        else:
+            await super().on_isupport_modes(value)
+
+    async def _check_all_flags(self):
+        for chan in self.governed.values():
+            if chan.name in self.channels:
+                await self._check_flags(chan)
+
+    async def _archive(self):
+        # Failed votes must stay around for as long as they block new ones
+        cooldown = max(vote.cooldown for vote in VOTE_NAMES.values())
+        days = max(getattr(config, 'ARCHIVE_AFTER_DAYS', 180), cooldown / 86400 + 1)
+        while await aiodb.run(archive.archive, days):
+            pass
 
-    def on_notice(self, target, by, message):
-        if by == "ChanServ" and target == config.CHANNEL:
+    async def _snapshot(self):
+        await aiodb.atomic(journal.snapshot)
+
+    async def _write_metrics(self):
+        await aiodb.run(metrics.write_textfile, config.METRICS_TEXTFILE)
+
+    async def _check_flags(self, chan):
+        self._flags_pending.append((chan, time.monotonic()))
+        await self.message('ChanServ', 'FLAGS {}'.format(chan.name))
+
+    async def on_raw_367(self, message):
+        channel, ban, creator, timestamp = message.params[1:5]
+        chan = self.governs(channel)
+        if chan is not None:
+            chan.bans.listed(ban, int(timestamp))
+
+    async def on_raw_368(self, message):
+        chan = self.governs(message.params[1])
+        if chan is not None:
+            chan.bans.end()
+            self._schedule_unban(chan)
+
+    async def on_mode_change(self, channel, modes, by):
+        await super().on_mode_change(channel, modes, by)
+        chan = self.governs(channel)
+        statuses = set(self._nickname_prefixes.values())
+        changed = False
+        for adding, mode, param in self._mode_params(modes):
+            if param is None:
+                continue
+            if mode in statuses:
+                self.roster.set_mode(channel, param, mode, adding)
+            elif mode == 'b' and chan is not None:
+                if adding:
+                    chan.bans.add(param)
+                else:
+                    chan.bans.remove(param)
+                changed = True
+        if changed:
+            self._schedule_unban(chan)
+
+    def _mode_params(self, modes):
+        """ Yields (adding, mode, parameter) for a channel MODE change """
+        params = iter(modes[1:])
+        adding = True
+        for mode in modes[0] if modes else '':
+            if mode in '+-':
+                adding = mode == '+'
+                continue
+            param = None
+            for behaviour, letters in self._channel_modes_behaviour.items():
+                if mode in letters:
+                    if behaviour in (BEHAVIOUR_LIST, BEHAVIOUR_PARAMETER) or \
+                       (adding and behaviour == BEHAVIOUR_PARAMETER_ON_SET):
+                        param = next(params, None)
+                    break
+            yield adding, mode, param
+
+    async def on_notice(self, target, by, message):
+        if by != "ChanServ":
+            return
+        chan = self.governs(target)
+        if chan is not None:
             m = CS_FCHANGE_RE.search(message)
             if m:
+                account = m.group(2).lower()
+                user = chan.usermap.add(account)
+                added = False
                 for fl in m.group(1):
                     if fl == '+':
                         add = True
                     elif fl == '-':
                         add = False
+                    elif add:
+                        if fl not in user.flags:
+                            user.flags += fl
+                        added = added or fl in acl.ENTITLES
                     else:
-                        if add:
-                            self.usermap[m.group(2).lower()]['flags'] += fl
-                        else:
-                            self.usermap[m.group(2).lower()]['flags'] = \
-                                self.usermap[m.group(2).lower()]['flags'].replace(
-                                    fl, '')
-        elif by == "ChanServ" and target == self.nickname:  # FLAGS
+                        user.flags = user.flags.replace(fl, '')
+                if added:
+                    await self.acl.changed(chan, account)
+        elif target == self.nickname:  # FLAGS
+            if message[:1].isdigit():
+                m = CS_FLAGS_RE.search(message)
+                chan = self.governs(m.group(3)) if m else None
+                if chan is not None:
+                    self.acl.listed(chan, m.group(1).lower(), m.group(2))
+                return
             if message == "You are not authorized to perform this operation.":
-                return self.message(config.CHANNEL, _("Error: Can't see ACL"))
-            if message.endswith('FLAGS listing.'):
-                for k in self.usermap:
-                    u = self.usermap[k]['flags']
-                    if (('V' in u) or ('O' in u)) and k.lower() != config.SASL_USER.lower():
-                        print(self.civis_count, k)
-                        try:
-                            ef = Effective.select().where(Effective.vote_target == k).get()
-                        except Effective.DoesNotExist:
-                            flags = 'VO'
-                            if self.civis_count <= 3:
-                                flags = flags.replace('V', '')
-                                self.civis_count -= 1
-                            if self.staff_count <= 2:
-                                flags = flags.replace('O', '')
-                                self.staff_count -= 1
-                            self.message('ChanServ', 'FLAGS {0} {1} -{2}'.format(config.CHANNEL, k, flags))
+                if self._flags_pending:
+                    chan, asked = self._flags_pending.popleft()
+                    CHANSERV_ROUNDTRIP.observe(time.monotonic() - asked)
+                    return await self.message(chan.name, chan.tr("Error: Can't see ACL"))
                 return
-            m = CS_FLAGS_RE.search(message)
+            m = CS_FLAGS_END_RE.search(message)
             if m:
-                if self.usermap.get(m.group(1).lower()):
-                    self.usermap[m.group(1).lower()]['flags'] = m.group(2)
-                else:
-                    self.usermap[m.group(1).lower()] = {"flags": m.group(2)}
-
-                if 'V' in m.group(2):
-                    self.civis_count += 1
-                if 'O' in m.group(2):
-                    self.staff_count += 1
-
-    def msg(self, message):
-        return self.notice(config.CHANNEL, message)
-
-    def count_line(self, account):
-        if self.usermap.get(account):
-            user = self.usermap[account]
-            user['last_seen'] = datetime.utcnow()
-            if user.get('lines'):
-                user['lines'] += 1
-            else:
-                user['lines'] = 1
-                user['first_seen'] = datetime.utcnow()
-                dbuser = User(name=account, lines=1,
-                              first_seen=datetime.utcnow(),
-                              last_seen=datetime.utcnow())
-                dbuser.save()
-            if (user['lines'] % 5) == 0:
-                dbuser = User.get(User.name == account)
-                dbuser.lines += 5
-                dbuser.last_seen = user['last_seen']
-                dbuser.save()
+                chan = self.governs(m.group(1))
+                if self._flags_pending:
+                    asked = self._flags_pending.popleft()[1]
+                    CHANSERV_ROUNDTRIP.observe(time.monotonic() - asked)
+                if chan is not None:
+                    await self.acl.audit(chan)
+
+    def _lane(self, target):
+        if target.lower() in SERVICES:
+            return outbound.CONTROL
+        if self.is_channel(target):
+            return outbound.ANNOUNCE
+        return outbound.REPLY
+
+    async def message(self, target, message, lane=None, key=None):
+        """ Queues a PRIVMSG; see OutboundQueue """
+        if lane is None:
+            lane = self._lane(target)
+        self.outbound.put('PRIVMSG', target, message, lane, key)
+
+    async def notice(self, target, message, lane=None, key=None):
+        """ Queues a NOTICE; see OutboundQueue """
+        if lane is None:
+            lane = self._lane(target)
+        self.outbound.put('NOTICE', target, message, lane, key)
+
+    async def _deliver(self, command, target, text):
+        if command == 'PRIVMSG':
+            await super().message(target, text)
+        elif command == 'NOTICE':
+            await super().notice(target, text)
+        elif command == 'MODE':
+            await self.rawmsg(command, target, *text.split(' '))
+        else:
+            await self.rawmsg(command, target, text)
+
+    async def msg(self, chan, message, **kwargs):
+        return await self.notice(chan.name, message, **kwargs)
+
+    def count_line(self, chan, account):
+        chan.activity.count(account)
+
+    async def get_user(self, chan, account):
+        """ Returns the User row for an account, writing out pending
+        activity first if it hasn't reached the database yet """
+        if account in chan.activity.dirty:
+            await chan.usermap.fetch(account)
+            await chan.activity.flush()
+        return await aiodb.run(User.get, (User.channel == chan.key) &
+                                         (User.name == account))
+
+    def is_enfranchised(self, chan, nick):
+        """ Whether `nick`, or another nick logged in to the same account,
+        has voice or op in the channel """
+        account = self.roster.account(nick)
+        if account is None:
+            modes = self.roster.modes(chan.name, nick)
         else:
-            user = {"first_seen": datetime.utcnow(),
-                    "last_seen": datetime.utcnow(),
-                    "lines": 1,
-                    "flags": ""}
-            dbuser = User(name=account, lines=1,
-                          first_seen=datetime.utcnow(),
-                          last_seen=datetime.utcnow())
-            dbuser.save()
-        self.usermap[account] = user
-
-    def start_vote(self, by, args):
+            modes = self.roster.privileges(chan.name, account)
+        return 'v' in modes or 'o' in modes
+
+    @staticmethod
+    def _create_election(elec, voter):
+        elec.save()
+        journal.record(journal.OPENED, elec.id, elec.opened_by.name,
+                       at=elec.opened, channel=elec.channel,
+                       vote_type=elec.vote_type, vote_target=elec.vote_target,
+                       close=elec.close)
+        if voter is not None:
+            Suffrage.create(election=elec, yea=True, emitted_by=voter)
+            journal.record(journal.CAST, elec.id, voter.name, yea=True)
+
+    async def start_vote(self, chan, by, args):
         account = self.users[by]['account'].lower()
         # 1 - Check if user has voice
-        if by not in self.channels[config.CHANNEL]['modes'].get('v', []):
-            if by not in self.channels[config.CHANNEL]['modes'].get('o', []):
-                return self.notice(by, _('Failed: You are not enfranchised.'))
+        if not self.is_enfranchised(chan, by):
+            return await self.notice(by, chan.tr('Failed: You are not enfranchised.'))
         # 2 - get vote class
-        vote = VOTE_NAMES[args[0]](self)
+        vote = VOTE_NAMES[args[0]](self, chan)
+        if vote.is_target_user and len(args) > 1 and args[1] in self.users:
+            await self.accounts.resolve(args[1])
         if not vote.get_target(args):
-            return self.notice(by, _('Failed: Target user not found or not identified.'))
-        # 3 - check if vote already exists
-        opener = User.get(User.name == account)
+            return await self.notice(by, chan.tr('Failed: Target user not found or not identified.'))
+        # Someone else opening the same vote goes first; ours then finds it
+        key = (chan.key, args[0], vote.get_target(args))
+        while key in self._opening:
+            await asyncio.shield(self._opening[key])
+        opening = self._opening[key] = asyncio.get_event_loop().create_future()
         try:
-            vote = Election.select() \
-                           .where(Election.vote_type == args[0],
+            await self._open_vote(chan, by, account, vote, args)
+        finally:
+            del self._opening[key]
+            opening.set_result(None)
+
+    async def _open_vote(self, chan, by, account, vote, args):
+        # 3 - check if vote already exists
+        opener = await self.get_user(chan, account)
+        existing = Election.select() \
+                           .where(Election.channel == chan.key,
+                                  Election.vote_type == args[0],
                                   Election.status == 0,
-                                  Election.vote_target == vote.get_target(args)).get()
+                                  Election.vote_target == vote.get_target(args))
+        existing = await aiodb.run(existing.first)
+        if existing is not None:
             # !!! vote already exists
-            return self.vote(vote, opener, by)
-        except Election.DoesNotExist:
-            pass
+            return await self.vote(existing, opener, by)
 
         # 5 - Custom vote type checks
-        if vote.vote_check(args, by) is not True:
+        if await vote.vote_check(args, by) is not True:
             print("Vote creation rejected by custom rule")
             return
 
         # 6 - Create the vote
-        elec = Election(vote_type=args[0],
+        elec = Election(channel=chan.key,
+                        vote_type=args[0],
                         opened=datetime.utcnow(),
                         close=datetime.utcnow() +
                         timedelta(seconds=vote.openfor),
                         status=0,
                         opened_by=opener,
                         vote_target=vote.get_target(args))
-        elec.save()
-        if not (vote.is_target_user and opener.name == vote.get_target(args)):
-            # 7 - Emit self vote
-            svote = Suffrage(election=elec,
-                             yea=True,
-                             emitted_by=opener)
-            svote.save()
-            # 8 - Schedule
-        self.eventloop.schedule_in(timedelta(seconds=vote.openfor),
-                                   self._closevote, elec.id)
+        # 7 - Emit self vote
+        selfvote = not (vote.is_target_user and opener.name == vote.get_target(args))
+        await aiodb.atomic(self._create_election, elec,
+                           opener if selfvote else None)
+        self.tallies.open(elec)
+        if selfvote:
+            self.tallies.cast(elec, opener.name, True)
+        # 8 - Schedule
+        self._schedule_close(elec)
         # 9 - announce
         dt = display_time(vote.openfor)
-        self.msg(_("Vote \002#{0}\002: \002{1}\002: \037{2}\037. You have "
-                   "\002{3}\002 to vote; \002{4}\002 votes are required for a "
-                   "quorum! Type or PM \002\00303!vote y {0}\003\002 or "
-                   "\002\00304!vote n {0}\003\002").format(
-                       elec.id, args[0], vote.get_target(args), dt, vote.quorum))
-
-    def _closevote(self, voteid):
-        """ Called when a vote is to be closed """
+        await self.msg(chan, chan.tr.format(
+            "Vote \002#{0}\002: \002{1}\002: \037{2}\037. You have "
+            "\002{3}\002 to vote; \002{4}\002 votes are required for a "
+            "quorum! Type or PM \002\00303!vote y {0}\003\002 or "
+            "\002\00304!vote n {0}\003\002",
+            elec.id, args[0], vote.get_target(args), dt, vote.quorum))
+
+    def _schedule_close(self, elec):
+        self.deadlines.schedule(('close', elec.id), elec.close,
+                                self._closed, elec.id,
+                                prepare=self._close_election)
+
+    def _schedule_expire(self, act):
+        self.deadlines.schedule(('expire', act.id), act.close,
+                                self._expire, act.id,
+                                prepare=self._load_effective)
+
+    @staticmethod
+    def _close_election(voteid, early=False):
+        """ Closes a vote in the database (before its time if `early`).
+        Runs on the database thread; returns the election, its tally and the
+        resulting Effective (if it passed), or None if it was already
+        closed. """
         vote = Election.get(Election.id == voteid)
-        vclass = VOTE_NAMES[vote.vote_type](self)
-        suffrages = Suffrage.select().where(Suffrage.election == vote)
-        if suffrages.count() < vclass.quorum:
-            self.msg(_("\002#{0}\002: Failed to reach quorum: \002{1}\002 of "
-                       "\002{2}\002 required votes.").format(voteid, suffrages.count(), vclass.quorum))
-            vote.status = 2  # Closed - quorum
-            vote.save()
-            return
-        yeas = 0
-        nays = 0
-        for sf in suffrages:
-            if sf.yea:
-                yeas += 1
-            else:
-                nays += 1
-        perc = int((yeas / suffrages.count()) * 100)
-        if (perc < 75 and vclass.supermajority) or (perc < 51):
-            self.msg(_("\002#{0}\002: \002{1}\002: \037{2}\037.  \002\00300,04The nays have it.\003\002 "
-                       "Yeas: \00303{3}\003. Nays: \00304{4}\003. \00304{5}\003% of approval (required at least \002{6}%)")
-                     .format(voteid, vote.vote_type, vote.vote_target, yeas, nays, perc,
-                             75 if vclass.supermajority else 51))
-            vote.status = 3  # closed - not approved
-            vote.save()
-            return
-        self.msg(_("\002#{0}\002: \002{1}\002: \037{2}\037. \002\00300,03The yeas have it.\003\002 Yeas: \00303{3}\003. Nays: \00304{4}\003. "
-                   "\00303{5}\003% of approval (required at least \002{6}%)")
-                 .format(voteid, vote.vote_type, vote.vote_target, yeas, nays, perc,
-                         75 if vclass.supermajority else 51))
-        vote.status = 1  # closed - passed
+        if vote.status != 0:
+            return None  # Already closed
+        vclass = VOTE_NAMES[vote.vote_type]
+        result = tally(vote)
+        act = None
+        # 1 - passed, 2 - no quorum, 3 - not approved
+        vote.status = vclass.outcome(result)
+        if early:
+            vote.close = datetime.utcnow()
+        if vote.status == 1:
+            act = Effective.create(channel=vote.channel,
+                                   vote_type=vote.vote_type,
+                                   close=datetime.utcnow() +
+                                   timedelta(seconds=vclass.duration),
+                                   vote_target=vote.vote_target,
+                                   election=vote)
         vote.save()
-        vclass.on_pass(vote.vote_target)
-        act = Effective(vote_type=vote.vote_type,
-                        close=datetime.utcnow() +
-                        timedelta(seconds=vclass.duration),
-                        vote_target=vote.vote_target,
-                        election=vote)
-        act.save()
-        self.eventloop.schedule_in(vclass.duration, self._expire, act.id)
-
-    def _expire(self, efid):
-        print("EEEXPIRE")
-        vote = Effective.get(Effective.id == efid)
-        vclass = VOTE_NAMES[vote.vote_type](self)
-        vclass.on_expire(vote.vote_target)
-        vote.delete_instance()
-
-    def _resolve_status(self, status):
-        if status == 0:
-            stat = _('\00301,07ACTIVE\003')
-        elif status == 1:
-            stat = _('\00300,03PASSED\003')
-        elif status == 2:
-            stat = _('\00300,04QUORUM\003')
-        elif status == 3:
-            stat = _('\00300,04FAILED\003')
-        elif status == 4:
-            stat = _('\00300,04VETOED\003')
-        else:
-            stat = _('\00300,02LIZARD\003')
-
-        return stat
-
-    def _resolve_time(self, delta, word):
-        if delta.total_seconds() > 604800:
-            ostr = _('{0} \002weeks {1}\002').format(
-                int(delta.total_seconds() / 604800), word)
-        elif delta.total_seconds() > 86400:
-            ostr = _('{0} \002days {1}\002').format(
-                int(delta.total_seconds() / 86400), word)
-        elif delta.total_seconds() > 3600:
-            ostr = _('{0} \002hours {1}\002').format(
-                int(round(delta.total_seconds() / 3600, 0)), word)
-        elif delta.total_seconds() > 60:
-            ostr = _('{0} \002minutes {1}\002').format(
-                int(round(delta.total_seconds() / 60, 0)), word)
+        if early:
+            journal.record(journal.CLOSED, vote.id, status=vote.status,
+                           close=vote.close)
         else:
-            ostr = _('{0} \002seconds {1}\002').format(
-                int(delta.total_seconds()), word)
-
-        return ostr
+            journal.record(journal.CLOSED, vote.id, status=vote.status)
+        if act is not None:
+            journal.record(journal.EFFECTIVE, vote.id, id=act.id,
+                           channel=act.channel, vote_type=act.vote_type,
+                           vote_target=act.vote_target, close=act.close)
+        return vote, result, act
+
+    async def _closevote(self, voteid, early=False):
+        """ Called when a vote is to be closed """
+        await self._closed(await aiodb.atomic(self._close_election, voteid,
+                                              early))
+
+    def electorate(self, chan):
+        """ The accounts that can vote in the channel: those with a V or O
+        flag, present or not, and whoever has voice or op right now """
+        accounts = set(account for account, record in chan.usermap.items()
+                       if any(fl in record.flags for fl in acl.ENTITLES))
+        accounts |= self.roster.holders(chan.name, 'vo')
+        accounts.discard(config.SASL_USER.lower())
+        return accounts
+
+    async def _close_if_decided(self, elec, vtype):
+        """ Closes an election of an `early_close` vote type once the
+        ballots left to cast can't change its outcome """
+        counted = self.tallies.get(elec)
+        if counted is None:
+            return
+        remaining = self.electorate(vtype.channel) - set(counted.ballots)
+        if vtype.is_target_user:
+            remaining.discard(elec.vote_target)
+        if vtype.decided(counted.tally(), len(remaining)) is None:
+            return
+        self.deadlines.cancel(('close', elec.id))
+        await self._closevote(elec.id, early=True)
 
-    def on_message(self, target, by, message):
+    async def _closed(self, closed):
+        """ Announces a vote closed by _close_election and applies it """
+        if closed is None:
+            return
+        vote, result, act = closed
+        voteid = vote.id
+        ELECTIONS_CLOSED.inc(CLOSED_STATUS.get(vote.status, 'other'))
+        self.tallies.close(vote)
+        chan = self.governs(vote.channel)
+        if chan is None:
+            return  # Not governing that channel anymore
+        vclass = VOTE_NAMES[vote.vote_type](self, chan)
+        if vote.status == 2:
+            return await self.msg(chan, chan.tr.format(
+                "\002#{0}\002: Failed to reach quorum: \002{1}\002 of "
+                "\002{2}\002 required votes.", voteid, result.total, vclass.quorum))
+        yeas, nays = result.yeas, result.nays
+        perc = result.approval
+        if vote.status == 3:
+            return await self.msg(chan, chan.tr.format(
+                "\002#{0}\002: \002{1}\002: \037{2}\037.  \002\00300,04The nays have it.\003\002 "
+                "Yeas: \00303{3}\003. Nays: \00304{4}\003. \00304{5}\003% of approval (required at least \002{6}%)",
+                voteid, vote.vote_type, vote.vote_target, yeas, nays, perc,
+                75 if vclass.supermajority else 51))
+        await self.msg(chan, chan.tr.format(
+            "\002#{0}\002: \002{1}\002: \037{2}\037. \002\00300,03The yeas have it.\003\002 Yeas: \00303{3}\003. Nays: \00304{4}\003. "
+            "\00303{5}\003% of approval (required at least \002{6}%)",
+            voteid, vote.vote_type, vote.vote_target, yeas, nays, perc,
+            75 if vclass.supermajority else 51))
+        await vclass.on_pass(vote.vote_target)
+        self._schedule_expire(act)
+
+    @staticmethod
+    def _load_effective(efid):
+        return Effective.get_or_none(Effective.id == efid)
+
+    @staticmethod
+    def _delete_effective(act):
+        journal.record(journal.EXPIRED, act.election_id, id=act.id)
+        act.delete_instance()
+
+    async def _expire(self, vote):
+        if vote is None:
+            return  # Already expired
+        EXPIRIES.inc()
+        chan = self.governs(vote.channel)
+        if chan is not None:
+            vclass = VOTE_NAMES[vote.vote_type](self, chan)
+            await vclass.on_expire(vote.vote_target)
+        await aiodb.atomic(self._delete_effective, vote)
+
+    def _resolve_status(self, status, tr=i18n.default):
+        return tr(STATUS_NAMES.get(status, '\00300,02LIZARD\003'))
+
+    def _resolve_time(self, delta, word, tr=i18n.default):
+        seconds = delta.total_seconds()
+        for unit, template in TIME_UNITS:
+            if seconds > unit:
+                # Hours and minutes are rounded, weeks and days truncated
+                count = seconds / unit
+                count = int(round(count, 0) if unit < 86400 else count)
+                return tr.format(template, count, tr(word))
+        return tr.format('{0} \002seconds {1}\002', int(seconds), tr(word))
+
+    async def on_message(self, target, by, message):
         try:
             account = self.users[by]['account']
         except KeyError:
             print("{0}: Not identified/not found".format(by))
             return
+        if not account:
+            # Maybe we just don't know yet
+            account = await self.accounts.resolve(by)
         if not account:
             return  # Unregistered users don't exist
         account = account.lower()
-        if target == config.CHANNEL:
-            self.count_line(account)
+        chan = self.governs(target)
+        if chan is not None:
+            self.count_line(chan, account)
+        elif len(self.governed) == 1:
+            # Private message; there's only one channel it can be about
+            chan = next(iter(self.governed.values()))
 
-        message = message.strip().lower()
+        if not message.lstrip().startswith('!'):
+            MESSAGES.inc('chatter')
+            return  # Just talking
 
-        if not message.startswith('!'):
+        try:
+            found = COMMANDS.parse(message)
+        except UsageError as e:
+            return await self.notice(by, str(e))
+        if found is None:
             return
-
-        command = message[1:].split()[0]
-        args = message.split()[1:]
-
-        if command == 'vote':
-            if not args:
-                return
-            args[0] = args[0].strip('#')
-            if args[0] in list(VOTE_NAMES):  # creating a vote!
-                self.start_vote(by, args)
-            elif args[0] == "list" and target == config.CHANNEL:
-                print('list ', by)
-                if by not in self.channels[config.CHANNEL]['modes'].get('v', []):
-                    if by not in self.channels[config.CHANNEL]['modes'].get('o', []):
-                        return self.notice(by, 'Failed: You are not enfranchised.')
-                vpar, unk = votelistParser.parse_known_args(args[1:])
-                if not vpar.type:
-                    votes = Election.select().where(Election.status == 0) \
-                                    .order_by(Election.id.desc()).limit(5)
-                else:
-                    if vpar.type not in list(VOTE_NAMES):
-                        return self.notice(by, 'Failed: Unknown vote type')
-                    votes = Election.select() \
-                                    .where(Election.vote_type == vpar.type) \
-                                    .order_by(Election.id.desc()).limit(10)
-                if not votes:
-                    return self.notice(by, 'No matching results.')
-                user = User.get(User.name == account)
-                for vote in votes:
-                    posit = Suffrage.select() \
-                                    .where((Suffrage.election == vote) &
-                                           (Suffrage.yea == True)).count()
-                    negat = Suffrage.select() \
-                                    .where((Suffrage.election == vote) &
-                                           (Suffrage.yea == False)).count()
-                    try:
-                        yv = Suffrage.get((Suffrage.election == vote) & (Suffrage.emitted_by == user))
-                        if yv.yea:
-                            you = '\00300,03YEA\003'
-                        else:
-                            you = '\00300,04NAY\003'
-                    except Suffrage.DoesNotExist:
-                        you = '\00300,01---\003'
-                    stat = self._resolve_status(vote.status)
-                    if vote.status == 0:
-                        tdel = vote.close - datetime.utcnow()
-                        ostr = self._resolve_time(tdel, _('left'))
-                    else:
-                        tdel = datetime.utcnow() - vote.close
-                        ostr = self._resolve_time(tdel, _('ago'))
-                    self.msg(_('\002#{0} YEA: \00303{1}\003 NAY: \00305{2}\003 '
-                               'YOU: {3} {4} {5}\002 \037{6}\037 - {7}').format(
-                                   vote.id, posit, negat, you, stat,
-                                   vote.vote_type, vote.vote_target, ostr))
-
-            elif args[0].isdigit() or args[0] in ['y', 'yes', 'n', 'no']:
-                if by not in self.channels[config.CHANNEL]['modes'].get('v', []):
-                    if by not in self.channels[config.CHANNEL]['modes'].get('o', []):
-                        return self.notice(by, 'Failed: You are not enfranchised.')
-                user = User.get(User.name == account)
-                if args[0].isdigit():
-                    if len(args) == 1:
-                        return self.vote_info(by, args[0])
-                    voteid = args[0]
-                    positive = True if args[1] in ['y', 'yes'] else False
-                else:
-                    positive = True if args[0] in ['y', 'yes'] else False
-                    if len(args) == 1:
-                        xe = Election.select().where(Election.status == 1)
-                        if xe.count() == 1:
-                            voteid = xe.get().id
-                        else:
-                            return self.notice(by, 'Failed: Usage: !vote y/n '
-                                               '<vote id>')
-                    else:
-                        voteid = args[1].strip('#')
-                        if not voteid.isdigit():
-                            self.notice(by, 'Usage: !vote y/n <vote id>')
-                            return
-                try:
-                    elec = Election.get(Election.id == voteid)
-                except Election.DoesNotExist:
-                    return self.notice(by, 'Failed: Vote not found')
-                if elec.status != 0:
-                    return self.notice(by, 'Failed: This vote already '
-                                       'ended')
-                return self.vote(elec, user, by, positive, (target != config.CHANNEL))
-
-    def vote_info(self, by, voteid):
+        MESSAGES.inc('command')
+        sub, args, options = found
+        if sub.channel_only and self.governs(target) is None:
+            return
+        ctx = Context(target, by, account, chan)
+        token = metrics.handler.set(sub.handler)
         try:
-            elec = Election.get(Election.id == voteid)
-        except Election.DoesNotExist:
-            return self.notice(by, 'Failed: Vote not found')
-        vtype = VOTE_NAMES[elec.vote_type](self)
+            with metrics.timed(COMMAND_SECONDS, sub.handler):
+                await getattr(self, sub.handler)(ctx, *args, **options)
+        finally:
+            metrics.handler.reset(token)
+
+    async def cmd_profile(self, ctx, seconds):
+        if ctx.account not in OPERATORS:
+            return
+        path = profiler.start(min(seconds, 600))
+        if path is None:
+            return await self.notice(ctx.by, 'Already profiling.')
+        await self.notice(ctx.by, 'Profiling for {0}s into {1}'
+                          .format(min(seconds, 600), path))
+
+    async def cmd_vote_start(self, ctx, vtype, target, more):
+        if ctx.chan is None:
+            return await self.notice(ctx.by, 'Failed: Start votes in the channel.')
+        await self.start_vote(ctx.chan, ctx.by, [vtype, target] + more)
+
+    async def cmd_vote_list(self, ctx, type=None):
+        chan, by = ctx.chan, ctx.by
+        if not self.is_enfranchised(chan, by):
+            return await self.notice(by, 'Failed: You are not enfranchised.')
+        if not type:
+            votes = Election.select().where((Election.channel == chan.key) &
+                                            (Election.status == 0)) \
+                            .order_by(Election.id.desc()).limit(5)
+        else:
+            if type not in VOTE_NAMES:
+                return await self.notice(by, 'Failed: Unknown vote type')
+            votes = Election.select() \
+                            .where((Election.channel == chan.key) &
+                                   (Election.vote_type == type)) \
+                            .order_by(Election.id.desc()).limit(10)
+        votes = await aiodb.run(list, votes)
+        if not votes:
+            return await self.notice(by, 'No matching results.')
+        counts = await self.tallies.tallies(votes, ctx.account, chan.key)
+        # A newer listing makes the one still waiting to be sent useless
+        key = ('list', chan.key)
+        self.outbound.discard(key)
+        for vote in votes:
+            posit, negat, mine = counts[vote.id]
+            if mine is None:
+                you = '\00300,01---\003'
+            elif mine:
+                you = '\00300,03YEA\003'
+            else:
+                you = '\00300,04NAY\003'
+            stat = self._resolve_status(vote.status, chan.tr)
+            if vote.status == 0:
+                tdel = vote.close - datetime.utcnow()
+                ostr = self._resolve_time(tdel, 'left', chan.tr)
+            else:
+                tdel = datetime.utcnow() - vote.close
+                ostr = self._resolve_time(tdel, 'ago', chan.tr)
+            await self.msg(chan, chan.tr.format(
+                '\002#{0} YEA: \00303{1}\003 NAY: \00305{2}\003 '
+                'YOU: {3} {4} {5}\002 \037{6}\037 - {7}',
+                vote.id, posit, negat, you, stat,
+                vote.vote_type, vote.vote_target, ostr),
+                lane=outbound.REPLY, key=key)
+
+    async def cmd_vote_ballot(self, ctx, positive, voteid=None):
+        """ !vote y/n [id] """
+        if voteid is None:
+            if ctx.chan is None:
+                return await self.notice(ctx.by, 'Failed: Usage: !vote y/n '
+                                         '<vote id>')
+            xe = Election.select(Election.id) \
+                         .where((Election.channel == ctx.chan.key) &
+                                (Election.status == 0)).limit(2)
+            xe = await aiodb.run(list, xe)
+            if len(xe) != 1:
+                return await self.notice(ctx.by, 'Failed: Usage: !vote y/n '
+                                         '<vote id>')
+            voteid = xe[0].id
+        await self.cmd_vote_id(ctx, voteid, positive)
+
+    async def cmd_vote_id(self, ctx, voteid, positive=None):
+        """ !vote <id> [y/n]. Shows the vote if there's no ballot. """
+        by = ctx.by
+        elec = await aiodb.run(Election.get_or_none, Election.id == voteid)
+        archived = None
+        if elec is None:
+            archived = await aiodb.run(archive.find, voteid)
+            if archived is None:
+                return await self.notice(by, 'Failed: Vote not found')
+            elec, archived = archived[0], archived[1:]
+        # Votes belong to the channel they were started in
+        chan = self.governs(elec.channel)
+        if chan is None or not self.is_enfranchised(chan, by):
+            return await self.notice(by, 'Failed: You are not enfranchised.')
+        if positive is None:
+            return await self.vote_info(by, elec, archived)
+        if elec.status != 0:
+            return await self.notice(by, 'Failed: This vote already '
+                                     'ended')
+        user = await self.get_user(chan, ctx.account)
+        return await self.vote(elec, user, by, positive, (ctx.target != chan.name))
+
+    async def vote_info(self, by, elec, archived=None):
+        """ Shows a vote. `archived` is the tally, yeas and nays of an
+        archived one. """
+        chan = self.governs(elec.channel)
+        vtype = VOTE_NAMES[elec.vote_type](self, chan)
+        key = ('info', by, elec.id)
+        self.outbound.discard(key)
 
         if elec.status == 0:
             tdel = elec.close - datetime.utcnow()
-            ostr = self._resolve_time(tdel, 'left')
+            ostr = self._resolve_time(tdel, 'left', chan.tr)
         else:
             tdel = datetime.utcnow() - elec.close
-            ostr = self._resolve_time(tdel, 'ago')
-        self.notice(by, "Information on vote #{0}: \002{1}\002 ({2})".format(
-                        elec.id, self._resolve_status(elec.status), ostr))
-
-        votes = Suffrage.select().where(Suffrage.election == elec)
-        yeacount = 0
-        yeas = ""
-        naycount = 0
-        nays = ""
-        for vot in votes:
-            if vot.yea:
-                yeacount += 1
-                yeas += vot.emitted_by.name + " "
-            else:
-                naycount += 1
-                nays += vot.emitted_by.name + " "
-
-        votecount = yeacount + naycount
-        perc = int((yeacount / votecount)*100) if votecount != 0 else 0
+            ostr = self._resolve_time(tdel, 'ago', chan.tr)
+        await self.notice(by, "Information on vote #{0}: \002{1}\002 ({2})".format(
+                              elec.id, self._resolve_status(elec.status, chan.tr), ostr), key=key)
+
+        cached = self.tallies.get(elec)
+        if cached is not None:
+            result = cached.tally()
+            yeas, nays = cached.voters()
+        elif archived is not None:
+            result, yeas, nays = archived
+        else:
+            result, yeas, nays = await aiodb.run(ballots, elec)
+        yeacount = result.yeas
+        naycount = result.nays
+        yeas = " ".join(yeas)
+        nays = " ".join(nays)
+        votecount = result.total
+        perc = result.approval
         percneeded = 75 if vtype.supermajority else 50
         if elec.status == 1:
-            try:
-                eff = Effective.get(Effective.election == elec)
+            eff = await aiodb.run(Effective.get_or_none, Effective.election == elec)
+            if eff is not None:
                 tdel = eff.close - datetime.utcnow()
-                ostr = self._resolve_time(tdel, 'left')
-                self.notice(by, " - \002\00303ACTIVE\003\002 {0}".format(ostr))
-            except Effective.DoesNotExist:
-                self.notice(by, " - \002\00304NOT EFFECTIVE ANYMORE\003\002 (expired)")
-                pass
+                ostr = self._resolve_time(tdel, 'left', chan.tr)
+                await self.notice(by, " - \002\00303ACTIVE\003\002 {0}".format(ostr), key=key)
+            else:
+                await self.notice(by, " - \002\00304NOT EFFECTIVE ANYMORE\003\002 (expired)", key=key)
         elif elec.status == 0:
             if votecount < vtype.quorum:
-                self.notice(by, " - \002\00307Needs {0} more votes for quorum\002".format(vtype.quorum-votecount))
+                await self.notice(by, " - \002\00307Needs {0} more votes for quorum\002".format(vtype.quorum-votecount), key=key)
             else:
                 if perc < percneeded:
-                    self.notice(by, " - \002\00304Motion is not passing ({0}% of approval, needs {1}%)\002".format(perc, percneeded))
+                    await self.notice(by, " - \002\00304Motion is not passing ({0}% of approval, needs {1}%)\002".format(perc, percneeded), key=key)
                 else:
-                    self.notice(by, " - \002\00303Motion is passing ({0}% of approval, needs {1}%)\002".format(perc, percneeded))
+                    await self.notice(by, " - \002\00303Motion is passing ({0}% of approval, needs {1}%)\002".format(perc, percneeded), key=key)
 
         if yeacount == 0:
             yeas = " - "
         if naycount == 0:
             nays = " - "
 
-        self.notice(by, " - \002\00303YEA\003\002 - \002{0}\002: {1}".format(yeacount, yeas))
-        self.notice(by, " - \002\00304NAY\003\002 - \002{0}\002: {1}".format(naycount, nays))
-
-    def vote(self, elec, user, by, positive=True, doAnn=False):
-        vtype = VOTE_NAMES[elec.vote_type](self)
+        await self.notice(by, " - \002\00303YEA\003\002 - \002{0}\002: {1}".format(yeacount, yeas), key=key)
+        await self.notice(by, " - \002\00304NAY\003\002 - \002{0}\002: {1}".format(naycount, nays), key=key)
+
+    @staticmethod
+    def _cast(elec, user, yea, changed):
+        """ Writes a ballot, unless the election closed. Returns whether it
+        did. """
+        open_ = Election.select().where((Election.id == elec) &
+                                        (Election.status == 0))
+        if not open_.exists():
+            return False
+        Suffrage.insert(election=elec, emitted_by=user, yea=yea) \
+                .on_conflict(conflict_target=[Suffrage.election,
+                                              Suffrage.emitted_by],
+                             preserve=[Suffrage.yea]) \
+                .execute()
+        journal.record(journal.CHANGED if changed else journal.CAST, elec,
+                       user.name, yea=yea)
+        return True
+
+    async def vote(self, elec, user, by, positive=True, doAnn=False):
+        chan = self.governs(elec.channel)
+        vtype = VOTE_NAMES[elec.vote_type](self, chan)
         if vtype.is_target_user and user.name == elec.vote_target:
-            return self.notice(by, 'Failed: You can\'t vote for yourself')
+            return await self.notice(by, 'Failed: You can\'t vote for yourself')
+        if self.tallies.get(elec) is None:
+            # Closed since it was read
+            return await self.notice(by, 'Failed: This vote already ended')
+        # Counted before writing, so a second ballot from the same user
+        # arriving meanwhile sees this one.
+        previous = self.tallies.cast(elec, user.name, positive)
+        if previous == positive:
+            return await self.notice(by, 'Failed: You have already voted on'
+                                     ' \002#{0}\002'.format(elec.id))
+        if previous is not None and vtype.early_close:
+            # It may have been closed early counting on it
+            self.tallies.uncast(elec, user.name, previous)
+            return await self.notice(by, 'Failed: Votes on \002#{0}\002 can\'t '
+                                     'be changed'.format(elec.id))
         try:
-            svote = Suffrage.get(Suffrage.emitted_by == user,
-                                 Suffrage.election == elec)
-            if svote.yea == positive:
-                self.notice(by, 'Failed: You have already voted on'
-                            ' \002#{0}\002'.format(elec.id))
-                return
-            self.notice(by, 'You have changed your vote on '
-                        '\002#{0}\002'.format(elec.id))
-            if doAnn:
-                self.msg('{0} changed their vote in #\002{2}\002 (now is \002{1}\002)'.format(user.name, '\00303YEA\003' if positive else '\00304NAY\003', elec.id))
-        except Suffrage.DoesNotExist:
-            svote = Suffrage(election=elec,
-                             emitted_by=user)
+            cast = await aiodb.atomic(self._cast, elec.id, user, positive,
+                                      previous is not None)
+        except Exception:
+            self.tallies.uncast(elec, user.name, previous)
+            raise
+        if not cast:
+            self.tallies.uncast(elec, user.name, previous)
+            return await self.notice(by, 'Failed: This vote already ended')
+        if previous is not None:
+            await self.notice(by, 'You have changed your vote on '
+                              '\002#{0}\002'.format(elec.id))
             if doAnn:
-                self.msg('{0} voted \002{1}\002 in #\002{2}\002'.format(user.name, '\00303YEA\003' if positive else '\00304NAY\003', elec.id))
-            self.notice(by, 'Thanks for casting your vote in '
-                        '\002#{0}\002'.format(elec.id))
-        svote.yea = positive
-        svote.save()
-
-    def _rename_user(self, user, new):
-        if user in self.users:
-            self.users[new] = copy.copy(self.users[user])
-            self.users[new]['nickname'] = new
-            del self.users[user]
+                await self.msg(chan, '{0} changed their vote in #\002{2}\002 (now is \002{1}\002)'.format(user.name, '\00303YEA\003' if positive else '\00304NAY\003', elec.id))
         else:
-            self._create_user(new)
-            if new not in self.users:
-                return
-
-        for ch in self.channels.values():
-            # Rename user in channel list.
-            if user in ch['users']:
-                ch['users'].discard(user)
-                ch['users'].add(new)
-
-
-client = Kontroler('Kontroler',
-                   sasl_username=config.SASL_USER,
-                   sasl_password=config.SASL_PASS)
-client.connect(config.IRC_SERVER, tls=True)
-try:
-    client.handle_forever()
-except KeyboardInterrupt:
-    print("Saving all our stuff...")
-    for usr in client.usermap:
-        uinfo = client.usermap[usr]
-        if not uinfo.get('lines'):
-            continue
-        try:
-            user = User.get(User.name == usr)
-            user.lines = uinfo['lines']
-            user.last_seen = uinfo['last_seen']
-        except User.DoesNotExist:
-            user = User(name=usr, lines=uinfo['lines'],
-                        first_seen=uinfo['first_seen'],
-                        last_seen=uinfo['last_seen'])
-        user.save()
+            if doAnn:
+                await self.msg(chan, '{0} voted \002{1}\002 in #\002{2}\002'.format(user.name, '\00303YEA\003' if positive else '\00304NAY\003', elec.id))
+            await self.notice(by, 'Thanks for casting your vote in '
+                              '\002#{0}\002'.format(elec.id))
+        if vtype.early_close:
+            await self._close_if_decided(elec, vtype)
+
+
+if __name__ == '__main__':
+    profiler.install_signal(getattr(config, 'PROFILE_SECONDS', 30))
+    client = Kontroler('Kontroler',
+                       sasl_username=config.SASL_USER,
+                       sasl_password=config.SASL_PASS)
+    try:
+        client.run(config.IRC_SERVER, tls=True)
+    finally:
+        print("Saving all our stuff...")
+        aiodb.shutdown()
+        for chan in client.governed.values():
+            chan.activity.save()
@@ -0,0 +1,130 @@
+""" Command table for `!command subcommand args...` lines.
+
+Every subcommand declares the types of its arguments, so a line is split
+and converted once, and the bot only has to call the matched handler.
+The table itself is built in bot.py, next to the handlers. """
+
+import collections
+
+
+# What a handler gets besides its arguments. `chan` is the ChannelState the
+# line is about: the channel it was said in, or the only one we govern for
+# private messages (None otherwise).
+Context = collections.namedtuple('Context', 'target by account chan')
+
+
+class UsageError(Exception):
+    """ The line matched a command but its arguments are wrong. The
+    message is meant for the user. """
+
+
+def vote_id(word):
+    word = word.lstrip('#')
+    if not word.isdigit():
+        raise ValueError(word)
+    return int(word)
+
+
+def ballot(word):
+    """ True for yea. Anything that isn't a yes is a nay. """
+    return word in ('y', 'yes')
+
+
+def rest(words):
+    """ Marker type: takes all the remaining words, as a list """
+    return words
+
+
+class Subcommand(object):
+    __slots__ = ('handler', 'args', 'optional', 'options', 'word',
+                 'channel_only', 'usage')
+
+    def __init__(self, handler, args=(), optional=(), options=None,
+                 word=None, channel_only=False, usage=None):
+        self.handler = handler  # name of a Kontroler method
+        self.args = tuple(args)  # types of the required arguments
+        self.optional = tuple(optional)  # types of optional trailing ones
+        self.options = options or {}  # {"--flag": type}
+        self.word = word  # type of the subcommand word, if it's passed on
+        self.channel_only = channel_only  # ignored outside of a channel
+        self.usage = usage
+
+    def parse(self, word, words):
+        values = [] if self.word is None else [self.word(word)]
+        options = {}
+        positional = []
+        it = iter(words)
+        for w in it:
+            if w in self.options:
+                value = next(it, None)
+                if value is None:
+                    raise UsageError(self.usage)
+                options[w.lstrip('-')] = self.options[w](value)
+            elif not (self.options and w.startswith('--')):
+                positional.append(w)
+
+        types = self.args + self.optional
+        if len(positional) < len(self.args):
+            raise UsageError(self.usage)
+        try:
+            for i, kind in enumerate(types):
+                if kind is rest:
+                    values.append(positional[i:])
+                    break
+                if i >= len(positional):
+                    break
+                values.append(kind(positional[i]))
+        except ValueError:
+            raise UsageError(self.usage)
+        return values, options
+
+
+class Command(object):
+    """ A `!name` command. Subcommands are looked up by their first word;
+    `numeric` handles lines whose first word is a vote id instead. """
+
+    def __init__(self, name):
+        self.name = name
+        self.subcommands = {}
+        self.numeric = None
+
+    def add(self, words, handler, **kwargs):
+        sub = Subcommand(handler, **kwargs)
+        for word in words:
+            self.subcommands[word] = sub
+        return sub
+
+    def add_numeric(self, handler, **kwargs):
+        self.numeric = Subcommand(handler, **kwargs)
+        return self.numeric
+
+    def match(self, words):
+        if not words:
+            return None
+        word = words[0].strip('#')
+        sub = self.subcommands.get(word)
+        if sub is not None:
+            return (sub,) + sub.parse(word, words[1:])
+        if self.numeric is not None and word.isdigit():
+            return (self.numeric,) + self.numeric.parse(None, words)
+        return None
+
+
+class CommandTable(object):
+    def __init__(self, prefix='!'):
+        self.prefix = prefix
+        self.commands = {}
+
+    def command(self, name):
+        return self.commands.setdefault(name, Command(name))
+
+    def parse(self, message):
+        """ Returns (Subcommand, [values], {options}) for a command line, or
+        None if the line isn't one. Raises UsageError. """
+        words = message.lower().split()
+        if not words or not words[0].startswith(self.prefix):
+            return None
+        command = self.commands.get(words[0][len(self.prefix):])
+        if command is None:
+            return None
+        return command.match(words[1:])
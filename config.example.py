@@ -5,3 +5,100 @@ SASL_USER = 'SPQH'
 SASL_PASS = '...'
 
 LANG = False  # If true, point to a file in i18n/
+
+# Languages of specific channels, when they differ from LANG, e.g.
+# {'#canal': 'es'}. Run `python3 i18n.py` to compile the catalogs.
+LOCALES = {}
+
+# Seconds between activity (line count) writes to the database. This is also
+# the most activity that can be lost if the bot crashes.
+ACTIVITY_FLUSH_INTERVAL = 60
+
+# Channels to govern. Each one gets its own users, elections and flags.
+# Defaults to [CHANNEL].
+CHANNELS = [CHANNEL]
+
+# Outgoing flood control: lines per second, and how many can be sent at once
+# after being idle. Queued replies to the same target are packed into lines
+# of up to OUTBOUND_LINE_LENGTH bytes; past OUTBOUND_BACKLOG waiting replies
+# the oldest are dropped.
+OUTBOUND_RATE = 1.0
+OUTBOUND_BURST = 5
+OUTBOUND_LINE_LENGTH = 400
+OUTBOUND_BACKLOG = 50
+
+# Accounts of joining nicks are looked up (unless the server has
+# extended-join) in batches: the lookups needed within ACCOUNT_BATCH_DELAY
+# seconds go out together, as a single WHO of the channel if
+# ACCOUNT_WHO_CHANNEL or more joined the same one. Accounts of nicks that
+# left are remembered for ACCOUNT_CACHE_TTL seconds, for netsplits.
+ACCOUNT_BATCH_DELAY = 0.5
+ACCOUNT_WHO_CHANNEL = 5
+ACCOUNT_CACHE_TTL = 600
+
+# Seconds between full audits of each channel's ChanServ access list. Flag
+# changes ChanServ notifies us about are checked as they happen.
+ACL_AUDIT_INTERVAL = 3600
+
+# Accounts kept in memory per channel (roughly 200 bytes each). Accounts
+# with flags or unsaved activity are always kept; others are read back from
+# the database when needed. Only accounts seen in the last
+# USERMAP_PRELOAD_DAYS are loaded at startup.
+USERMAP_CAPACITY = 20000
+USERMAP_PRELOAD_DAYS = 30
+
+# Days of lines per day kept for every account (2 bytes a day), for the
+# recent activity vote types require. No vote looks further back than 28.
+ACTIVITY_WINDOW_DAYS = 28
+
+# Metrics in the Prometheus text format: served over HTTP on
+# METRICS_LISTEN, e.g. ('127.0.0.1', 9105), and/or written every
+# METRICS_TEXTFILE_INTERVAL seconds to METRICS_TEXTFILE for node_exporter's
+# textfile collector. Both are off by default.
+METRICS_LISTEN = None
+METRICS_TEXTFILE = None
+METRICS_TEXTFILE_INTERVAL = 15
+
+# Bans are lifted BAN_LIFETIME seconds after they're set. The ban list is
+# followed through MODE changes; it's only fetched again from the server
+# every BAN_RESYNC_INTERVAL seconds, in case we missed some.
+BAN_LIFETIME = 86400
+BAN_RESYNC_INTERVAL = 21600
+
+# The SQLite database: a file, or ':memory:' to keep nothing (tests and
+# benchmarks). DATABASE_PRAGMAS are set on every connection; WAL lets
+# readers like reports work while the bot writes. Connections wait up to
+# DATABASE_TIMEOUT seconds for another one's lock. With DATABASE_POOL > 0,
+# threads share a pool of up to that many connections.
+DATABASE = 'users.db'
+DATABASE_PRAGMAS = {'journal_mode': 'wal',
+                    'synchronous': 'normal',
+                    'cache_size': -16000,  # KiB
+                    'mmap_size': 64 * 2 ** 20}
+DATABASE_TIMEOUT = 5
+DATABASE_POOL = 0
+
+# Seconds between snapshots of the event journal. Startup only replays the
+# events after the latest one; `python3 journal.py rebuild` rebuilds the
+# election tables from the whole journal.
+JOURNAL_SNAPSHOT_INTERVAL = 3600
+
+# Closed elections are moved to monthly files in ARCHIVE_DIR once they're
+# ARCHIVE_AFTER_DAYS old (or at least as old as the longest cooldown), once
+# a day. `!vote <id>` still finds them. None keeps everything.
+ARCHIVE_AFTER_DAYS = 180
+ARCHIVE_DIR = 'archive'
+
+# Database statements taking longer than this many milliseconds are logged,
+# with the handler they ran for. None turns it off.
+SLOW_QUERY_MS = 250
+
+# Accounts that may use maintenance commands, like `!profile <seconds>`.
+OPERATORS = []
+
+# Profiling, with !profile or by sending the bot SIGUSR1 (which profiles for
+# PROFILE_SECONDS): stacks are sampled PROFILE_RATE times per second and
+# written to PROFILE_DIR as profile-<time>.folded, for flamegraph.pl.
+PROFILE_SECONDS = 30
+PROFILE_RATE = 100
+PROFILE_DIR = '.'
@@ -1,11 +1,98 @@
-import config
+""" Translations. Catalogs are the JSON files in i18n/; running this file
+compiles them into .cat files (marshal), which load much faster and are
+used when they're up to date. Nothing is read until a string of that
+language is first translated.
+
+    python3 i18n.py """
+
+import os
 import json
+import marshal
+import config
+
+DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'i18n')
+
+
+def _source(lang):
+    return os.path.join(DIR, '{0}.json'.format(lang))
+
+
+def _compiled(lang):
+    return os.path.join(DIR, '{0}.cat'.format(lang))
+
+
+def compile_catalog(lang):
+    with open(_source(lang), encoding='utf-8') as f:
+        catalog = json.load(f)
+    with open(_compiled(lang), 'wb') as f:
+        marshal.dump(catalog, f)
+    return len(catalog)
+
+
+def load_catalog(lang):
+    """ Returns {string: translation}, from the compiled catalog if it's
+    not older than the JSON one """
+    source, compiled = _source(lang), _compiled(lang)
+    try:
+        if os.path.getmtime(compiled) >= os.path.getmtime(source):
+            with open(compiled, 'rb') as f:
+                return marshal.load(f)
+    except (OSError, EOFError, ValueError, TypeError):
+        pass
+    with open(source, encoding='utf-8') as f:
+        return json.load(f)
+
+
+class Translator(object):
+    """ Translates strings to a language (English, the source strings, if
+    it's falsy). Translations and their bound `format` methods are cached,
+    so each string is looked up in the catalog once. """
+    __slots__ = ('lang', '_strings', '_formats', '_catalog')
+
+    def __init__(self, lang):
+        self.lang = lang
+        self._strings = {}
+        self._formats = {}
+        self._catalog = None
+
+    @property
+    def catalog(self):
+        if self._catalog is None:
+            self._catalog = load_catalog(self.lang) if self.lang else {}
+        return self._catalog
+
+    def __call__(self, string):
+        try:
+            return self._strings[string]
+        except KeyError:
+            translated = self._strings[string] = self.catalog.get(string, string)
+            return translated
+
+    def format(self, string, *args, **kwargs):
+        """ Same as `self(string).format(*args, **kwargs)` """
+        try:
+            formatter = self._formats[string]
+        except KeyError:
+            formatter = self._formats[string] = self(string).format
+        return formatter(*args, **kwargs)
+
+
+_translators = {}
+
+
+def translator(lang):
+    """ The shared Translator for `lang` """
+    if lang not in _translators:
+        _translators[lang] = Translator(lang)
+    return _translators[lang]
+
 
-langfile = json.load(open('i18n/{0}.json'.format(config.LANG)))
+default = translator(config.LANG)
+_ = default
 
 
-def _(string):
-    if config.LANG is False:
-        return string
-    else:
-        return langfile.get(string, string)
+if __name__ == '__main__':
+    for name in sorted(os.listdir(DIR)):
+        if name.endswith('.json'):
+            lang = name[:-len('.json')]
+            print("{0}: {1} strings".format(lang, compile_catalog(lang)))
@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+""" Append-only journal of what happens to elections.
+
+The tables only say how things are now: statuses are overwritten, ballots
+flipped and expired actions deleted. Every change to them also appends an
+Event, in the same transaction, so the journal keeps the whole history.
+
+A snapshot is the State (open elections with their ballots, actions in
+effect) as of some event; startup reads the latest one and replays only
+the events after it. Running this file rebuilds the tables from the
+journal, or takes a snapshot:
+
+    python3 journal.py rebuild|snapshot """
+
+import sys
+import json
+from datetime import datetime
+from models import db, User, Election, Suffrage, Effective, Event, Snapshot, \
+    Archived
+
+OPENED = 'opened'  # account opened it; channel, vote_type, vote_target, close
+CAST = 'cast'  # account voted; yea
+CHANGED = 'changed'  # account changed their ballot; yea
+CLOSED = 'closed'  # status; close, if it closed early
+EFFECTIVE = 'effective'  # id, channel, vote_type, vote_target, close
+EXPIRED = 'expired'  # id
+
+SNAPSHOTS_KEPT = 2
+
+
+def record(kind, election, account=None, at=None, **data):
+    """ Appends an event. Call it on the database thread, inside the
+    transaction making the change. """
+    Event.insert(at=at or datetime.utcnow(), kind=kind, election=election,
+                 account=account,
+                 data=json.dumps(data, default=str) if data else None) \
+         .execute()
+
+
+def _time(value):
+    return datetime.fromisoformat(value) if isinstance(value, str) else value
+
+
+class State(object):
+    """ Elections and actions in effect, as of event number `event`. With
+    `history`, closed elections (and their ballots) are kept too. """
+
+    def __init__(self, event=0, elections=None, effective=None,
+                 history=False):
+        self.event = event
+        # {election id: {"opened_by", "opened", "channel", "vote_type",
+        #                "vote_target", "close", "status", "ballots"}}
+        self.elections = elections or {}
+        # {effective id: {"election", "channel", "vote_type",
+        #                 "vote_target", "close"}}
+        self.effective = effective or {}
+        self.history = history
+
+    def apply(self, event, at, kind, election, account, data):
+        self.event = event
+        data = json.loads(data) if data else {}
+        if kind == OPENED:
+            data.update(opened_by=account, opened=str(at), status=0,
+                        ballots={})
+            self.elections[election] = data
+        elif kind in (CAST, CHANGED):
+            elec = self.elections.get(election)
+            if elec is not None:
+                elec['ballots'][account] = data['yea']
+        elif kind == CLOSED:
+            if self.history and election in self.elections:
+                # Closed early, if there's a close
+                self.elections[election].update(data)
+            else:
+                self.elections.pop(election, None)
+        elif kind == EFFECTIVE:
+            data['election'] = election
+            self.effective[data.pop('id')] = data
+        elif kind == EXPIRED:
+            self.effective.pop(data['id'], None)
+
+    def replay(self):
+        """ Applies the events that came after the state's """
+        events = Event.select(Event.id, Event.at, Event.kind, Event.election,
+                              Event.account, Event.data) \
+                      .where(Event.id > self.event) \
+                      .order_by(Event.id) \
+                      .tuples()
+        for row in events.iterator():
+            self.apply(*row)
+        return self
+
+    def dump(self):
+        return json.dumps({'elections': self.elections,
+                           'effective': self.effective})
+
+    @classmethod
+    def load(cls, event, text):
+        data = json.loads(text)
+        # JSON object keys are strings
+        return cls(event,
+                   dict((int(k), v) for k, v in data['elections'].items()),
+                   dict((int(k), v) for k, v in data['effective'].items()))
+
+
+def recover():
+    """ The current State: the latest snapshot and the events after it """
+    latest = Snapshot.select().order_by(Snapshot.event.desc()).first()
+    state = State() if latest is None else State.load(latest.event, latest.data)
+    return state.replay()
+
+
+def snapshot():
+    """ Stores the current State if there were events since the latest
+    snapshot, and drops the older ones. Returns the State. """
+    latest = Snapshot.select(Snapshot.event).order_by(Snapshot.event.desc()) \
+                     .first()
+    state = recover()
+    if latest is None or state.event > latest.event:
+        Snapshot.create(event=state.event, taken=datetime.utcnow(),
+                        data=state.dump())
+        kept = Snapshot.select(Snapshot.id).order_by(Snapshot.event.desc()) \
+                       .limit(SNAPSHOTS_KEPT)
+        Snapshot.delete().where(Snapshot.id.not_in(kept)).execute()
+    return state
+
+
+def rebuild():
+    """ Replaces the elections, ballots and actions in effect with what the
+    journal says, leaving out archived elections. Accounts that are gone
+    get an empty User row. """
+    state = State(history=True).replay()
+    for (elec,) in Archived.select(Archived.election).tuples():
+        state.elections.pop(elec, None)
+    users = {}
+
+    def user(channel, name, seen):
+        key = (channel, name)
+        if key not in users:
+            users[key] = User.get_or_create(
+                channel=channel, name=name,
+                defaults={'first_seen': seen, 'last_seen': seen,
+                          'lines': 0})[0].id
+        return users[key]
+
+    with db.atomic():
+        for model in (Suffrage, Effective, Election):
+            model.delete().execute()
+        for elec_id, elec in sorted(state.elections.items()):
+            opened = _time(elec['opened'])
+            Election.insert(id=elec_id, channel=elec['channel'],
+                            vote_type=elec['vote_type'],
+                            vote_target=elec['vote_target'],
+                            opened=opened, close=_time(elec['close']),
+                            status=elec['status'],
+                            opened_by=user(elec['channel'], elec['opened_by'],
+                                           opened)).execute()
+            rows = [{'election': elec_id, 'yea': yea,
+                     'emitted_by': user(elec['channel'], name, opened)}
+                    for name, yea in elec['ballots'].items()]
+            for i in range(0, len(rows), 500):
+                Suffrage.insert_many(rows[i:i + 500]).execute()
+        for act_id, act in sorted(state.effective.items()):
+            Effective.insert(id=act_id, election=act['election'],
+                             channel=act['channel'],
+                             vote_type=act['vote_type'],
+                             vote_target=act['vote_target'],
+                             close=_time(act['close'])).execute()
+    return state
+
+
+if __name__ == '__main__':
+    if sys.argv[1:] == ['rebuild']:
+        state = rebuild()
+        print("Rebuilt {0} elections and {1} actions in effect from {2} "
+              "events".format(len(state.elections), len(state.effective),
+                              state.event))
+    elif sys.argv[1:] == ['snapshot']:
+        state = snapshot()
+        print("Snapshot at event {0}: {1} open elections, {2} actions in "
+              "effect".format(state.event, len(state.elections),
+                              len(state.effective)))
+    else:
+        sys.exit(__doc__.strip().splitlines()[-1].strip())
@@ -0,0 +1,183 @@
+""" Counters, gauges and histograms about the bot, in the Prometheus text
+format. They're plain dicts and lists, cheap enough to always keep;
+rendering only happens when they're scraped (`serve`) or written out
+(`write_textfile`). """
+
+import os
+import time
+import bisect
+import asyncio
+import contextvars
+
+# What the bot is busy with (a command handler, a periodic job...), so
+# database work can be attributed to it
+handler = contextvars.ContextVar('handler', default='other')
+
+LATENCY_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5,
+                   1, 2.5, 5, 10)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"') \
+                     .replace('\n', '\\n')
+
+
+def _labels(names, values, extra=''):
+    pairs = ['{0}="{1}"'.format(n, _escape(v)) for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Metric(object):
+    kind = 'untyped'
+
+    def __init__(self, name, doc, labels=()):
+        self.name = name
+        self.doc = doc
+        self.labels = tuple(labels)
+
+    def samples(self):
+        """ Yields (suffix, labels, value) """
+        return ()
+
+    def render(self):
+        lines = ['# HELP {0} {1}'.format(self.name, self.doc),
+                 '# TYPE {0} {1}'.format(self.name, self.kind)]
+        for suffix, labels, value in self.samples():
+            lines.append('{0}{1}{2} {3}'.format(self.name, suffix, labels,
+                                                repr(float(value))))
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def __init__(self, name, doc, labels=()):
+        super().__init__(name, doc, labels)
+        self.values = {}
+
+    def inc(self, *labels, amount=1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self):
+        for labels, value in list(self.values.items()):
+            yield '', _labels(self.labels, labels), value
+
+
+class Gauge(Metric):
+    """ Its value is read from `func` when rendered: a number, or a dict
+    of {label values tuple: number} if the gauge has labels. Use
+    kind='counter' for values that only go up. """
+
+    def __init__(self, name, doc, func, labels=(), kind='gauge'):
+        super().__init__(name, doc, labels)
+        self.func = func
+        self.kind = kind
+
+    def samples(self):
+        value = self.func()
+        if not self.labels:
+            yield '', '', value
+            return
+        for labels, v in list(value.items()):
+            yield '', _labels(self.labels, labels), v
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, doc, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, doc, labels)
+        self.buckets = tuple(buckets)
+        self.values = {}  # {labels: [count per bucket..., +Inf, sum]}
+
+    def observe(self, value, *labels):
+        counts = self.values.get(labels)
+        if counts is None:
+            counts = self.values[labels] = [0] * (len(self.buckets) + 2)
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def samples(self):
+        for labels, counts in list(self.values.items()):
+            counts = list(counts)
+            total = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                total += count
+                yield '_bucket', _labels(self.labels, labels,
+                                         'le="{0}"'.format(bound)), total
+            yield '_sum', _labels(self.labels, labels), counts[-1]
+            yield '_count', _labels(self.labels, labels), total
+
+
+class Registry(object):
+    def __init__(self):
+        self.metrics = {}
+
+    def register(self, metric):
+        # Replacing by name, so a new Kontroler can take over the gauges
+        self.metrics[metric.name] = metric
+        return metric
+
+    def render(self):
+        return '\n'.join(m.render() for m in self.metrics.values()) + '\n'
+
+
+REGISTRY = Registry()
+
+
+def counter(name, doc, labels=()):
+    return REGISTRY.register(Counter(name, doc, labels))
+
+
+def gauge(name, doc, func, labels=(), kind='gauge'):
+    return REGISTRY.register(Gauge(name, doc, func, labels, kind))
+
+
+def histogram(name, doc, labels=(), buckets=LATENCY_BUCKETS):
+    return REGISTRY.register(Histogram(name, doc, labels, buckets))
+
+
+class timed(object):
+    """ `with timed(histogram, *labels):` observes how long the block took """
+    __slots__ = ('histogram', 'labels', 'start')
+
+    def __init__(self, histogram, *labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, *self.labels)
+
+
+async def _respond(reader, writer):
+    try:
+        await reader.readuntil(b'\r\n\r\n')
+        body = REGISTRY.render().encode('utf-8')
+        writer.write(b'HTTP/1.0 200 OK\r\n'
+                     b'Content-Type: text/plain; version=0.0.4\r\n'
+                     b'Content-Length: ' + str(len(body)).encode() +
+                     b'\r\n\r\n' + body)
+        await writer.drain()
+    except (asyncio.IncompleteReadError, asyncio.LimitOverrunError,
+            ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+async def serve(host, port):
+    """ Answers every HTTP request on host:port with the metrics """
+    return await asyncio.start_server(_respond, host, port)
+
+
+def write_textfile(path):
+    """ Writes the metrics for node_exporter's textfile collector """
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        f.write(REGISTRY.render())
+    os.replace(tmp, path)
@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+""" Versioned schema migrations for users.db.
+
+The schema version is kept in SQLite's `user_version` pragma. Fresh
+databases are created straight at the latest version; existing ones get
+every pending migration applied in order, each one in its own transaction.
+Running this file upgrades the database in place. """
+
+
+def _merge_duplicate_users(db):
+    dupes = db.execute_sql('SELECT name, MIN(id) FROM "user" GROUP BY name '
+                           'HAVING COUNT(*) > 1').fetchall()
+    for name, keep in dupes:
+        db.execute_sql('UPDATE "user" SET '
+                       'lines = (SELECT SUM(lines) FROM "user" WHERE name = ?), '
+                       'first_seen = (SELECT MIN(first_seen) FROM "user" WHERE name = ?), '
+                       'last_seen = (SELECT MAX(last_seen) FROM "user" WHERE name = ?) '
+                       'WHERE id = ?', (name, name, name, keep))
+        others = 'SELECT id FROM "user" WHERE name = ? AND id != ?'
+        db.execute_sql('UPDATE "election" SET opened_by_id = ? WHERE '
+                       'opened_by_id IN ({0})'.format(others), (keep, name, keep))
+        db.execute_sql('UPDATE "suffrage" SET emitted_by_id = ? WHERE '
+                       'emitted_by_id IN ({0})'.format(others), (keep, name, keep))
+        db.execute_sql('DELETE FROM "user" WHERE name = ? AND id != ?',
+                       (name, keep))
+
+
+def _v1_indexes(db):
+    """ Unique users and ballots, indexes for the hot lookups """
+    _merge_duplicate_users(db)
+    # Keep only the latest ballot of anybody who voted twice
+    db.execute_sql('DELETE FROM "suffrage" WHERE id NOT IN '
+                   '(SELECT MAX(id) FROM "suffrage" '
+                   'GROUP BY election_id, emitted_by_id)')
+    db.execute_sql('CREATE UNIQUE INDEX IF NOT EXISTS "user_name" '
+                   'ON "user" ("name")')
+    db.execute_sql('CREATE INDEX IF NOT EXISTS '
+                   '"election_vote_type_status_vote_target" ON "election" '
+                   '("vote_type", "status", "vote_target")')
+    db.execute_sql('CREATE UNIQUE INDEX IF NOT EXISTS '
+                   '"suffrage_election_id_emitted_by_id" ON "suffrage" '
+                   '("election_id", "emitted_by_id")')
+    db.execute_sql('CREATE INDEX IF NOT EXISTS "effective_vote_type_vote_target" '
+                   'ON "effective" ("vote_type", "vote_target")')
+    db.execute_sql('CREATE INDEX IF NOT EXISTS "effective_election_id" '
+                   'ON "effective" ("election_id")')
+
+
+def _v2_channels(db):
+    """ Channel key on users, elections and effective actions """
+    import config
+    # Everything so far happened in the one channel the bot used to govern
+    channel = getattr(config, 'CHANNELS', [getattr(config, 'CHANNEL', '')])[0]
+    for table in ('user', 'election', 'effective'):
+        db.execute_sql('ALTER TABLE "{0}" ADD COLUMN "channel" VARCHAR(255) '
+                       'NOT NULL DEFAULT \'\''.format(table))
+        db.execute_sql('UPDATE "{0}" SET channel = ?'.format(table),
+                       (channel.lower(),))
+    db.execute_sql('DROP INDEX IF EXISTS "user_name"')
+    db.execute_sql('CREATE UNIQUE INDEX IF NOT EXISTS "user_channel_name" '
+                   'ON "user" ("channel", "name")')
+    db.execute_sql('DROP INDEX IF EXISTS "election_vote_type_status_vote_target"')
+    db.execute_sql('CREATE INDEX IF NOT EXISTS '
+                   '"election_channel_vote_type_status_vote_target" ON '
+                   '"election" ("channel", "vote_type", "status", "vote_target")')
+    db.execute_sql('DROP INDEX IF EXISTS "effective_vote_type_vote_target"')
+    db.execute_sql('CREATE INDEX IF NOT EXISTS '
+                   '"effective_channel_vote_type_vote_target" ON "effective" '
+                   '("channel", "vote_type", "vote_target")')
+
+
+def _v3_journal(db):
+    """ Event journal, started with what the tables hold """
+    import json
+    db.execute_sql('CREATE TABLE IF NOT EXISTS "event" ('
+                   '"id" INTEGER NOT NULL PRIMARY KEY, '
+                   '"at" DATETIME NOT NULL, "kind" VARCHAR(255) NOT NULL, '
+                   '"election" INTEGER NOT NULL, "account" VARCHAR(255), '
+                   '"data" TEXT)')
+    db.execute_sql('CREATE TABLE IF NOT EXISTS "snapshot" ('
+                   '"id" INTEGER NOT NULL PRIMARY KEY, '
+                   '"event" INTEGER NOT NULL, "taken" DATETIME NOT NULL, '
+                   '"data" TEXT NOT NULL)')
+    users = dict(db.execute_sql('SELECT id, name FROM "user"').fetchall())
+    ballots = {}
+    for elec, user, yea in db.execute_sql(
+            'SELECT election_id, emitted_by_id, yea FROM "suffrage" '
+            'ORDER BY id'):
+        ballots.setdefault(elec, []).append((users.get(user), bool(yea)))
+    effective = {}
+    for row in db.execute_sql('SELECT id, election_id, channel, vote_type, '
+                              'vote_target, close FROM "effective"'):
+        effective.setdefault(row[1], []).append(row)
+
+    def add(at, kind, election, account=None, **data):
+        db.execute_sql('INSERT INTO "event" (at, kind, election, account, '
+                       'data) VALUES (?, ?, ?, ?, ?)',
+                       (at, kind, election, account,
+                        json.dumps(data) if data else None))
+
+    for elec, channel, vtype, target, opened, close, status, opener in \
+            db.execute_sql('SELECT id, channel, vote_type, vote_target, '
+                           'opened, close, status, opened_by_id '
+                           'FROM "election" ORDER BY id').fetchall():
+        add(opened, 'opened', elec, users.get(opener), channel=channel,
+            vote_type=vtype, vote_target=target, close=close)
+        for name, yea in ballots.get(elec, []):
+            add(opened, 'cast', elec, name, yea=yea)
+        if status != 0:
+            add(close, 'closed', elec, status=status)
+        for act, _, channel, vtype, target, until in effective.get(elec, []):
+            add(close, 'effective', elec, id=act, channel=channel,
+                vote_type=vtype, vote_target=target, close=until)
+
+
+def _v4_daily_lines(db):
+    """ Lines per day of the last weeks, for users """
+    db.execute_sql('ALTER TABLE "user" ADD COLUMN "recent" BLOB')
+
+
+def _v5_election_ids(db):
+    """ Election ids that are never handed out again """
+    # Archiving deletes elections, and without AUTOINCREMENT SQLite reuses
+    # the highest ids, which the archive and the journal still refer to.
+    # Ballots and actions point at elections, so the check of those
+    # references waits for the new table.
+    db.execute_sql('PRAGMA defer_foreign_keys = ON')
+    columns = ('"id", "channel", "vote_type", "opened", "close", "status", '
+               '"opened_by_id", "vote_target"')
+    db.execute_sql('CREATE TABLE "election_new" ('
+                   '"id" INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT, '
+                   '"channel" VARCHAR(255) NOT NULL, '
+                   '"vote_type" VARCHAR(255) NOT NULL, '
+                   '"opened" DATETIME NOT NULL, "close" DATETIME NOT NULL, '
+                   '"status" INTEGER NOT NULL, '
+                   '"opened_by_id" INTEGER NOT NULL, '
+                   '"vote_target" VARCHAR(255) NOT NULL, '
+                   'FOREIGN KEY ("opened_by_id") REFERENCES "user" ("id"))')
+    db.execute_sql('INSERT INTO "election_new" ({0}) SELECT {0} FROM "election"'
+                   .format(columns))
+    db.execute_sql('DROP TABLE "election"')
+    db.execute_sql('ALTER TABLE "election_new" RENAME TO "election"')
+    db.execute_sql('CREATE INDEX IF NOT EXISTS "election_opened_by_id" '
+                   'ON "election" ("opened_by_id")')
+    db.execute_sql('CREATE INDEX IF NOT EXISTS '
+                   '"election_channel_vote_type_status_vote_target" ON '
+                   '"election" ("channel", "vote_type", "status", "vote_target")')
+    # Start after every id ever used, archived ones included
+    tables = set(db.get_tables())
+    used = ['SELECT MAX(id) FROM "election"']
+    if 'archived' in tables:
+        used.append('SELECT MAX(election) FROM "archived"')
+    if 'event' in tables:
+        used.append('SELECT MAX(election) FROM "event"')
+    highest = max([db.execute_sql(q).fetchone()[0] or 0 for q in used])
+    db.execute_sql('DELETE FROM "sqlite_sequence" WHERE name = \'election\'')
+    db.execute_sql('INSERT INTO "sqlite_sequence" (name, seq) '
+                   'VALUES (\'election\', ?)', (highest,))
+
+
+MIGRATIONS = [_v1_indexes, _v2_channels, _v3_journal, _v4_daily_lines,
+              _v5_election_ids]
+
+
+def schema_version(db):
+    return db.execute_sql('PRAGMA user_version').fetchone()[0]
+
+
+def _set_version(db, version):
+    db.execute_sql('PRAGMA user_version = {0:d}'.format(version))
+
+
+def migrate(db, models):
+    """ Brings the database up to date. Returns the migrations applied. """
+    existing = set(db.get_tables())
+    if not existing & set(m._meta.table_name for m in models):
+        # Brand new database, nothing to upgrade
+        with db.atomic():
+            db.create_tables(models, safe=True)
+            _set_version(db, len(MIGRATIONS))
+        return []
+
+    applied = []
+    version = schema_version(db)
+    for number, migration in enumerate(MIGRATIONS[version:], version + 1):
+        with db.atomic():
+            migration(db)
+            _set_version(db, number)
+        print("Applied schema migration {0}: {1}".format(
+            number, migration.__doc__.strip()))
+        applied.append(number)
+    # Tables added after the database was created
+    db.create_tables(models, safe=True)
+    return applied
+
+
+if __name__ == '__main__':
+    from models import db  # noqa: migrates on import
+    print("Schema is at version {0}".format(schema_version(db)))
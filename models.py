@@ -1,50 +1,162 @@
 from peewee import SqliteDatabase, Model, CharField, DateTimeField
-from peewee import ForeignKeyField, BooleanField, IntegerField
-
-
-db = SqliteDatabase('users.db')
+from peewee import ForeignKeyField, BooleanField, IntegerField, TextField
+from peewee import BlobField
+from playhouse.pool import PooledSqliteDatabase
+from playhouse.sqlite_ext import AutoIncrementField
+import time
+import config
+import migrations
+
+
+class Instrumented(object):
+    """ Counts the statements it runs, for metrics, and logs the ones that
+    take longer than `slow` seconds """
+    queries = 0
+    slow = None
+    handler = 'other'  # What the statements are run for; set by aiodb
+
+    def execute_sql(self, sql, params=None, *args, **kwargs):
+        self.queries += 1
+        if self.slow is None:
+            return super().execute_sql(sql, params, *args, **kwargs)
+        start = time.perf_counter()
+        try:
+            return super().execute_sql(sql, params, *args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - start
+            if elapsed >= self.slow:
+                print("Slow query ({0:.0f}ms in {1}): {2} {3}".format(
+                    elapsed * 1000, self.handler, sql, params))
+
+
+class Database(Instrumented, SqliteDatabase):
+    pass
+
+
+class PooledDatabase(Instrumented, PooledSqliteDatabase):
+    pass
+
+
+PRAGMAS = {'journal_mode': 'wal',
+           'synchronous': 'normal',
+           'cache_size': -16000,  # KiB
+           'mmap_size': 64 * 2 ** 20}
+
+
+def open_database(path, pragmas=PRAGMAS, timeout=5, pool=0, readonly=False):
+    """ A database for `path`, which can be ':memory:'. `pragmas` are set on
+    every connection; other connections holding a lock are waited for
+    `timeout` seconds. With `pool`, threads take their connections from a
+    pool of up to that many, and give them back when they close them. """
+    pragmas = dict(pragmas, busy_timeout=int(timeout * 1000))
+    if readonly:
+        # Changing the journal mode is a write
+        pragmas.pop('journal_mode', None)
+        return Database('file:{0}?mode=ro'.format(path), pragmas=pragmas,
+                        uri=True)
+    if path == ':memory:':
+        # Every connection would be a database of its own: share one
+        return Database(path, pragmas=pragmas, thread_safe=False,
+                        check_same_thread=False)
+    if pool:
+        return PooledDatabase(path, pragmas=pragmas, max_connections=pool,
+                              stale_timeout=300, check_same_thread=False)
+    return Database(path, pragmas=pragmas)
+
+
+db = open_database(getattr(config, 'DATABASE', 'users.db'),
+                   pragmas=getattr(config, 'DATABASE_PRAGMAS', PRAGMAS),
+                   timeout=getattr(config, 'DATABASE_TIMEOUT', 5),
+                   pool=getattr(config, 'DATABASE_POOL', 0),
+                   # For tools reading the bot's database, like stats.py
+                   readonly=getattr(config, 'DATABASE_READONLY', False))
+if getattr(config, 'SLOW_QUERY_MS', 250) is not None:
+    db.slow = getattr(config, 'SLOW_QUERY_MS', 250) / 1000
 
 
 class User(Model):
+    channel = CharField()
     name = CharField()
     first_seen = DateTimeField()
     last_seen = DateTimeField()
     lines = IntegerField()
+    recent = BlobField(null=True)  # usermap.DailyLines
 
     class Meta:
         database = db
+        indexes = ((('channel', 'name'), True),)
 
 
 class Election(Model):
+    id = AutoIncrementField()  # Never reused, archived elections keep theirs
+    channel = CharField()
     vote_type = CharField()
     opened = DateTimeField()  # when election started
     close = DateTimeField()  # when election should close
     status = IntegerField()  # 0=open, 1=passed, 2=quorum, 3=not passed, 4=veto
-    opened_by = ForeignKeyField(User, related_name='votes_opened')
+    opened_by = ForeignKeyField(User, backref='votes_opened')
     vote_target = CharField()
 
     class Meta:
         database = db
+        indexes = ((('channel', 'vote_type', 'status', 'vote_target'), False),)
 
 
 class Suffrage(Model):
-    election = ForeignKeyField(Election, related_name='suffrages')
+    election = ForeignKeyField(Election, backref='suffrages')
     yea = BooleanField()
-    emitted_by = ForeignKeyField(User, related_name='suffrages')
+    emitted_by = ForeignKeyField(User, backref='suffrages')
 
     class Meta:
         database = db
+        # One ballot per user and election; lets votes be upserted
+        indexes = ((('election', 'emitted_by'), True),)
 
 
 class Effective(Model):
-    election = ForeignKeyField(Election, related_name='effective')
+    election = ForeignKeyField(Election, backref='effective', index=True)
+    channel = CharField()
     vote_type = CharField()
     close = DateTimeField()
     vote_target = CharField()
 
+    class Meta:
+        database = db
+        indexes = ((('channel', 'vote_type', 'vote_target'), False),)
+
+
+class Event(Model):
+    """ An entry of the journal (see journal.py). Only ever appended to. """
+    at = DateTimeField()
+    kind = CharField()
+    election = IntegerField()  # not a foreign key: it outlives the rows
+    account = CharField(null=True)
+    data = TextField(null=True)  # JSON
+
+    class Meta:
+        database = db
+
+
+class Snapshot(Model):
+    """ journal.State as of an event """
+    event = IntegerField()
+    taken = DateTimeField()
+    data = TextField()  # JSON
+
+    class Meta:
+        database = db
+
+
+class Archived(Model):
+    """ Which archive file (see archive.py) an election was moved to """
+    election = IntegerField(primary_key=True)
+    partition = CharField()  # YYYY-MM
+
     class Meta:
         database = db
 
 
 db.connect()
-db.create_tables([User, Election, Suffrage, Effective], True)
+if not getattr(config, 'DATABASE_READONLY', False):
+    migrations.migrate(db, [User, Election, Suffrage, Effective, Event,
+                            Snapshot, Archived])
@@ -0,0 +1,129 @@
+import asyncio
+import collections
+import time
+import traceback
+
+# Lanes, in the order they're drained: ChanServ and other services,
+# announcements to the channel, then replies to commands.
+CONTROL, ANNOUNCE, REPLY = range(3)
+
+SEPARATOR = ' \002|\002 '
+
+
+class OutboundQueue(object):
+    """ Sends messages no faster than the server lets us.
+
+    Lines are sent from a token bucket that refills `rate` times per second
+    and holds up to `burst` lines. While waiting, consecutive messages to the
+    same target in the same lane are packed into a single line of up to
+    `line_length` bytes (never in CONTROL, those are service commands). A
+    service command identical to one that's still queued is dropped, and so
+    are the oldest replies once more than `backlog` are waiting.
+
+    Messages can be tagged with a `key`; `discard(key)` drops whatever is
+    still queued under it, for output that a newer request supersedes. """
+
+    def __init__(self, send, rate=1.0, burst=5, line_length=400, backlog=50):
+        self._send = send  # coroutine function (command, target, text)
+        self.rate = rate
+        self.burst = burst
+        self.line_length = line_length
+        self.backlog = backlog
+        self._tokens = burst
+        self._stamp = time.monotonic()
+        self._lanes = [collections.deque() for _ in range(REPLY + 1)]
+        self._queued = set()  # (command, target, text) queued in CONTROL
+        self._wake = asyncio.Event()
+        self._task = None
+        # Counters, for whoever wants to look
+        self.sent = 0
+        self.packed = 0
+        self.dropped = 0
+
+    def __len__(self):
+        return sum(len(lane) for lane in self._lanes)
+
+    def put(self, command, target, text, lane=REPLY, key=None):
+        message = (command, target, text)
+        if lane == CONTROL:
+            if message in self._queued:
+                self.dropped += 1
+                return
+            self._queued.add(message)
+        self._lanes[lane].append((message, key))
+        replies = self._lanes[REPLY]
+        while len(replies) > self.backlog:
+            replies.popleft()
+            self.dropped += 1
+        self._wake.set()
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._run())
+
+    def discard(self, key):
+        """ Drops queued messages tagged with `key` """
+        for i, lane in enumerate(self._lanes):
+            keep = collections.deque()
+            for message, mkey in lane:
+                if mkey == key:
+                    if i == CONTROL:
+                        self._queued.discard(message)
+                    self.dropped += 1
+                else:
+                    keep.append((message, mkey))
+            self._lanes[i] = keep
+
+    def clear(self):
+        for lane in self._lanes:
+            lane.clear()
+        self._queued.clear()
+
+    async def _take_token(self):
+        while True:
+            now = time.monotonic()
+            self._tokens = min(self.burst,
+                               self._tokens + (now - self._stamp) * self.rate)
+            self._stamp = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    def _next(self):
+        """ Pops the next line to send, packing what fits into it """
+        for lane_id, lane in enumerate(self._lanes):
+            if lane:
+                break
+        else:
+            return None
+        message, _ = lane.popleft()
+        if lane_id == CONTROL:
+            self._queued.discard(message)
+            return message
+        command, target, text = message
+        size = len(text.encode('utf-8'))
+        while lane:
+            (ncommand, ntarget, ntext), _ = lane[0]
+            nsize = len(ntext.encode('utf-8')) + len(SEPARATOR)
+            if (ncommand, ntarget) != (command, target) or \
+               size + nsize > self.line_length:
+                break
+            lane.popleft()
+            text += SEPARATOR + ntext
+            size += nsize
+            self.packed += 1
+        return command, target, text
+
+    async def _run(self):
+        while True:
+            if not any(self._lanes):
+                self._wake.clear()
+                await self._wake.wait()
+            await self._take_token()
+            message = self._next()
+            if message is None:
+                continue
+            try:
+                await self._send(*message)
+                self.sent += 1
+            except Exception:
+                traceback.print_exc()
@@ -0,0 +1,103 @@
+""" A sampling profiler that can be turned on while the bot runs, with
+`!profile <seconds>` or SIGUSR1. While it's on, a thread looks at the stack
+of every other thread PROFILE_RATE times per second; when it's done the
+stacks are written in the collapsed format flamegraph.pl, speedscope and
+friends read:
+
+    MainThread;bot.py:on_message;bot.py:cmd_vote_start;... 12
+
+Stacks of the database thread start with the handler it's working for.
+Nothing runs while it's off. """
+
+import os
+import sys
+import time
+import signal
+import threading
+import collections
+from datetime import datetime
+import config
+from models import db
+
+_running = None
+_lock = threading.Lock()
+
+
+def _stack(frame):
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append('{0}:{1}'.format(os.path.basename(code.co_filename),
+                                      code.co_name))
+        frame = frame.f_back
+    names.reverse()
+    return names
+
+
+class Sampler(threading.Thread):
+    def __init__(self, seconds, path, rate):
+        super().__init__(name='profiler', daemon=True)
+        self.seconds = seconds
+        self.path = path
+        self.interval = 1 / rate
+        self.stacks = collections.Counter()
+        self.samples = 0
+
+    def sample(self):
+        names = dict((t.ident, t.name) for t in threading.enumerate())
+        for ident, frame in sys._current_frames().items():
+            if ident == self.ident:
+                continue
+            root = [names.get(ident, str(ident))]
+            stack = _stack(frame)
+            if 'aiodb.py:_call' in stack:
+                root.append('handler:' + db.handler)
+            self.stacks[';'.join(root + stack)] += 1
+        self.samples += 1
+
+    def run(self):
+        global _running
+        try:
+            end = time.monotonic() + self.seconds
+            while time.monotonic() < end:
+                self.sample()
+                time.sleep(self.interval)
+            self.write()
+            print("Profile: {0} samples written to {1}".format(self.samples,
+                                                                self.path))
+        finally:
+            with _lock:
+                _running = None
+
+    def write(self):
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            for stack, count in self.stacks.most_common():
+                f.write('{0} {1}\n'.format(stack, count))
+        os.replace(tmp, self.path)
+
+
+def start(seconds):
+    """ Profiles for `seconds`. Returns the file it'll write the stacks to,
+    or None if it's already profiling. """
+    global _running
+    with _lock:
+        if _running is not None:
+            return None
+        name = 'profile-{0}.folded'.format(
+            datetime.utcnow().strftime('%Y%m%d-%H%M%S'))
+        path = os.path.join(getattr(config, 'PROFILE_DIR', '.'), name)
+        _running = Sampler(seconds, path, getattr(config, 'PROFILE_RATE', 100))
+        _running.start()
+        return path
+
+
+def install_signal(seconds):
+    """ Makes SIGUSR1 profile for `seconds` """
+    def handle(signum, frame):
+        path = start(seconds)
+        if path is None:
+            print("Profile: already running")
+        else:
+            print("Profile: sampling for {0}s into {1}".format(seconds, path))
+    signal.signal(signal.SIGUSR1, handle)
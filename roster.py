@@ -0,0 +1,110 @@
+class Roster(object):
+    """ Who is in which channel with which status modes (+o, +v...), and
+    which account they're logged in to, kept up to date from JOIN, PART,
+    KICK, QUIT, NICK and MODE as they come instead of searched for in
+    pydle's per-channel lists. Nicks and channels are normalized with
+    `normalize` (the server's case mapping); accounts are lowercase. """
+
+    def __init__(self, normalize):
+        self.normalize = normalize
+        self._channels = {}  # {nick: {channel: {status modes}}}
+        self._accounts = {}  # {nick: account}
+        self._nicks = {}  # {account: {nicks}}
+        self._holders = {}  # {channel: {status mode: {nicks}}}
+
+    def __len__(self):
+        return len(self._channels)
+
+    def joined(self, channel, nick):
+        self._channels.setdefault(self.normalize(nick), {}) \
+                      .setdefault(self.normalize(channel), set())
+
+    def parted(self, nick, channel=None):
+        """ `nick` left `channel`, or every channel (quit). Its account is
+        forgotten along with the last one. """
+        nick = self.normalize(nick)
+        channels = self._channels.get(nick)
+        if channels is None:
+            return self._set_account(nick, None)
+        for chan in ([self.normalize(channel)] if channel is not None
+                     else list(channels)):
+            for mode in channels.pop(chan, ()):
+                self._holders[chan][mode].discard(nick)
+        if not channels:
+            del self._channels[nick]
+            self._set_account(nick, None)
+
+    def renamed(self, old, new):
+        """ Moves everything about `old` to `new`. Returns {channel: {status
+        modes}} of the channels it's in. """
+        old, new = self.normalize(old), self.normalize(new)
+        channels = self._channels.pop(old, {})
+        if channels:
+            self._channels[new] = channels
+        for chan, modes in channels.items():
+            for mode in modes:
+                holders = self._holders[chan][mode]
+                holders.discard(old)
+                holders.add(new)
+        account = self._accounts.get(old)
+        self._set_account(old, None)
+        self._set_account(new, account)
+        return channels
+
+    def set_mode(self, channel, nick, mode, on):
+        nick, channel = self.normalize(nick), self.normalize(channel)
+        modes = self._channels.setdefault(nick, {}).setdefault(channel, set())
+        holders = self._holders.setdefault(channel, {}).setdefault(mode, set())
+        if on:
+            modes.add(mode)
+            holders.add(nick)
+        else:
+            modes.discard(mode)
+            holders.discard(nick)
+
+    def modes(self, channel, nick):
+        """ The status modes `nick` has in `channel` """
+        return self._channels.get(self.normalize(nick), {}) \
+                             .get(self.normalize(channel), frozenset())
+
+    def set_account(self, nick, account):
+        self._set_account(self.normalize(nick), account and account.lower())
+
+    def _set_account(self, nick, account):
+        previous = self._accounts.pop(nick, None)
+        if previous is not None:
+            nicks = self._nicks[previous]
+            nicks.discard(nick)
+            if not nicks:
+                del self._nicks[previous]
+        if account is not None:
+            self._accounts[nick] = account
+            self._nicks.setdefault(account, set()).add(nick)
+
+    def account(self, nick):
+        """ The (lowercase) account `nick` is logged in to, or None """
+        return self._accounts.get(self.normalize(nick))
+
+    def nicks(self, account):
+        """ The nicks logged in to `account` """
+        return self._nicks.get(account.lower(), frozenset())
+
+    def privileges(self, channel, account):
+        """ The status modes any nick of `account` has in `channel` """
+        channel = self.normalize(channel)
+        modes = set()
+        for nick in self._nicks.get(account.lower(), ()):
+            modes.update(self._channels.get(nick, {}).get(channel, ()))
+        return modes
+
+    def holders(self, channel, modes):
+        """ The accounts of the nicks with any of `modes` in `channel` """
+        held = self._holders.get(self.normalize(channel), {})
+        return set(self._accounts[nick] for mode in modes
+                   for nick in held.get(mode, ()) if nick in self._accounts)
+
+    def clear(self):
+        self._channels.clear()
+        self._holders.clear()
+        self._accounts.clear()
+        self._nicks.clear()
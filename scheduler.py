@@ -0,0 +1,136 @@
+import asyncio
+import heapq
+import itertools
+import traceback
+from datetime import datetime, timedelta
+from models import db
+import aiodb
+import metrics
+
+_FAILED = object()
+
+
+class DeadlineScheduler(object):
+    """ Runs callbacks at fixed points in time (vote closes, expiries...).
+
+    Jobs are keyed (for example `('close', 12)`), so scheduling the same key
+    again only moves its deadline instead of adding a second job. A single
+    event loop timer is armed for the earliest deadline; when it fires,
+    every job that is due runs in one batch. Timers are rounded up to the
+    second, so deadlines that land in the same second are handled together.
+
+    A job may have a `prepare` function: it gets the job's arguments and
+    runs on the database thread, where the `prepare` of every job in a batch
+    shares one transaction. Its return value is then passed to the job's
+    coroutine instead of the arguments. """
+
+    def __init__(self):
+        self._heap = []  # [deadline, seq, key]
+        self._jobs = {}  # {key: (deadline, callback, args, prepare)}
+        self._seq = itertools.count()
+        self._timer = None
+        self._timer_at = None
+
+    def __len__(self):
+        return len(self._jobs)
+
+    def __contains__(self, key):
+        return key in self._jobs
+
+    @property
+    def depth(self):
+        """ Number of pending jobs """
+        return len(self._jobs)
+
+    @property
+    def next_deadline(self):
+        """ Deadline of the earliest pending job, or None """
+        self._prune()
+        return self._heap[0][0] if self._heap else None
+
+    def pending(self):
+        """ {kind: number of pending jobs}, kind being the first item of
+        their keys """
+        counts = {}
+        for key in self._jobs:
+            counts[key[0]] = counts.get(key[0], 0) + 1
+        return counts
+
+    def schedule(self, key, deadline, callback, *args, prepare=None):
+        job = self._jobs.get(key)
+        if job is not None and job[0] == deadline:
+            return
+        self._jobs[key] = (deadline, callback, args, prepare)
+        heapq.heappush(self._heap, (deadline, next(self._seq), key))
+        self._arm()
+
+    def cancel(self, key):
+        if self._jobs.pop(key, None) is not None:
+            self._arm()
+
+    def _prune(self):
+        # Drop heap entries whose job was cancelled or rescheduled
+        while self._heap:
+            deadline, _, key = self._heap[0]
+            job = self._jobs.get(key)
+            if job is not None and job[0] == deadline:
+                return
+            heapq.heappop(self._heap)
+
+    def _arm(self):
+        target = self.next_deadline
+        if target is not None and target.microsecond:
+            target = target.replace(microsecond=0) + timedelta(seconds=1)
+        if target == self._timer_at:
+            return
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        self._timer_at = target
+        if target is not None:
+            delay = max((target - datetime.utcnow()).total_seconds(), 0)
+            self._timer = asyncio.get_event_loop().call_later(delay, self._fire)
+
+    def _fire(self):
+        self._timer = None
+        self._timer_at = None
+        now = datetime.utcnow()
+        due = []
+        self._prune()
+        while self._heap and self._heap[0][0] <= now:
+            deadline, _, key = heapq.heappop(self._heap)
+            due.append(self._jobs.pop(key))
+            self._prune()
+        if due:
+            asyncio.ensure_future(self._run(due))
+        self._arm()
+
+    @staticmethod
+    def _prepare(due):
+        results = []
+        with db.atomic():
+            for deadline, callback, args, prepare in due:
+                if prepare is None:
+                    results.append(args)
+                    continue
+                try:
+                    with db.atomic():
+                        results.append((prepare(*args),))
+                except Exception:
+                    traceback.print_exc()
+                    results.append(_FAILED)
+        return results
+
+    async def _run(self, due):
+        metrics.handler.set('deadlines')
+        if any(job[3] is not None for job in due):
+            results = await aiodb.run(self._prepare, due)
+        else:
+            results = [job[2] for job in due]
+        for job, args in zip(due, results):
+            if args is _FAILED:
+                continue
+            try:
+                await job[1](*args)
+            except Exception:
+                traceback.print_exc()
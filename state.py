@@ -0,0 +1,28 @@
+import config
+import i18n
+from activity import ActivityCounter
+from usermap import UserMap
+from bans import BanTracker
+
+CHANNELS = getattr(config, 'CHANNELS', None) or [config.CHANNEL]
+LOCALES = dict((name.lower(), lang) for name, lang
+               in getattr(config, 'LOCALES', {}).items())
+
+
+class ChannelState(object):
+    """ Everything the bot keeps in memory about a governed channel """
+
+    def __init__(self, name):
+        self.name = name
+        self.key = name.lower()  # how the channel is stored in the database
+        self.tr = i18n.translator(LOCALES.get(self.key, config.LANG))
+        # {"account": UserRecord}
+        self.usermap = UserMap(self.key,
+                               capacity=getattr(config, 'USERMAP_CAPACITY', 20000),
+                               preload=getattr(config, 'USERMAP_PRELOAD_DAYS', 30),
+                               window=getattr(config, 'ACTIVITY_WINDOW_DAYS', 28))
+        self.activity = ActivityCounter(self.key, self.usermap)
+        self.bans = BanTracker(getattr(config, 'BAN_LIFETIME', 86400))
+        # Enfranchised users and staff, counted from the FLAGS listing
+        self.civis_count = 0
+        self.staff_count = 0
@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+""" Participation statistics over the election history.
+
+    voters    ballots, yea/nay ratio and turnout of every account
+    types     how often each type of vote passes, fails or misses quorum
+    quorum    how long elections take to reach quorum
+    activity  accounts ranked by lines spoken
+
+The database is opened read-only. Rows are streamed and aggregated as
+they're read, so a live database (in WAL mode, the default) can be used
+while the bot runs without blocking it; a copy works just as well.
+Archived elections are included. `quorum` needs the ballot times of the
+journal, so elections from before it are left out.
+
+    python3 stats.py [--db FILE] [--archive DIR] [--channel CHANNEL]
+                     [--format table|csv|json] [--output FILE]
+                     [--limit N] voters|types|quorum|activity """
+
+import sys
+import csv
+import json
+import bisect
+import argparse
+import collections
+from datetime import datetime
+import config
+
+# models, and everything using it, is imported once the database to read
+# is known (see main)
+
+REPORTS = collections.OrderedDict()
+
+
+def report(*columns):
+    def register(func):
+        REPORTS[func.__name__] = (columns, func)
+        return func
+    return register
+
+
+def _ratio(part, whole):
+    return round(part / whole, 4) if whole else None
+
+
+@report('channel', 'account', 'ballots', 'yeas', 'nays', 'yea_ratio',
+        'elections', 'turnout')
+def voters(args):
+    """ `elections` are the ones held since the account was first seen """
+    import archive
+    from peewee import fn, JOIN
+    from models import User, Election, Suffrage
+    # Archived ballots and open times, then the ones still in the database
+    archived = collections.Counter()  # {(channel, name, yea): ballots}
+    opened = collections.defaultdict(list)  # {channel: [opened]}
+    for record in archive.records():
+        if args.channel in (None, record['channel']):
+            opened[record['channel']].append(
+                datetime.fromisoformat(record['opened']))
+            for name, yea in record['ballots'].items():
+                archived[record['channel'], name, yea] += 1
+    query = Election.select(Election.channel, Election.opened).tuples()
+    if args.channel:
+        query = query.where(Election.channel == args.channel)
+    for channel, when in query.iterator():
+        opened[channel].append(when)
+    for times in opened.values():
+        times.sort()
+
+    query = User.select(User.channel, User.name, User.first_seen,
+                        fn.COUNT(Suffrage.id), fn.SUM(Suffrage.yea)) \
+                .join(Suffrage, JOIN.LEFT_OUTER,
+                      on=(Suffrage.emitted_by == User.id)) \
+                .group_by(User.id) \
+                .order_by(User.channel, User.name) \
+                .tuples()
+    if args.channel:
+        query = query.where(User.channel == args.channel)
+    for channel, name, first_seen, ballots, yeas in query.iterator():
+        yeas = (yeas or 0) + archived[channel, name, True]
+        ballots += archived[channel, name, True] + archived[channel, name, False]
+        times = opened.get(channel, [])
+        held = len(times) - bisect.bisect_left(times, first_seen)
+        yield (channel, name, ballots, yeas, ballots - yeas,
+               _ratio(yeas, ballots), held, _ratio(ballots, held))
+
+
+def _events(*kinds):
+    from models import Event
+    return Event.select(Event.at, Event.kind, Event.election, Event.data) \
+                .where(Event.kind.in_(kinds)) \
+                .order_by(Event.id) \
+                .tuples() \
+                .iterator()
+
+
+@report('channel', 'vote_type', 'closed', 'passed', 'failed', 'quorum',
+        'other', 'pass_rate')
+def types(args):
+    import journal
+    open_ = {}  # {election: (channel, vote_type)}
+    counts = collections.defaultdict(collections.Counter)
+    names = {1: 'passed', 3: 'failed', 2: 'quorum'}
+    for at, kind, election, data in _events(journal.OPENED, journal.CLOSED):
+        data = json.loads(data)
+        if kind == journal.OPENED:
+            if args.channel in (None, data['channel']):
+                open_[election] = (data['channel'], data['vote_type'])
+        elif election in open_:
+            counts[open_.pop(election)][names.get(data['status'], 'other')] += 1
+    for (channel, vtype), count in sorted(counts.items()):
+        closed = sum(count.values())
+        yield (channel, vtype, closed, count['passed'], count['failed'],
+               count['quorum'], count['other'],
+               _ratio(count['passed'], closed))
+
+
+def _percentile(ordered, p):
+    return ordered[int(round(p * (len(ordered) - 1)))]
+
+
+@report('channel', 'vote_type', 'reached', 'min_minutes', 'p50_minutes',
+        'p90_minutes', 'max_minutes')
+def quorum(args):
+    import journal
+    import votes
+    quorums = dict((name, vote.quorum) for name, vote in votes.BY_NAME.items())
+    open_ = {}  # {election: [channel, vote_type, opened, ballots]}
+    delays = collections.defaultdict(list)  # {(channel, vote_type): [seconds]}
+    for at, kind, election, data in _events(journal.OPENED, journal.CAST,
+                                            journal.CLOSED):
+        if kind == journal.OPENED:
+            data = json.loads(data)
+            if args.channel in (None, data['channel']) and \
+               data['vote_type'] in quorums:
+                open_[election] = [data['channel'], data['vote_type'], at, 0]
+        elif kind == journal.CLOSED:
+            open_.pop(election, None)
+        elif election in open_:
+            elec = open_[election]
+            if at == elec[2]:
+                # Started from the tables: ballots have no time of their own
+                del open_[election]
+                continue
+            elec[3] += 1
+            if elec[3] == quorums[elec[1]]:
+                delays[elec[0], elec[1]].append((at - elec[2]).total_seconds())
+                del open_[election]
+    for key, seconds in sorted(delays.items()):
+        seconds.sort()
+        yield key + (len(seconds),) + tuple(
+            round(s / 60, 1) for s in (seconds[0], _percentile(seconds, .5),
+                                       _percentile(seconds, .9), seconds[-1]))
+
+
+@report('rank', 'channel', 'account', 'lines', 'first_seen', 'last_seen')
+def activity(args):
+    from models import User
+    query = User.select(User.channel, User.name, User.lines, User.first_seen,
+                        User.last_seen) \
+                .order_by(User.lines.desc()) \
+                .tuples()
+    if args.channel:
+        query = query.where(User.channel == args.channel)
+    if args.limit:
+        query = query.limit(args.limit)
+    for rank, row in enumerate(query.iterator(), 1):
+        yield (rank,) + row
+
+
+def write_table(out, columns, rows):
+    rows = [[('' if v is None else str(v)) for v in row] for row in rows]
+    widths = [max([len(c)] + [len(row[i]) for row in rows])
+              for i, c in enumerate(columns)]
+    for row in [columns] + rows:
+        out.write('  '.join(v.ljust(w) for v, w in zip(row, widths)).rstrip()
+                  + '\n')
+
+
+def write_csv(out, columns, rows):
+    writer = csv.writer(out)
+    writer.writerow(columns)
+    for row in rows:
+        writer.writerow(row)
+
+
+def write_json(out, columns, rows):
+    out.write('[')
+    for i, row in enumerate(rows):
+        out.write(',\n ' if i else '\n ')
+        json.dump(dict(zip(columns, row)), out, default=str)
+    out.write('\n]\n')
+
+
+WRITERS = {'table': write_table, 'csv': write_csv, 'json': write_json}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('report', choices=list(REPORTS))
+    parser.add_argument('--db', default=getattr(config, 'DATABASE', 'users.db'),
+                        help='database file (default: the bot\'s)')
+    parser.add_argument('--archive', help='archive directory (default: the '
+                        'bot\'s)')
+    parser.add_argument('--channel', type=str.lower)
+    parser.add_argument('--format', choices=list(WRITERS), default='table')
+    parser.add_argument('--output', help='file to write to (default: stdout)')
+    parser.add_argument('--limit', type=int, default=50,
+                        help='rows of the activity ranking (0: all)')
+    args = parser.parse_args()
+
+    config.DATABASE = args.db
+    config.DATABASE_READONLY = True
+    if args.archive:
+        config.ARCHIVE_DIR = args.archive
+
+    columns, func = REPORTS[args.report]
+    out = open(args.output, 'w', newline='') if args.output else sys.stdout
+    try:
+        WRITERS[args.format](out, columns, func(args))
+    finally:
+        if args.output:
+            out.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,192 @@
+from collections import namedtuple
+from peewee import fn, Case
+from models import User, Election, Suffrage
+import aiodb
+
+
+class Tally(namedtuple('Tally', ['yeas', 'nays', 'mine'])):
+    """ Vote counts of an election. `mine` is the ballot of the user the
+    tally was requested for: True, False or None if they didn't vote """
+    __slots__ = ()
+
+    @property
+    def total(self):
+        return self.yeas + self.nays
+
+    @property
+    def approval(self):
+        """ Percentage of yeas, rounded down """
+        return int((self.yeas / self.total) * 100) if self.total else 0
+
+
+EMPTY = Tally(0, 0, None)
+
+
+def tallies(elections, account=None, channel=None):
+    """ Returns {election id: Tally} for all the given elections using a
+    single grouped query. Elections without ballots get EMPTY. `mine` is
+    the ballot of `account` in `channel` (the elections'), as account
+    names are only unique within a channel. """
+    ids = [getattr(elec, 'id', elec) for elec in elections]
+    if not ids:
+        return {}
+    if account is not None:
+        # 2 = voted yea, 1 = voted nay, 0 = didn't vote
+        voter = User.select(User.id).where((User.channel == channel) &
+                                           (User.name == account))
+        mine = fn.MAX(Case(None, [((Suffrage.emitted_by == voter) &
+                                   (Suffrage.yea == True), 2),  # noqa
+                                  (Suffrage.emitted_by == voter, 1)], 0))
+    else:
+        mine = fn.MAX(0)
+    query = Suffrage.select(Suffrage.election, fn.SUM(Suffrage.yea),
+                            fn.COUNT(Suffrage.id), mine) \
+                    .where(Suffrage.election.in_(ids)) \
+                    .group_by(Suffrage.election) \
+                    .tuples()
+
+    result = dict.fromkeys(ids, EMPTY)
+    for elec, yeas, total, you in query:
+        result[elec] = Tally(yeas, total - yeas, (None, False, True)[you])
+    return result
+
+
+def tally(election, account=None, channel=None):
+    return tallies([election], account, channel)[getattr(election, 'id', election)]
+
+
+def ballots(election):
+    """ Returns the Tally and the names of the yea and nay voters of an
+    election, in one query """
+    yeas = []
+    nays = []
+    query = Suffrage.select(Suffrage.yea, User.name) \
+                    .join(User, on=(Suffrage.emitted_by == User.id)) \
+                    .where(Suffrage.election == election) \
+                    .tuples()
+    for yea, name in query:
+        (yeas if yea else nays).append(name)
+    return Tally(len(yeas), len(nays), None), yeas, nays
+
+
+class ElectionTally(object):
+    """ Running count of an open election's ballots """
+    __slots__ = ('ballots', 'yeas')
+
+    def __init__(self):
+        self.ballots = {}  # {"account": yea}
+        self.yeas = 0
+
+    def cast(self, account, yea):
+        """ Records a ballot, returns the previous one (or None) """
+        previous = self.ballots.get(account)
+        if previous is not None:
+            self.yeas -= previous
+        self.ballots[account] = yea
+        self.yeas += yea
+        return previous
+
+    def uncast(self, account, previous):
+        """ Reverts `cast`, given the ballot it returned """
+        self.yeas -= self.ballots.pop(account)
+        if previous is not None:
+            self.cast(account, previous)
+
+    def tally(self, account=None):
+        return Tally(self.yeas, len(self.ballots) - self.yeas,
+                     self.ballots.get(account))
+
+    def voters(self):
+        yeas = [k for k, v in self.ballots.items() if v]
+        nays = [k for k, v in self.ballots.items() if not v]
+        return yeas, nays
+
+
+class TallyCache(object):
+    """ Keeps the tallies of all open elections in memory so counting votes
+    doesn't need to touch the database. Built once by `load`, and kept up to
+    date with `open`, `cast` and `close`. """
+
+    def __init__(self):
+        self.elections = {}  # {election id: ElectionTally}
+
+    def load(self, state=None):
+        """ From a journal State if there's one, else from the tables """
+        if state is None:
+            self.elections = self._stored()
+            return
+        self.elections = {}
+        for elec, info in state.elections.items():
+            counted = self.elections[elec] = ElectionTally()
+            for account, yea in info['ballots'].items():
+                counted.cast(account, yea)
+
+    @staticmethod
+    def _stored(election=None):
+        elections = {}
+        query = Election.select(Election.id).where(Election.status == 0)
+        if election is not None:
+            query = query.where(Election.id == election)
+        for (elec,) in query.tuples():
+            elections[elec] = ElectionTally()
+        query = Suffrage.select(Suffrage.election, User.name, Suffrage.yea) \
+                        .join(User, on=(Suffrage.emitted_by == User.id)) \
+                        .switch(Suffrage) \
+                        .join(Election) \
+                        .where(Election.status == 0) \
+                        .order_by(Suffrage.id) \
+                        .tuples()
+        if election is not None:
+            query = query.where(Election.id == election)
+        for elec, name, yea in query:
+            elections[elec].cast(name, bool(yea))
+        return elections
+
+    @classmethod
+    def load_election(cls, election):
+        """ Reads the ElectionTally of a single open election """
+        election = getattr(election, 'id', election)
+        return cls._stored(election).get(election, ElectionTally())
+
+    def open(self, election):
+        self.elections[getattr(election, 'id', election)] = ElectionTally()
+
+    def get(self, election):
+        return self.elections.get(getattr(election, 'id', election))
+
+    def cast(self, election, account, yea):
+        return self.elections[getattr(election, 'id', election)] \
+                   .cast(account, yea)
+
+    def uncast(self, election, account, previous):
+        counted = self.get(election)
+        if counted is not None:  # Unless it closed meanwhile
+            counted.uncast(account, previous)
+
+    def close(self, election):
+        return self.elections.pop(getattr(election, 'id', election), None)
+
+    async def tallies(self, elections, account=None, channel=None):
+        """ Like `tallies`, but only asks the database (off the event
+        loop) for elections that aren't open """
+        ids = [getattr(elec, 'id', elec) for elec in elections]
+        result = {}
+        for elec in ids:
+            if elec in self.elections:
+                result[elec] = self.elections[elec].tally(account)
+        missing = [elec for elec in ids if elec not in result]
+        if missing:
+            result.update(await aiodb.run(tallies, missing, account, channel))
+        return result
+
+    def check(self):
+        """ Compares the cached tallies against the database. Returns a
+        list of (election id, cached Tally, stored Tally) that differ. """
+        stored = self._stored()
+        errors = []
+        for elec in set(stored) | set(self.elections):
+            cached = self.elections.get(elec, ElectionTally())
+            real = stored.get(elec, ElectionTally())
+            if cached.ballots != real.ballots:
+                errors.append((elec, cached.tally(), real.tally()))
+        return errors
@@ -0,0 +1,284 @@
+import asyncio
+import struct
+import collections
+import traceback
+from array import array
+from datetime import datetime, timedelta
+from models import User
+import aiodb
+
+
+def today():
+    return datetime.utcnow().toordinal()
+
+
+class DailyLines(object):
+    """ Lines said on each of the last `size` days, in a ring of counters:
+    day `d` (an ordinal) is kept in `counts[d % size]`. `total`, the sum of
+    the whole window, is kept up to date. Days before `start` weren't
+    counted. """
+    __slots__ = ('counts', 'day', 'start', 'total')
+    HEADER = struct.Struct('<ii')  # start, day
+
+    def __init__(self, size, day, start=None):
+        self.counts = array('H', bytes(2 * size))
+        self.day = day  # the latest day in the ring
+        self.start = day if start is None else min(start, day)
+        self.total = 0
+
+    def _advance(self, day):
+        # Forget the days that fell out of the window
+        size = len(self.counts)
+        if day - self.day >= size:
+            self.counts = array('H', bytes(2 * size))
+            self.total = 0
+        else:
+            for d in range(self.day + 1, day + 1):
+                self.total -= self.counts[d % size]
+                self.counts[d % size] = 0
+        self.day = max(self.day, day)
+
+    def add(self, day, lines=1):
+        self._advance(day)
+        if day <= self.day - len(self.counts):
+            return  # Too old to be in the window
+        i = day % len(self.counts)
+        lines = min(lines, 0xffff - self.counts[i])
+        self.counts[i] += lines
+        self.total += lines
+
+    def last(self, days, day):
+        """ Lines said in the `days` days up to `day`, or None if they
+        weren't all counted """
+        if days > len(self.counts) or self.start > day - days + 1:
+            return None
+        self._advance(day)
+        if days == len(self.counts) and day == self.day:
+            return self.total
+        # Days after `day` may have taken the place of the first ones
+        first = max(day - days, self.day - len(self.counts)) + 1
+        return sum(self.counts[d % len(self.counts)]
+                   for d in range(first, day + 1))
+
+    def merge(self, other):
+        """ Adds the lines counted by `other` """
+        for d in range(other.day - len(other.counts) + 1, other.day + 1):
+            lines = other.counts[d % len(other.counts)]
+            if lines:
+                self.add(d, lines)
+        self.start = min(self.start, other.start)
+
+    def dump(self):
+        return self.HEADER.pack(self.start, self.day) + self.counts.tobytes()
+
+    @classmethod
+    def load(cls, data, size):
+        start, day = cls.HEADER.unpack_from(data)
+        stored = cls(0, day, start)
+        stored.counts.frombytes(data[cls.HEADER.size:])
+        if len(stored.counts) == size:
+            stored.total = sum(stored.counts)
+            return stored
+        # The window was resized
+        lines = cls(size, day, start)
+        lines.merge(stored)
+        lines.start = max(start, day - min(size, len(stored.counts)) + 1)
+        return lines
+
+
+class UserRecord(object):
+    """ What we know about an account in a channel. `complete` is False
+    until its User row (if any) has been read, and `lines`/`first_seen`
+    only cover what was counted since. `recent` is a DailyLines, if lines
+    were ever counted by day. """
+    __slots__ = ('flags', 'lines', 'first_seen', 'last_seen', 'complete',
+                 'recent')
+
+    def __init__(self, flags='', lines=0, first_seen=None, last_seen=None,
+                 complete=False, recent=None):
+        self.flags = flags
+        self.lines = lines
+        self.first_seen = first_seen
+        self.last_seen = last_seen
+        self.complete = complete
+        self.recent = recent
+
+    def count(self, window, now):
+        """ Counts a line said at `now` """
+        day = now.toordinal()
+        if self.recent is None:
+            if not self.complete:
+                start = None  # Until the stored record says otherwise
+            elif self.last_seen is None:
+                start = 0  # Never said anything before
+            else:
+                start = self.last_seen.toordinal() + 1
+            self.recent = DailyLines(window, day, start)
+        self.recent.add(day)
+        if not self.lines:
+            self.first_seen = now
+        self.lines += 1
+        self.last_seen = now
+
+    def lines_in(self, days):
+        """ Lines said in the last `days` days (today included), or None if
+        we can't tell """
+        day = today()
+        if self.last_seen is not None and \
+           self.last_seen.toordinal() <= day - days:
+            return 0
+        if self.recent is None:
+            return None if self.lines else 0
+        return self.recent.last(days, day)
+
+
+class UserMap(object):
+    """ The accounts of a channel we keep in memory, least recently used
+    first.
+
+    Only accounts active in the last `preload` days are read at startup;
+    others are read from the database when they're needed (`fetch`). Past
+    `capacity` records, the least recently used ones are dropped, unless
+    they have flags (those only come from ChanServ) or unsaved activity
+    (`dirty`, or `writing` while it's being written). """
+
+    def __init__(self, channel, capacity=20000, preload=30, window=28):
+        self.channel = channel
+        self.capacity = capacity
+        self.preload = preload
+        self.window = window  # days of lines per day kept for each account
+        self._records = collections.OrderedDict()
+        self.dirty = set()  # accounts with activity not written yet
+        self.writing = set()  # accounts whose activity is being written
+        self._fetching = set()
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._records)
+
+    def __contains__(self, account):
+        return account in self._records
+
+    def __iter__(self):
+        return iter(list(self._records))
+
+    def __getitem__(self, account):
+        return self._records[account]
+
+    def items(self):
+        return list(self._records.items())
+
+    def values(self):
+        return list(self._records.values())
+
+    def get(self, account):
+        """ The record of `account` if it's in memory, or None """
+        record = self._records.get(account)
+        if record is not None:
+            self._records.move_to_end(account)
+        return record
+
+    def flags(self, account):
+        record = self._records.get(account)
+        return record.flags if record is not None else ''
+
+    def add(self, account):
+        """ Returns the record of `account`, creating an incomplete one if
+        it isn't in memory """
+        record = self.get(account)
+        if record is None:
+            if len(self._records) >= self.capacity:
+                self.evict(1)
+            record = self._records[account] = UserRecord()
+        return record
+
+    def evict(self, room=0):
+        """ Drops least recently used records until there's `room` for more
+        under capacity """
+        for _ in range(len(self._records)):
+            if len(self._records) + room <= self.capacity:
+                return
+            account, record = next(iter(self._records.items()))
+            if record.flags or account in self.dirty or account in self.writing:
+                self._records.move_to_end(account)
+            else:
+                del self._records[account]
+                self.evictions += 1
+
+    def load(self):
+        """ Reads the recently active accounts. Blocking, for startup. """
+        since = datetime.utcnow() - timedelta(days=self.preload)
+        query = User.select(User.name, User.lines, User.first_seen,
+                            User.last_seen, User.recent) \
+                    .where((User.channel == self.channel) &
+                           (User.last_seen >= since)) \
+                    .order_by(User.last_seen) \
+                    .tuples()
+        for name, lines, first_seen, last_seen, recent in query:
+            if recent is not None:
+                recent = DailyLines.load(recent, self.window)
+            self._records[name] = UserRecord('', lines, first_seen,
+                                             last_seen, True, recent)
+        self.evict()
+
+    def _row(self, account):
+        return User.get_or_none((User.channel == self.channel) &
+                                (User.name == account))
+
+    def _merge(self, account, row):
+        record = self.get(account)
+        if record is None:
+            if row is None:
+                return None
+            record = self.add(account)
+        if not record.complete:
+            record.complete = True
+            if row is None:
+                if record.recent is not None:
+                    record.recent.start = 0  # Nothing was said before
+                return record
+            # Add what we counted before knowing the stored values
+            record.lines += row.lines
+            record.first_seen = row.first_seen
+            if row.recent is not None:
+                stored = DailyLines.load(row.recent, self.window)
+                if record.recent is not None:
+                    stored.merge(record.recent)
+                record.recent = stored
+            elif record.recent is not None:
+                # Silent since the stored last line, as far as we know
+                record.recent.start = min(record.recent.start,
+                                          row.last_seen.toordinal() + 1)
+            if record.last_seen is None or record.last_seen < row.last_seen:
+                record.last_seen = row.last_seen
+        return record
+
+    async def fetch(self, account):
+        """ Returns the complete record of `account`, reading it from the
+        database if needed, or None if the account was never seen """
+        record = self.get(account)
+        if record is not None and record.complete:
+            return record
+        row = await aiodb.run(self._row, account)
+        return self._merge(account, row)  # It may have changed meanwhile
+
+    def complete(self):
+        """ Reads every incomplete dirty record. Blocking, for shutdown. """
+        for account in list(self.dirty):
+            if not self._records[account].complete:
+                self._merge(account, self._row(account))
+
+    def fault(self, account):
+        """ Starts reading `account` in the background """
+        if account in self._fetching:
+            return
+
+        async def fetch():
+            try:
+                await self.fetch(account)
+            except Exception:
+                traceback.print_exc()
+            finally:
+                self._fetching.discard(account)
+        self._fetching.add(account)
+        asyncio.ensure_future(fetch())
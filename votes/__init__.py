@@ -1,3 +1,7 @@
 from .civis import Civis, Censure, Staff, Destaff
 from .base import Opine
 from .management import Ban, Topic, Kick
+
+# {"name": vote class}, in the order they're listed to users
+BY_NAME = dict((vote.name, vote) for vote in (Civis, Censure, Staff, Destaff,
+                                              Kick, Topic, Opine, Ban))
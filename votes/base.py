@@ -1,6 +1,7 @@
 from datetime import datetime, timedelta
-import config
+import aiodb
 from models import Effective, Election
+from tally import Tally
 
 
 class BaseVote(object):
@@ -12,70 +13,120 @@ class BaseVote(object):
     supermajority = False
     name = "base"
     cooldown = 86400  # 1 day
+    # Lines the target must have said in the last `active_days` days
+    active_lines = 0
+    active_days = 28
+    # Close as soon as the remaining voters can't change the outcome. Ballots
+    # can't be changed then, or it never could be certain.
+    early_close = False
 
     is_target_user = True  # True if target is a user in the channel
 
-    def __init__(self, irc):
+    def __init__(self, irc, channel):
         self.irc = irc
+        self.channel = channel  # ChannelState
+
+    @property
+    def usermap(self):
+        return self.channel.usermap
+
+    @classmethod
+    def outcome(cls, result):
+        """ The status an election with Tally `result` closes with: 1
+        (passed), 2 (no quorum) or 3 (failed) """
+        if result.total < cls.quorum:
+            return 2
+        if result.approval < (75 if cls.supermajority else 51):
+            return 3
+        return 1
+
+    @classmethod
+    def decided(cls, result, remaining):
+        """ The status the election will pass or fail with whatever the
+        `remaining` voters do (or don't), or None if it isn't certain yet.
+        A quorum that can't be reached doesn't count, the electorate may
+        grow. Ballots already cast are taken as final, which they are for
+        `early_close` vote types. """
+        status = cls.outcome(result)
+        if status == 2:
+            return None
+        # Approval is lowest with every remaining ballot a nay, highest
+        # with every one a yea
+        if cls.outcome(Tally(result.yeas, result.nays + remaining, None)) != status or \
+           cls.outcome(Tally(result.yeas + remaining, result.nays, None)) != status:
+            return None
+        return status
 
     def get_target(self, args):
         if self.is_target_user:
-            try:
-                return self.irc.users[args[1]]['account'].lower()
-            except (AttributeError, KeyError):
-                return False
+            return self.irc.roster.account(args[1]) or False
         else:
             return " ".join(args[1:])
 
-    def vote_check(self, args, by):
-        if self.is_target_user:
-            try:
-                account = self.irc.users[args[1]]['account'].lower()
-            except KeyError:
-                return self.irc.notice(by, 'Can\'t start vote: User not found '
-                                       'or not identified.')
-            user = self.irc.usermap.get(account)
-            if not user or not user.get('lines'):
-                return self.irc.notice(by, 'Can\'t start vote: User has never '
-                                       'interacted with the channel.')
-
+    def _find_conflicts(self, target):
+        """ Returns the election id of an identical active motion (or
+        "Unknown election"), and a similar vote that failed recently """
+        active = None
+        x = Effective.select().where((Effective.channel == self.channel.key) &
+                                     (Effective.vote_type == self.name) &
+                                     (Effective.vote_target == target)).first()
+        if x is not None:
             try:
-                x = Effective.select().where((Effective.vote_type == self.name) &
-                                             (Effective.vote_target == self.get_target(args))) \
-                             .get()
-                try:
-                    elecid = x.election.id
-                except Election.DoesNotExist:
-                    elecid = "Unknown election"
-                return self.irc.notice(by, 'Can\'t start vote: There\'s an identical motion already active (\002{0}\002).'.format(elecid))
-            except Effective.DoesNotExist:
-                pass
-
-            try:
-                x = Election.select().where((Election.vote_type == self.name) &
-                                            (Election.vote_target == self.get_target(args)) &
-                                            (Election.status == 3) &
-                                            (Election.close > (datetime.utcnow() - timedelta(seconds=self.cooldown)))).get()
-                return self.irc.notice(by, 'Can\'t start vote: There was a similar vote that failed not too long ago (\002{0}\002).'.format(x.id))
+                active = x.election.id
             except Election.DoesNotExist:
-                pass
+                active = "Unknown election"
+        failed = Election.select().where((Election.channel == self.channel.key) &
+                                         (Election.vote_type == self.name) &
+                                         (Election.vote_target == target) &
+                                         (Election.status == 3) &
+                                         (Election.close > (datetime.utcnow() - timedelta(seconds=self.cooldown)))).first()
+        return active, failed
+
+    async def vote_check(self, args, by):
+        if self.is_target_user:
+            account = self.irc.roster.account(args[1])
+            if account is None:
+                return await self.irc.notice(by, 'Can\'t start vote: User not found '
+                                             'or not identified.')
+            user = await self.usermap.fetch(account)
+            if not user or not user.lines:
+                return await self.irc.notice(by, 'Can\'t start vote: User has never '
+                                             'interacted with the channel.')
+
+            active, failed = await aiodb.run(self._find_conflicts,
+                                             self.get_target(args))
+            if active is not None:
+                return await self.irc.notice(by, 'Can\'t start vote: There\'s an identical motion already active (\002{0}\002).'.format(active))
+
+            if failed is not None:
+                return await self.irc.notice(by, 'Can\'t start vote: There was a similar vote that failed not too long ago (\002{0}\002).'.format(failed.id))
 
             if self.required_time != 0:
                 reqtime = datetime.utcnow() - timedelta(seconds=self.required_time)
-                if user['first_seen'] > reqtime:
-                    return self.irc.notice(by, "Can't start vote: User at issue "
-                                           "has not been present long enough for "
-                                           "consideration.")
-
-                if user['last_seen'] < reqtime:
-                    return self.irc.notice(by, "Can't start vote: User at issue "
-                                           "has not been active recently.")
-
-                if user['lines'] < self.required_lines:
-                    return self.irc.notice(by, "Can't start vote: User at issue "
-                                           "has {0} of {1} required lines"
-                                           .format(user['lines'],
-                                                   self.required_lines))
+                if user.first_seen > reqtime:
+                    return await self.irc.notice(by, "Can't start vote: User at issue "
+                                                 "has not been present long enough for "
+                                                 "consideration.")
+
+                if user.last_seen < reqtime:
+                    return await self.irc.notice(by, "Can't start vote: User at issue "
+                                                 "has not been active recently.")
+
+                if user.lines < self.required_lines:
+                    return await self.irc.notice(by, "Can't start vote: User at issue "
+                                                 "has {0} of {1} required lines"
+                                                 .format(user.lines,
+                                                         self.required_lines))
+
+            if self.active_lines:
+                # None: not counted by day for long enough to tell
+                said = user.lines_in(self.active_days)
+                if said is not None and said < self.active_lines:
+                    return await self.irc.notice(by, "Can't start vote: User at issue "
+                                                 "has {0} of {1} lines required in "
+                                                 "the last {2} days"
+                                                 .format(said, self.active_lines,
+                                                         self.active_days))
         return True  # True = check passed
 
 
@@ -86,10 +137,10 @@ class Opine(BaseVote):
 
     is_target_user = False
 
-    def on_pass(self, issue):
-        self.irc.msg("The people of {0} decided \002{1}\002".format(
-                     config.CHANNEL,
-                     issue))
+    async def on_pass(self, issue):
+        await self.irc.msg(self.channel, "The people of {0} decided \002{1}\002".format(
+                           self.channel.name,
+                           issue))
 
-    def on_expire(self, target):
+    async def on_expire(self, target):
         pass
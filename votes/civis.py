@@ -1,6 +1,6 @@
-import config
+import aiodb
 from .base import BaseVote
-from models import Election, Effective
+from models import Effective
 
 
 class Civis(BaseVote):
@@ -9,55 +9,53 @@ class Civis(BaseVote):
     duration = 2419200  # 28 days
     name = "civis"
 
-    def on_pass(self, target):
-        self.irc.message('ChanServ', 'FLAGS {0} {1} +V'
-                         .format(config.CHANNEL, target))
-
-    def on_expire(self, target):
-        try:
-            x = Effective.select().where((Effective.vote_type == "staff") &
-                                         (Effective.vote_target == target)).get()
-            return self.irc.msg('\002{0}\002\'s civis expired. Not removing, as they are active staff.'.format(target))
-        except Effective.DoesNotExist:
-            pass
-        try:
-            x = Effective.select().where((Effective.vote_type == "civis")).count()
-            if x <= 3:
-                return self.irc.msg('\002{0}\002\'s civis expired. Not removing as there are too few enfranchised users.')
-        except Effective.DoesNotExist:
-            pass
-        self.irc.message('ChanServ', 'FLAGS {0} {1} -V'
-                         .format(config.CHANNEL, target))
-
-    def vote_check(self, args, by):
-        f = self.irc.usermap[self.get_target(args)]['flags']
+    async def on_pass(self, target):
+        await self.irc.message('ChanServ', 'FLAGS {0} {1} +V'
+                               .format(self.channel.name, target))
+
+    async def on_expire(self, target):
+        staff = Effective.select().where((Effective.channel == self.channel.key) &
+                                         (Effective.vote_type == "staff") &
+                                         (Effective.vote_target == target))
+        if await aiodb.run(staff.exists):
+            return await self.irc.msg(self.channel, '\002{0}\002\'s civis expired. Not removing, as they are active staff.'.format(target))
+        active = Effective.select().where((Effective.channel == self.channel.key) &
+                                          (Effective.vote_type == "civis"))
+        x = await aiodb.run(active.count)
+        if x <= 3:
+            return await self.irc.msg(self.channel, '\002{0}\002\'s civis expired. Not removing as there are too few enfranchised users.')
+        await self.irc.message('ChanServ', 'FLAGS {0} {1} -V'
+                               .format(self.channel.name, target))
+
+    async def vote_check(self, args, by):
+        f = self.usermap.flags(self.get_target(args))
         if 'V' in f:
-            return self.irc.notice(by, "Can't start vote: User at issue is "
-                                   "already enfranchised.")
-        return super().vote_check(args, by)
+            return await self.irc.notice(by, "Can't start vote: User at issue is "
+                                         "already enfranchised.")
+        return await super().vote_check(args, by)
 
 
 class Censure(BaseVote):
     supermajority = True
     name = "censure"
 
-    def on_pass(self, target):
-        self.irc.message('ChanServ', 'FLAGS {0} {1} -V'
-                         .format(config.CHANNEL, target))
+    async def on_pass(self, target):
+        await self.irc.message('ChanServ', 'FLAGS {0} {1} -V'
+                               .format(self.channel.name, target))
 
-    def on_expire(self, target):
-        self.irc.message('ChanServ', 'FLAGS {0} {1} +V'
-                         .format(config.CHANNEL, target))
+    async def on_expire(self, target):
+        await self.irc.message('ChanServ', 'FLAGS {0} {1} +V'
+                               .format(self.channel.name, target))
 
-    def vote_check(self, args, by):
-        f = self.irc.usermap[self.get_target(args)]['flags']
+    async def vote_check(self, args, by):
+        f = self.usermap.flags(self.get_target(args))
         if 'V' not in f:
-            return self.irc.notice(by, "Can't start vote: User at issue is "
-                                   "not enfranchised.")
+            return await self.irc.notice(by, "Can't start vote: User at issue is "
+                                         "not enfranchised.")
         if 'o' in f:
-            return self.irc.notice(by, "Can't start vote: User at issue is "
-                                   "a staff.")
-        return super().vote_check(args, by)
+            return await self.irc.notice(by, "Can't start vote: User at issue is "
+                                         "a staff.")
+        return await super().vote_check(args, by)
 
 
 class Staff(BaseVote):
@@ -70,33 +68,31 @@ class Staff(BaseVote):
     name = "staff"
     cooldown = 604800  # 7 days
 
-    def on_pass(self, target):
-        self.irc.message('ChanServ', 'FLAGS {0} {1} +O'
-                         .format(config.CHANNEL, target))
+    async def on_pass(self, target):
+        await self.irc.message('ChanServ', 'FLAGS {0} {1} +O'
+                               .format(self.channel.name, target))
 
-    def on_expire(self, target):
-        f = self.irc.usermap[target]['flags']
-        print(f, ' ', target)
+    async def on_expire(self, target):
+        f = self.usermap.flags(target)
         if 'V' in f:
             flags = '-VO'
         else:
             flags = '-O'
-        try:
-            x = Effective.select().where((Effective.vote_type == "staff")).count()
-            if x <= 2:
-                return self.irc.msg('\002{0}\002\'s civis expired. Not removing as there are too few enfranchised users.')
-        except Effective.DoesNotExist:
-            pass
-
-        self.irc.message('ChanServ', 'FLAGS {0} {1} {2}'
-                         .format(config.CHANNEL, target, flags))
-
-    def vote_check(self, args, by):
-        f = self.irc.usermap[self.get_target(args)]['flags']
+        active = Effective.select().where((Effective.channel == self.channel.key) &
+                                          (Effective.vote_type == "staff"))
+        x = await aiodb.run(active.count)
+        if x <= 2:
+            return await self.irc.msg(self.channel, '\002{0}\002\'s civis expired. Not removing as there are too few enfranchised users.')
+
+        await self.irc.message('ChanServ', 'FLAGS {0} {1} {2}'
+                               .format(self.channel.name, target, flags))
+
+    async def vote_check(self, args, by):
+        f = self.usermap.flags(self.get_target(args))
         if 'V' not in f:
-            return self.irc.notice(by, "Can't start vote: User at issue is "
-                                   "not enfranchised.")
-        return super().vote_check(args, by)
+            return await self.irc.notice(by, "Can't start vote: User at issue is "
+                                         "not enfranchised.")
+        return await super().vote_check(args, by)
 
 
 class Destaff(BaseVote):
@@ -107,16 +103,16 @@ class Destaff(BaseVote):
     name = "destaff"
     cooldown = 604800  # 7 days
 
-    def on_pass(self, target):
-        self.irc.message('ChanServ', 'FLAGS {0} {1} -O'
-                         .format(config.CHANNEL, target))
+    async def on_pass(self, target):
+        await self.irc.message('ChanServ', 'FLAGS {0} {1} -O'
+                               .format(self.channel.name, target))
 
-    def on_expire(self, target):
+    async def on_expire(self, target):
         pass
 
-    def vote_check(self, args, by):
-        f = self.irc.usermap[self.get_target(args)]['flags']
+    async def vote_check(self, args, by):
+        f = self.usermap.flags(self.get_target(args))
         if 'O' not in f:
-            return self.irc.notice(by, "Can't start vote: User at issue is "
-                                   "not staff.")
-        return super().vote_check(args, by)
+            return await self.irc.notice(by, "Can't start vote: User at issue is "
+                                         "not staff.")
+        return await super().vote_check(args, by)
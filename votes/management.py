@@ -1,4 +1,3 @@
-import config
 from .base import BaseVote
 
 
@@ -8,13 +7,13 @@ class Ban(BaseVote):
     duration = 259200  # 3 days
     name = "ban"
 
-    def on_pass(self, target):
-        self.irc.message('ChanServ', 'FLAGS {0} {1} +b'
-                         .format(config.CHANNEL, target))
+    async def on_pass(self, target):
+        await self.irc.message('ChanServ', 'FLAGS {0} {1} +b'
+                               .format(self.channel.name, target))
 
-    def on_expire(self, target):
-        self.irc.message('ChanServ', 'FLAGS {0} {1} -b'
-                         .format(config.CHANNEL, target))
+    async def on_expire(self, target):
+        await self.irc.message('ChanServ', 'FLAGS {0} {1} -b'
+                               .format(self.channel.name, target))
 
 
 class Kick(BaseVote):
@@ -22,10 +21,10 @@ class Kick(BaseVote):
     name = "kick"
     duration = 0
 
-    def on_pass(self, target):
-        self.irc.kick(config.CHANNEL, target, "The people have decided.")
+    async def on_pass(self, target):
+        await self.irc.kick(self.channel.name, target, "The people have decided.")
 
-    def on_expire(self, target):
+    async def on_expire(self, target):
         pass
 
 
@@ -36,8 +35,8 @@ class Topic(BaseVote):
 
     is_target_user = False
 
-    def on_pass(self, issue):
-        self.irc.message('ChanServ', 'TOPIC {0} {1}'.format(config.CHANNEL, issue))
+    async def on_pass(self, issue):
+        await self.irc.message('ChanServ', 'TOPIC {0} {1}'.format(self.channel.name, issue))
 
-    def on_expire(self, target):
+    async def on_expire(self, target):
         pass